@@ -0,0 +1,177 @@
+"""
+下载存档（SQLite）
+记录已经下载完成的视频：按 bvid/cid/清晰度/编码/输出格式 索引，保存文件路径、大小、哈希和时间，
+批量下载前一次性查出已下载的视频并跳过；存档文件也可以直接用 sqlite3 查询做媒体库统计
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    bvid TEXT NOT NULL,
+    cid INTEGER NOT NULL,
+    quality INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    output_format TEXT NOT NULL,
+    download_type TEXT NOT NULL,
+    aid INTEGER,
+    page INTEGER NOT NULL DEFAULT 1,
+    requested_quality INTEGER,
+    title TEXT,
+    path TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (bvid, cid, quality, codec, output_format, download_type)
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_video
+    ON downloads (bvid, page, download_type, output_format);
+CREATE INDEX IF NOT EXISTS idx_downloads_aid ON downloads (aid);
+"""
+
+# 一条IN查询中的最多参数个数（SQLite默认上限为999）
+QUERY_CHUNK = 500
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadArchive:
+    """
+    下载存档，可在多个线程中同时使用
+    同一视频的同一清晰度、编码和输出格式只保留一条记录，重新下载时更新路径、大小和哈希
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def record(self, bvid, cid, quality, codec, output_format, download_type, path,
+               aid=None, page=1, requested_quality=None, title='', size=None, sha256=None):
+        """记录一次完成的下载"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO downloads (bvid, cid, quality, codec, output_format, download_type,
+                                       aid, page, requested_quality, title, path, size, sha256,
+                                       created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bvid, cid, quality, codec, output_format, download_type) DO UPDATE SET
+                    aid = excluded.aid, page = excluded.page,
+                    requested_quality = excluded.requested_quality, title = excluded.title,
+                    path = excluded.path, size = excluded.size, sha256 = excluded.sha256,
+                    updated = excluded.updated
+                """,
+                (bvid, cid, quality, codec or '', output_format, download_type, aid, page or 1,
+                 requested_quality, title, path, size, sha256, now, now)
+            )
+
+    def _select(self, column, values, download_type, output_format, quality):
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), QUERY_CHUNK):
+            chunk = values[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            with self._lock:
+                rows.extend(self._conn.execute(
+                    f"""
+                    SELECT * FROM downloads
+                    WHERE {column} IN ({placeholders})
+                      AND download_type = ? AND output_format = ?
+                      AND (requested_quality = ? OR quality >= ?)
+                    ORDER BY updated
+                    """,
+                    chunk + [download_type, output_format, quality, quality]
+                ).fetchall())
+        return rows
+
+    def find_existing(self, videos, download_type, output_format, quality, check_files=True):
+        """
+        批量查找已下载的视频（只查本地存档，不访问网络）
+        videos: [{'bvid' 或 'aid': ..., 'page': 页码或None}, ...]
+        quality: 请求的清晰度（仅音频时为音质），之前以相同参数请求过或实际清晰度不低于它时算作已下载
+        check_files: 同时确认文件仍然存在且大小一致
+        返回: {videos中的下标: 存档记录dict}
+        """
+        bvids = {v['bvid'] for v in videos if v.get('bvid')}
+        aids = {int(v['aid']) for v in videos if v.get('aid') and str(v['aid']).isdigit()}
+
+        found = {}
+        for column, values in (('bvid', bvids), ('aid', aids)):
+            for row in self._select(column, values, download_type, output_format, quality):
+                row = dict(row)
+                if check_files and not self._file_intact(row):
+                    continue
+                # 按更新时间排序，同一视频保留最新的记录
+                found[(column, row[column], row['page'])] = row
+
+        result = {}
+        for index, video in enumerate(videos):
+            page = video.get('page') or 1
+            if video.get('bvid'):
+                row = found.get(('bvid', video['bvid'], page))
+            else:
+                aid = str(video.get('aid', ''))
+                row = found.get(('aid', int(aid), page)) if aid.isdigit() else None
+            if row:
+                result[index] = row
+        return result
+
+    @staticmethod
+    def _file_intact(row):
+        try:
+            return row['size'] is None or os.path.getsize(row['path']) == row['size']
+        except OSError:
+            return False
+
+    def iter_records(self, **filters):
+        """按条件（列名=值）逐条产出存档记录，按完成时间排序"""
+        conditions = ' AND '.join(f"{column} = ?" for column in filters)
+        query = "SELECT * FROM downloads"
+        if conditions:
+            query += " WHERE " + conditions
+        query += " ORDER BY updated"
+        with self._lock:
+            rows = self._conn.execute(query, list(filters.values())).fetchall()
+        for row in rows:
+            yield dict(row)
+
+    def summary(self):
+        """媒体库统计：总数、总大小，以及按输出格式和下载类型的分类"""
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COUNT(*) AS count, COUNT(DISTINCT bvid) AS videos, "
+                "COALESCE(SUM(size), 0) AS size FROM downloads"
+            ).fetchone()
+            groups = self._conn.execute(
+                "SELECT output_format, download_type, COUNT(*) AS count, "
+                "COALESCE(SUM(size), 0) AS size FROM downloads "
+                "GROUP BY output_format, download_type ORDER BY count DESC"
+            ).fetchall()
+        return {
+            'count': total['count'],
+            'videos': total['videos'],
+            'size': total['size'],
+            'by_format': [dict(row) for row in groups],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,442 @@
+"""
+Bilibili API异步客户端
+基于asyncio和aiohttp，所有请求共享一个连接池，适合同时处理大量视频信息查询和下载
+接口与 BilibiliAPI 保持一致，解析逻辑直接复用 BilibiliAPI
+"""
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:  # 可选依赖，仅异步客户端需要
+    aiohttp = None
+
+from bilibili_api import BilibiliAPI, DownloadManifest, MetadataCache, StreamCatalog
+from bandwidth import get_limiter
+from filewriter import FileWriter, FSYNC_CLOSE
+from ratelimit import RequestScheduler, parse_retry_after
+
+
+class AsyncBilibiliAPI:
+    QUALITY_MAP = BilibiliAPI.QUALITY_MAP
+    AUDIO_QUALITY_MAP = BilibiliAPI.AUDIO_QUALITY_MAP
+
+    API_BASE = BilibiliAPI.API_BASE
+    PASSPORT_BASE = BilibiliAPI.PASSPORT_BASE
+
+    DOWNLOAD_CONNECTIONS = BilibiliAPI.DOWNLOAD_CONNECTIONS
+    MIN_SEGMENT_SIZE = BilibiliAPI.MIN_SEGMENT_SIZE
+    SEGMENT_RETRIES = BilibiliAPI.SEGMENT_RETRIES
+    MANIFEST_FLUSH_BYTES = BilibiliAPI.MANIFEST_FLUSH_BYTES
+
+    # 超时（秒）：接口请求与同步客户端一致；下载只限制连接和单次读取，不限制总时长
+    API_TIMEOUT = 10
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 30
+
+    def __init__(self, cookies=None, max_concurrency=8, max_connections=32, cache=None,
+                 scheduler=None):
+        """
+        cookies: 已有的登录cookies（例如 BilibiliAPI.load_login_state 之后的 api.cookies）
+        max_concurrency: 同时进行的接口请求数
+        max_connections: 连接池大小，同时也是所有下载共用的连接数上限
+        cache: 元数据缓存（MetadataCache），可与 BilibiliAPI.cache 共用
+        scheduler: 接口请求调度器（RequestScheduler），可与 BilibiliAPI.scheduler 共用
+        """
+        if aiohttp is None:
+            raise ImportError("异步客户端需要aiohttp，请先安装: pip install aiohttp")
+        # 下载文件的fsync策略（见 filewriter.FSYNC_POLICIES）
+        self.fsync_policy = FSYNC_CLOSE
+        # 与同步客户端共用进程内的全局限速器
+        self.bandwidth = get_limiter()
+
+        self.headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Referer': 'https://www.bilibili.com'
+        }
+        self.cookies = dict(cookies or {})
+        self.is_logged_in = 'SESSDATA' in self.cookies
+
+        self.download_connections = self.DOWNLOAD_CONNECTIONS
+        self.min_segment_size = self.MIN_SEGMENT_SIZE
+
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self._api_slots = None
+        self._download_slots = None
+        self._session = None
+
+        self.cache = cache or MetadataCache()
+        # 与同步客户端相同的降速和重试策略
+        self.scheduler = scheduler or RequestScheduler()
+
+    async def __aenter__(self):
+        await self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _get_session(self):
+        """延迟创建会话和并发限制（必须在事件循环中创建）"""
+        if self._session is None or self._session.closed:
+            self._api_slots = asyncio.Semaphore(self.max_concurrency)
+            self._download_slots = asyncio.Semaphore(self.max_connections)
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.CONNECT_TIMEOUT,
+                                            sock_read=self.READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(headers=self.headers, connector=connector,
+                                                  timeout=timeout)
+            self._session.cookie_jar.update_cookies(self.cookies)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _get_json(self, url, params=None):
+        """
+        接口请求（受并发数限制）
+        经过请求调度器：被风控、HTTP 429/5xx 或网络错误时降速并重试
+        """
+        session = await self._get_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.API_TIMEOUT,
+                                        sock_read=self.API_TIMEOUT)
+
+        async def send():
+            async with self._api_slots:
+                async with session.get(url, params=params, timeout=timeout) as response:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError:
+                        # 风控和网关错误常常返回HTML页面
+                        data = None
+                    return (response.status, data,
+                            parse_retry_after(response.headers.get('Retry-After')))
+
+        return await self.scheduler.run_async(send)
+
+    async def _cached_get_json(self, endpoint, url, params):
+        """经过元数据缓存的接口请求，同一key的并发请求（包括同步客户端的）合并为一次"""
+        key = self.cache.make_key(endpoint, params, self.cookies.get('DedeUserID', ''))
+        return await self.cache.get_or_fetch_async(endpoint, key,
+                                                   lambda: self._get_json(url, params))
+
+    async def generate_qr_code(self):
+        """生成登录二维码"""
+        try:
+            url = f'{self.PASSPORT_BASE}/x/passport-login/web/qrcode/generate'
+            data = await self._get_json(url)
+
+            if data['code'] != 0:
+                return None, None, "获取二维码失败"
+
+            qr_url = data['data']['url']
+            qrcode_key = data['data']['qrcode_key']
+
+            return BilibiliAPI.make_qr_image(qr_url), qrcode_key, None
+
+        except Exception as e:
+            return None, None, f"生成二维码出错: {str(e)}"
+
+    async def check_qr_status(self, qrcode_key):
+        """检查二维码扫描状态"""
+        try:
+            url = f'{self.PASSPORT_BASE}/x/passport-login/web/qrcode/poll'
+            data = await self._get_json(url, {'qrcode_key': qrcode_key})
+
+            code = data['data']['code']
+
+            if code == 0:
+                session = await self._get_session()
+                self.cookies = {cookie.key: cookie.value for cookie in session.cookie_jar}
+                self.is_logged_in = 'SESSDATA' in self.cookies
+
+                if self.is_logged_in:
+                    return 'success', '登录成功'
+                else:
+                    return 'error', '登录失败: 未获取到有效凭证'
+
+            elif code in BilibiliAPI.QR_STATUS:
+                return BilibiliAPI.QR_STATUS[code]
+            else:
+                return 'error', f'未知状态码: {code}'
+
+        except Exception as e:
+            return 'error', f'检查状态出错: {str(e)}'
+
+    async def wait_qr_login(self, qrcode_key, interval=2, timeout=180):
+        """
+        轮询二维码状态直到登录成功、失效或超时
+        返回: (status, message)
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status, message = await self.check_qr_status(qrcode_key)
+            if status in ('success', 'expired', 'error'):
+                return status, message
+            await asyncio.sleep(interval)
+        return 'expired', '等待扫码超时'
+
+    async def get_video_info(self, url):
+        """获取视频信息"""
+        try:
+            params = BilibiliAPI.parse_video_params(url)
+            if not params:
+                return None, "无效的视频URL"
+
+            data = await self._cached_get_json('view', f'{self.API_BASE}/x/web-interface/view',
+                                               params)
+
+            if data['code'] != 0:
+                return None, f"获取视频信息失败: {data.get('message', '未知错误')}"
+
+            return data['data'], None
+
+        except Exception as e:
+            return None, f"获取视频信息出错: {str(e)}"
+
+    async def get_stream_catalog(self, bvid, cid, qn=127):
+        """
+        获取视频的流目录（一次playurl请求，结果经过缓存）
+        返回: (StreamCatalog, error)
+        """
+        try:
+            params = BilibiliAPI.playurl_params(bvid, cid, qn)
+            data = await self._cached_get_json('playurl', f'{self.API_BASE}/x/player/playurl',
+                                               params)
+
+            if data['code'] != 0:
+                return None, data.get('message', '未知错误')
+
+            return StreamCatalog(data['data']), None
+
+        except Exception as e:
+            return None, str(e)
+
+    async def get_available_qualities(self, bvid, cid):
+        """获取视频可用的清晰度列表"""
+        catalog, error = await self.get_stream_catalog(bvid, cid)
+        if error:
+            return [], [], f"获取清晰度列表失败: {error}"
+
+        video_qualities, audio_qualities = catalog.qualities(self.QUALITY_MAP, self.AUDIO_QUALITY_MAP)
+        return video_qualities, audio_qualities, None
+
+    async def get_download_urls(self, bvid, cid, qn=80, audio_qn=30280, codecs=None):
+        """
+        获取音视频下载链接
+        返回: (video_url, audio_url, video_size, audio_size, error)
+        """
+        catalog, error = await self.get_stream_catalog(bvid, cid)
+
+        if not error and not catalog.is_dash and catalog.quality != qn \
+                and qn in catalog.accept_quality:
+            catalog, error = await self.get_stream_catalog(bvid, cid, qn)
+
+        if error:
+            return None, None, 0, 0, f"获取下载链接失败: {error}"
+
+        return catalog.download_urls(qn, audio_qn, codecs)
+
+    async def probe_file_size(self, url):
+        """
+        探测远程文件大小及是否支持Range请求
+        返回: (total_size, accept_ranges, validator)
+        """
+        try:
+            session = await self._get_session()
+            headers = {'Range': 'bytes=0-0'}
+            async with session.get(url, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(total=10)) as response:
+                validator = response.headers.get('etag') or response.headers.get('last-modified')
+
+                if response.status == 206:
+                    total = response.headers.get('content-range', '').rsplit('/', 1)[-1]
+                    if total.isdigit():
+                        return int(total), True, validator
+
+                if response.status == 200:
+                    return int(response.headers.get('content-length', 0)), False, validator
+
+            return 0, False, None
+        except Exception:
+            return 0, False, None
+
+    async def download_file(self, url, save_path, progress_callback=None, desc="",
+                            connections=None, min_segment_size=None, stream_info=None,
+                            resume=True):
+        """
+        下载文件，行为与 BilibiliAPI.download_file 相同（分段并发、断点续传）
+        取消该协程即可中止下载，已完成的区间保存在断点清单中
+        """
+        try:
+            connections = connections or self.download_connections
+            min_segment_size = min_segment_size or self.min_segment_size
+
+            total_size, accept_ranges, validator = await self.probe_file_size(url)
+            if accept_ranges and total_size > 0:
+                identity = dict(stream_info or {'path': urlsplit(url).path})
+                identity['size'] = total_size
+                identity['validator'] = validator
+
+                if resume:
+                    manifest = DownloadManifest.load(save_path, identity)
+                else:
+                    manifest = DownloadManifest(save_path, identity)
+
+                return await self._download_segmented(
+                    url, save_path, total_size, manifest, connections, min_segment_size,
+                    progress_callback, desc
+                )
+
+            return await self._download_single(url, save_path, progress_callback, desc)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return False, f"下载出错: {str(e)}"
+
+    async def _throttle(self, size):
+        """按全局限速等待（不阻塞事件循环）"""
+        delay = self.bandwidth.reserve(size)
+        while delay > 0:
+            await asyncio.sleep(min(delay, 0.5))
+            delay = self.bandwidth.pending()
+
+    @staticmethod
+    async def _in_thread(func, *args):
+        """在线程池中执行文件操作（预分配、写入、fsync可能很慢），不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _download_single(self, url, save_path, progress_callback=None, desc=""):
+        """单连接顺序下载"""
+        session = await self._get_session()
+        async with self._download_slots:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return False, f"下载失败: HTTP {response.status}"
+
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded_size = 0
+
+                writer = await self._in_thread(FileWriter, save_path, False, self.fsync_policy)
+                try:
+                    if total_size > 0:
+                        await self._in_thread(writer.preallocate, total_size)
+                    # iter_any 每次取出已到达的全部数据，高速链接上调用次数更少
+                    async for chunk in response.content.iter_any():
+                        await self._in_thread(writer.write, chunk)
+                        downloaded_size += len(chunk)
+
+                        if progress_callback and total_size > 0:
+                            progress = (downloaded_size / total_size) * 100
+                            progress_callback(progress, downloaded_size, total_size, desc)
+                        await self._throttle(len(chunk))
+                finally:
+                    await self._in_thread(writer.close)
+
+        return True, "下载完成"
+
+    async def _download_segmented(self, url, save_path, total_size, manifest, connections,
+                                  min_segment_size, progress_callback=None, desc=""):
+        """多连接分段下载，进度同步写入断点清单"""
+        resume = bool(manifest.completed) and os.path.exists(save_path)
+        if not resume:
+            manifest.completed = []
+
+        writer = await self._in_thread(FileWriter, save_path, resume, self.fsync_policy)
+        try:
+            await self._in_thread(writer.preallocate, total_size)
+            return await self._fetch_segments(url, writer, total_size, manifest, connections,
+                                              min_segment_size, progress_callback, desc)
+        finally:
+            await self._in_thread(writer.close)
+
+    async def _fetch_segments(self, url, writer, total_size, manifest, connections,
+                              min_segment_size, progress_callback, desc):
+        """并发下载清单中缺失的区间，写入 writer 的对应偏移"""
+        missing = manifest.missing(total_size)
+        if not missing:
+            # 清单已覆盖整个文件（上次在删除清单前退出），不需要再下载
+            if progress_callback:
+                progress_callback(100, total_size, total_size, desc)
+            manifest.remove()
+            return True, "下载完成"
+
+        ranges = []
+        for start, stop in missing:
+            ranges.extend(BilibiliAPI.split_ranges(stop - start, connections, min_segment_size, start))
+
+        session = await self._get_session()
+        state = {'downloaded': manifest.completed_bytes()}
+        job_slots = asyncio.Semaphore(connections)
+
+        async def fetch(segment):
+            start, end = segment
+            position = start
+            committed = start
+            last_error = None
+
+            async with job_slots, self._download_slots:
+                for _ in range(self.SEGMENT_RETRIES):
+                    try:
+                        headers = {'Range': f'bytes={position}-{end}'}
+                        async with session.get(url, headers=headers) as response:
+                            if response.status != 206:
+                                raise IOError(f"HTTP {response.status}")
+
+                            try:
+                                async for chunk in response.content.iter_any():
+                                    chunk = chunk[:end + 1 - position]
+                                    await self._in_thread(writer.pwrite, chunk, position)
+                                    position += len(chunk)
+                                    state['downloaded'] += len(chunk)
+                                    if progress_callback:
+                                        downloaded = state['downloaded']
+                                        progress_callback(downloaded / total_size * 100,
+                                                          downloaded, total_size, desc)
+                                    await self._throttle(len(chunk))
+
+                                    if position - committed >= self.MANIFEST_FLUSH_BYTES:
+                                        await self._in_thread(writer.checkpoint)
+                                        manifest.add(committed, position)
+                                        committed = position
+                                    if position > end:
+                                        break
+                            finally:
+                                await self._in_thread(writer.checkpoint)
+                                manifest.add(committed, position)
+                                committed = position
+
+                        if position > end:
+                            return
+                        last_error = IOError("连接提前关闭")
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        last_error = e
+
+            raise IOError(f"分段 {start}-{end} 下载失败: {last_error}")
+
+        tasks = [asyncio.ensure_future(fetch(r)) for r in ranges]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            error = next((t.exception() for t in done if t.exception()), None)
+        finally:
+            # 出错或被取消时结束其余分段，并保留断点
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if manifest.completed_bytes() != total_size:
+                manifest.save(force=True)
+
+        if error:
+            return False, f"下载出错: {str(error)}（已保存断点，可重试续传）"
+        if manifest.completed_bytes() != total_size:
+            return False, f"下载不完整: {manifest.completed_bytes()}/{total_size}"
+
+        manifest.remove()
+        return True, "下载完成"
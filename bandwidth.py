@@ -0,0 +1,228 @@
+"""
+下载限速（令牌桶）
+进程内所有下载共用一个全局令牌桶，每个任务可以再有自己的令牌桶；
+支持运行中调整速度和按时段自动切换速度
+
+读取不会为了限速而变小：每读到一块数据就扣除相应令牌（允许欠账），
+欠账时睡眠到令牌补足为止，不忙等
+"""
+import re
+import threading
+import time
+from datetime import datetime
+
+
+UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """
+    解析速度字符串，如 '500K'、'2M'、'1.5MB'（单位为字节/秒）
+    '0'、空字符串或None表示不限速，返回None
+    """
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return text or None
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?)(?:i?B)?(?:/s)?\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无法识别的速度: {text}")
+    rate = float(match.group(1)) * UNITS[match.group(2).upper()]
+    return int(rate) or None
+
+
+def parse_schedule(text):
+    """
+    解析时段限速，如 '09:00-18:00=2M,18:00-23:00=10M'
+    返回: [(start_minutes, end_minutes, rate), ...]，结束时间早于开始时间表示跨过午夜
+    """
+    rules = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', part)
+        if not match:
+            raise ValueError(f"无法识别的时段: {part}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        rules.append((start, end, parse_rate(match.group(5))))
+    return rules
+
+
+class TokenBucket:
+    """
+    令牌桶，rate为字节/秒，None表示不限速
+    burst为桶容量，默认为一秒的流量
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._cond = threading.Condition()
+        self.rate = rate or None
+        self.burst = burst
+        self.tokens = self._capacity()
+        self.last = time.monotonic()
+
+    def _capacity(self):
+        if not self.rate:
+            return 0
+        return self.burst or self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._capacity(), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate, burst=None):
+        """调整速度，正在等待的线程会按新速度重新计算"""
+        with self._cond:
+            self._refill()
+            self.rate = rate or None
+            if burst is not None:
+                self.burst = burst
+            if not self.rate:
+                self.tokens = 0
+            else:
+                self.tokens = min(self.tokens, self._capacity())
+            self._cond.notify_all()
+
+    def reserve(self, size):
+        """扣除令牌（可以欠账），返回需要等待的秒数"""
+        with self._cond:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self.tokens -= size
+            return self._delay()
+
+    def _delay(self):
+        if not self.rate or self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def delay(self):
+        """还需等待的秒数"""
+        with self._cond:
+            self._refill()
+            return self._delay()
+
+    def wait(self, cancel_event=None, max_wait=0.5):
+        """
+        睡眠到欠账还清；每次最多睡 max_wait 秒，以便响应取消
+        返回: False表示等待期间被取消
+        """
+        with self._cond:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                self._refill()
+                delay = self._delay()
+                if delay <= 0:
+                    return True
+                self._cond.wait(min(delay, max_wait))
+
+    def consume(self, size, cancel_event=None):
+        """扣除令牌并在需要时等待"""
+        if self.reserve(size) > 0:
+            return self.wait(cancel_event)
+        return True
+
+
+class BandwidthLimiter:
+    """
+    全局限速器：所有下载都从全局令牌桶取令牌，任务还可以有自己的令牌桶（单任务上限）
+    schedule: 时段限速规则（见 parse_schedule），当前时间落在某个时段内时使用该时段的速度，
+              否则使用 set_rate 设置的基础速度
+    """
+
+    SCHEDULE_CHECK_INTERVAL = 10  # 检查时段切换的间隔（秒）
+
+    def __init__(self, rate=None, schedule=None):
+        self.base_rate = rate or None
+        self.schedule = list(schedule or [])
+        self.bucket = TokenBucket(self._scheduled_rate())
+        self._next_check = time.monotonic() + self.SCHEDULE_CHECK_INTERVAL
+        self._lock = threading.Lock()
+        self.transferred = 0
+
+    def _scheduled_rate(self, now=None):
+        now = now or datetime.now()
+        minutes = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= minutes < end:
+                    return rate
+            elif minutes >= start or minutes < end:
+                return rate
+        return self.base_rate
+
+    @property
+    def rate(self):
+        """当前生效的全局速度（字节/秒），None表示不限速"""
+        return self.bucket.rate
+
+    def set_rate(self, rate):
+        """调整基础速度（运行中立即生效；处于限速时段时以时段速度为准）"""
+        self.base_rate = rate or None
+        self.bucket.set_rate(self._scheduled_rate())
+
+    def set_schedule(self, schedule):
+        self.schedule = list(schedule or [])
+        self.bucket.set_rate(self._scheduled_rate())
+
+    def _check_schedule(self):
+        now = time.monotonic()
+        if not self.schedule or now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.SCHEDULE_CHECK_INTERVAL
+        rate = self._scheduled_rate()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+
+    def job(self, rate=None):
+        """为单个任务创建令牌桶，rate为None时不限制单任务速度"""
+        return TokenBucket(rate) if rate else None
+
+    def consume(self, size, job=None, cancel_event=None):
+        """
+        传输 size 字节后调用：先受单任务上限约束，再受全局上限约束
+        返回: False表示等待期间被取消
+        """
+        with self._lock:
+            self.transferred += size
+        if job is not None and not job.consume(size, cancel_event):
+            return False
+        self._check_schedule()
+        return self.bucket.consume(size, cancel_event)
+
+    def reserve(self, size, job=None):
+        """
+        非阻塞版本（供异步客户端使用）：扣除令牌并返回需要等待的秒数
+        等待结束后应再用 pending 确认（期间速度可能被调整）
+        """
+        with self._lock:
+            self.transferred += size
+        self._check_schedule()
+        delay = self.bucket.reserve(size)
+        if job is not None:
+            delay = max(delay, job.reserve(size))
+        return delay
+
+    def pending(self, job=None):
+        """当前还需等待的秒数"""
+        delay = self.bucket.delay()
+        if job is not None:
+            delay = max(delay, job.delay())
+        return delay
+
+
+_default_limiter = BandwidthLimiter()
+
+
+def get_limiter():
+    """进程内共用的全局限速器"""
+    return _default_limiter
@@ -0,0 +1,321 @@
+"""
+本地的B站接口和CDN替身（基准测试用）
+接口服务器模拟 /x/web-interface/view 和 /x/player/playurl，任何BV号都返回一个视频，
+可以设置请求速率上限，超过时像B站风控一样返回 HTTP 412 / code -412；
+每个CDN服务器是一个单独的端口（即不同的镜像主机），按配置限速、加延迟和注入错误
+
+用法: python benchmarks/fake_server.py --config '{"cdn": [{"rate": 4194304}]}'
+启动后向标准输出打印一行JSON: {"api": 接口地址, "cdn": [CDN地址, ...]}，标准输入关闭时退出
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+DEFAULT_CONFIG = {
+    'api_latency': 0.0,           # 接口响应前的延迟（秒）
+    'api_rate_limit': None,       # 接口每秒最多接受的请求数，超过时返回 -412
+    'pages': 1,                   # 每个视频的分P数
+    'duration': 60,               # 视频时长（秒）
+    'video_size': 32 * 1024 * 1024,
+    'audio_size': 4 * 1024 * 1024,
+    'media': None,                # {'video': 文件路径, 'audio': 文件路径}，设置后CDN返回这些文件
+    'cdn': [{}],                  # 每项一个CDN镜像，第一个为baseUrl，其余为backupUrl
+}
+
+DEFAULT_CDN = {
+    'rate': None,         # 每个连接的速度上限（字节/秒）
+    'latency': 0.0,       # 响应头之前的延迟（秒）
+    'error_rate': 0.0,    # 直接返回503的概率
+    'drop_rate': 0.0,     # 传输中途断开连接的概率
+    'range': True,        # 是否支持Range请求
+}
+
+# 响应内容由这块随机数据循环拼成，任意大小的文件都不占额外内存
+BLOCK = os.urandom(1024 * 1024)
+WRITE_SIZE = 64 * 1024
+
+
+def body_slice(start, stop):
+    """循环数据中 [start, stop) 区间的内容，按 WRITE_SIZE 分块产出"""
+    position = start
+    while position < stop:
+        offset = position % len(BLOCK)
+        size = min(WRITE_SIZE, stop - position, len(BLOCK) - offset)
+        yield BLOCK[offset:offset + size]
+        position += size
+
+
+class Stats:
+    """各服务器的请求数、错误数和发送字节数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.servers = {}
+        # 接口最近的请求时间（用于模拟限速）
+        self._recent = deque()
+
+    def add(self, name, **counts):
+        with self._lock:
+            entry = self.servers.setdefault(name, {'requests': 0, 'errors': 0, 'drops': 0,
+                                                   'bytes': 0})
+            for key, value in counts.items():
+                entry[key] += value
+
+    def over_limit(self, limit, window=1.0):
+        """记录一次请求，返回最近 window 秒内的请求数是否超过 limit"""
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= window:
+                self._recent.popleft()
+            self._recent.append(now)
+            return len(self._recent) > limit * window
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.servers))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分开写入，不关闭Nagle算法时小响应会多出几十毫秒的延迟
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class APIHandler(Handler):
+    """模拟B站接口"""
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        server.stats.add('api', requests=1)
+
+        if parts.path == '/__stats':
+            return self.send_json(server.stats.snapshot())
+
+        if config['api_latency']:
+            time.sleep(config['api_latency'])
+        if config['api_rate_limit'] and server.stats.over_limit(config['api_rate_limit']):
+            server.stats.add('api', errors=1)
+            return self.send_json({'code': -412, 'message': '请求被拦截'}, status=412)
+
+        if parts.path == '/x/web-interface/view':
+            return self.send_json({'code': 0, 'message': '0', 'data': self.view(query)})
+        if parts.path == '/x/player/playurl':
+            return self.send_json({'code': 0, 'message': '0', 'data': self.playurl(query)})
+
+        server.stats.add('api', errors=1)
+        self.send_json({'code': -404, 'message': '啥都木有'}, status=404)
+
+    def view(self, query):
+        config = self.server.config
+        bvid = query.get('bvid') or f"BV{query.get('aid', '0')}"
+        aid = int(query.get('aid') or sum(map(ord, bvid)))
+        pages = [
+            {'cid': aid * 100 + n, 'page': n, 'part': f'P{n}', 'duration': config['duration']}
+            for n in range(1, config['pages'] + 1)
+        ]
+        return {
+            'bvid': bvid, 'aid': aid, 'cid': pages[0]['cid'], 'title': f'benchmark {bvid}',
+            'duration': config['duration'], 'pages': pages, 'pic': '', 'desc': '',
+            'owner': {'mid': 1, 'name': 'benchmark'},
+            'stat': {'view': 0, 'danmaku': 0, 'like': 0, 'coin': 0, 'favorite': 0},
+        }
+
+    def stream_urls(self, name, size):
+        deadline = int(time.time()) + 7200
+        urls = [f"{base}/{name}?size={size}&deadline={deadline}" for base in self.server.cdn_urls]
+        return urls[0], urls[1:]
+
+    def playurl(self, query):
+        config = self.server.config
+        media = config.get('media') or {}
+        prefix = f"{query.get('bvid', '')}/{query.get('cid', '0')}"
+
+        def stream(kind, stream_id, codecs, codecid, size, **extra):
+            if kind in media:
+                name, size = f'media/{kind}.m4s', os.path.getsize(media[kind])
+            else:
+                name = f'{prefix}/{stream_id}.m4s'
+            base_url, backup_urls = self.stream_urls(name, size)
+            entry = {
+                'id': stream_id, 'baseUrl': base_url, 'backupUrl': backup_urls,
+                'codecs': codecs, 'codecid': codecid,
+                'bandwidth': size * 8 // max(1, config['duration']),
+                'mimeType': f'{kind}/mp4',
+            }
+            entry.update(extra)
+            return entry
+
+        video_size, audio_size = config['video_size'], config['audio_size']
+        return {
+            'quality': 80, 'accept_quality': [80, 64], 'timelength': config['duration'] * 1000,
+            'dash': {
+                'duration': config['duration'],
+                'video': [
+                    stream('video', 80, 'avc1.640032', 7, video_size, width=1920, height=1080),
+                    stream('video', 64, 'avc1.64001F', 7, video_size // 2, width=1280, height=720),
+                ],
+                'audio': [
+                    stream('audio', 30280, 'mp4a.40.2', 0, audio_size),
+                    stream('audio', 30216, 'mp4a.40.2', 0, audio_size // 2),
+                ],
+            },
+        }
+
+
+class CDNHandler(Handler):
+    """模拟CDN：支持Range、每连接限速、延迟和错误注入"""
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def do_GET(self):
+        self.serve()
+
+    def serve(self, head=False):
+        server = self.server
+        profile = server.profile
+        name = server.name
+        server.stats.add(name, requests=1)
+
+        if profile['latency']:
+            time.sleep(profile['latency'])
+        if profile['error_rate'] and random.random() < profile['error_rate']:
+            server.stats.add(name, errors=1)
+            return self.send_json({'error': 'injected'}, status=503)
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        media = server.config.get('media') or {}
+        match = re.fullmatch(r'/media/(\w+)\.m4s', parts.path)
+        if match and match.group(1) in media:
+            with open(media[match.group(1)], 'rb') as f:
+                content = f.read()
+            size = len(content)
+        else:
+            content = None
+            size = int(query.get('size', ['0'])[0])
+
+        start, stop = 0, size
+        range_header = self.headers.get('Range')
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header or '')
+        if match and profile['range']:
+            start = int(match.group(1))
+            stop = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            if start >= size:
+                server.stats.add(name, errors=1)
+                return self.send_json({'error': 'range'}, status=416)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(stop - start))
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('ETag', f'"{size}"')
+        if profile['range']:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if head:
+            return
+
+        # 中途断开：在随机位置停止发送并关闭连接
+        drop_at = None
+        if profile['drop_rate'] and random.random() < profile['drop_rate']:
+            drop_at = start + random.randrange(max(1, stop - start))
+
+        if content is not None:
+            chunks = (content[i:min(i + WRITE_SIZE, stop)]
+                      for i in range(start, stop, WRITE_SIZE))
+        else:
+            chunks = body_slice(start, stop)
+
+        rate = profile['rate']
+        started = time.monotonic()
+        sent = 0
+        try:
+            for chunk in chunks:
+                if drop_at is not None and start + sent + len(chunk) > drop_at:
+                    self.wfile.write(chunk[:drop_at - start - sent])
+                    server.stats.add(name, drops=1, bytes=drop_at - start - sent)
+                    self.close_connection = True
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    delay = sent / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消或切换了镜像
+            self.close_connection = True
+        finally:
+            server.stats.add(name, bytes=sent)
+
+
+def start_server(handler, config, stats, name, profile=None):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = stats
+    server.name = name
+    server.profile = profile
+    server.handle_error = lambda request, address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start(config=None):
+    """
+    在当前进程中启动接口和CDN服务器
+    返回: (api_url, cdn_urls, stats)
+    """
+    merged = dict(DEFAULT_CONFIG)
+    merged.update(config or {})
+    stats = Stats()
+
+    cdn_urls = []
+    for index, profile in enumerate(merged['cdn'] or [{}]):
+        profile = dict(DEFAULT_CDN, **profile)
+        server = start_server(CDNHandler, merged, stats, f'cdn{index}', profile)
+        cdn_urls.append(f'http://127.0.0.1:{server.server_port}')
+
+    api = start_server(APIHandler, merged, stats, 'api')
+    api.cdn_urls = cdn_urls
+    return f'http://127.0.0.1:{api.server_port}', cdn_urls, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地B站接口和CDN替身")
+    parser.add_argument('--config', default='{}', help="JSON配置（见 DEFAULT_CONFIG）")
+    args = parser.parse_args()
+
+    api_url, cdn_urls, _ = start(json.loads(args.config))
+    print(json.dumps({'api': api_url, 'cdn': cdn_urls}), flush=True)
+    # 父进程退出（标准输入关闭）时结束
+    sys.stdin.read()
+
+
+if __name__ == "__main__":
+    main()
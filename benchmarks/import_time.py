@@ -0,0 +1,123 @@
+"""
+导入耗时基准
+在全新的子进程中用 python -X importtime 测量模块的冷启动导入耗时，取多次的中位数，
+超过预算，或导入时加载了不应加载的依赖（二维码、图形界面、ffmpeg后处理、HTTP库）时返回1
+
+用法:
+    python benchmarks/import_time.py                      检查默认模块
+    python benchmarks/import_time.py --repeat 10 --json
+    python benchmarks/import_time.py cli --budget 150
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# 各模块的导入耗时预算（毫秒），以及导入后不应出现在 sys.modules 中的模块
+BUDGETS = {
+    'bilibili_api': {
+        'budget_ms': 80,
+        'forbidden': ['qrcode', 'PIL', 'tkinter', 'postprocess', 'subprocess', 'requests',
+                      'urllib3', 'http.server'],
+    },
+    'cli': {
+        'budget_ms': 120,
+        'forbidden': ['qrcode', 'PIL', 'tkinter', 'requests', 'http.server'],
+    },
+}
+
+IMPORTTIME_LINE = re.compile(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)')
+
+
+def measure(module):
+    """
+    在新进程中导入模块一次
+    返回: (导入耗时毫秒, 耗时最多的依赖 [(模块, 毫秒), ...], 导入后已加载的模块集合)
+    """
+    code = f"import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT_DIR,
+                            env=env, capture_output=True, text=True, check=True)
+
+    # importtime 先输出子模块再输出父模块，顶层模块之间的第二层条目即为它直接导入的依赖
+    total = None
+    children = []
+    pending = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if depth == 1:
+            if name == module:
+                total, children = cumulative / 1000, pending
+            pending = []
+        elif depth == 3:
+            pending.append((name, cumulative / 1000))
+    if total is None:
+        # 模块已经在解释器启动时导入（不应发生）
+        total = 0.0
+    children.sort(key=lambda item: item[1], reverse=True)
+    return total, children, set(json.loads(result.stdout))
+
+
+def check(module, repeat, budget_ms=None):
+    """多次测量取中位数，并检查不应加载的依赖"""
+    config = BUDGETS.get(module, {})
+    budget_ms = budget_ms if budget_ms is not None else config.get('budget_ms')
+
+    # 第一次运行生成字节码缓存，不计入结果
+    measure(module)
+    runs = [measure(module) for _ in range(max(1, repeat))]
+    times = [total for total, _, _ in runs]
+    median = statistics.median(times)
+    _, children, modules = min(runs, key=lambda run: abs(run[0] - median))
+
+    loaded = sorted(name for name in config.get('forbidden', ())
+                    if name in modules or any(m.startswith(name + '.') for m in modules))
+    return {
+        'module': module,
+        'median_ms': round(median, 1),
+        'min_ms': round(min(times), 1),
+        'max_ms': round(max(times), 1),
+        'budget_ms': budget_ms,
+        'forbidden_loaded': loaded,
+        'slowest': [[name, round(ms, 1)] for name, ms in children[:5]],
+        'ok': not loaded and (budget_ms is None or median <= budget_ms),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模块冷启动导入耗时基准")
+    parser.add_argument('modules', nargs='*', help=f"要测量的模块（默认: {', '.join(BUDGETS)}）")
+    parser.add_argument('--repeat', type=int, default=5, help="每个模块的测量次数，取中位数（默认5）")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="导入耗时预算（毫秒），覆盖各模块的默认预算")
+    parser.add_argument('--json', action='store_true', help="输出JSON而不是表格")
+    args = parser.parse_args(argv)
+
+    results = [check(module, args.repeat, args.budget) for module in args.modules or BUDGETS]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            status = '通过' if result['ok'] else '超出预算'
+            budget = f"{result['budget_ms']:g}ms" if result['budget_ms'] is not None else '-'
+            print(f"{result['module']:<16} 中位数 {result['median_ms']:>7.1f}ms "
+                  f"({result['min_ms']:.1f}-{result['max_ms']:.1f})  预算 {budget:<8} {status}")
+            if result['forbidden_loaded']:
+                print(f"  导入时加载了不应加载的模块: {', '.join(result['forbidden_loaded'])}")
+            slowest = ', '.join(f"{name} {ms:.1f}ms" for name, ms in result['slowest'])
+            print(f"  耗时最多的依赖: {slowest}")
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
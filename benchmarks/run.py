@@ -0,0 +1,466 @@
+"""
+离线基准测试
+每个场景在单独的子进程中运行，并另起一个子进程运行本地接口和CDN替身（fake_server.py），
+只统计下载器本身的耗时、吞吐量、延迟分位数、CPU时间和峰值内存
+
+用法:
+    python benchmarks/run.py                      运行全部场景
+    python benchmarks/run.py segmented mirror     只运行指定场景
+    python benchmarks/run.py --save-baseline main 保存结果为基线
+    python benchmarks/run.py --compare main       与基线比较，有退化时返回1
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows没有resource模块，不统计峰值内存
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bilibili_api import BilibiliAPI  # noqa: E402
+from postprocess import PostProcessPool, get_ffmpeg  # noqa: E402
+
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+MB = 1024 * 1024
+
+# 比较基线时各指标的方向：True表示越大越好
+METRICS = {
+    'seconds': False,
+    'throughput_mb_s': True,
+    'requests_per_s': True,
+    'latency_p50_ms': False,
+    'latency_p95_ms': False,
+    'latency_p99_ms': False,
+    'cpu_seconds': False,
+    'peak_rss_mb': False,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+def make_api(api_url):
+    api = BilibiliAPI()
+    api.API_BASE = api_url
+    return api
+
+
+def first_byte_timer(started, latencies):
+    """进度回调：记录第一次收到数据的时间（首字节延迟）"""
+    def callback(progress, downloaded, total, desc=""):
+        if downloaded and not latencies:
+            latencies.append(time.perf_counter() - started)
+    return callback
+
+
+# ---- 场景 ----
+# 每个场景: (服务器配置函数(scale), 运行函数(api, context) -> 结果dict)，说明见运行函数的文档
+# 结果dict: bytes（下载字节数）、requests（接口请求数）、latencies（秒）、errors
+
+def config_metadata(scale):
+    return {'api_latency': 0.02}
+
+
+def run_metadata(api, context):
+    """视频信息和下载链接：逐个请求测延迟，再用 prefetch_catalogs 并发请求测吞吐"""
+    count = max(8, int(50 * context['scale']))
+    latencies = []
+    for index in range(count):
+        started = time.perf_counter()
+        video_info, error = api.get_video_info(f'BV1seq{index:06d}')
+        if error:
+            raise RuntimeError(error)
+        api.get_stream_catalog(video_info['bvid'], video_info['cid'])
+        latencies.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=api.PREFETCH_WORKERS) as executor:
+        infos = list(executor.map(api.get_video_info,
+                                  [f'BV1par{index:06d}' for index in range(count * 4)]))
+    errors = api.prefetch_catalogs([(info['bvid'], info['cid']) for info, _ in infos if info])
+    return {'requests': count * 2 + count * 8, 'latencies': latencies, 'errors': len(errors)}
+
+
+def config_throttled(scale):
+    return {'api_latency': 0.01, 'api_rate_limit': 40}
+
+
+def run_throttled(api, context):
+    """接口限速（超过每秒40次返回 -412）时的并发视频信息请求：看自动降速后的成功数和吞吐"""
+    count = max(40, int(200 * context['scale']))
+    with ThreadPoolExecutor(max_workers=api.PREFETCH_WORKERS) as executor:
+        results = list(executor.map(api.get_video_info,
+                                    [f'BV1thr{index:06d}' for index in range(count)]))
+    errors = sum(1 for _, error in results if error)
+    return {'requests': count - errors, 'errors': errors}
+
+
+def config_single(scale):
+    return {'video_size': int(128 * MB * scale)}
+
+
+def run_single(api, context):
+    """单连接下载（不限速），主要反映写入层的CPU开销"""
+    return download_stream(api, context, connections=1)
+
+
+def config_segmented(scale):
+    return {'video_size': int(32 * MB * scale), 'cdn': [{'rate': 4 * MB}]}
+
+
+def run_segmented(api, context):
+    """每连接限速4MB/s的CDN上分段并发下载"""
+    return download_stream(api, context, connections=4)
+
+
+def config_mirror(scale):
+    return {
+        'video_size': int(32 * MB * scale),
+        'cdn': [
+            {'rate': 512 * 1024, 'drop_rate': 0.2, 'latency': 0.05},
+            {'rate': 8 * MB, 'error_rate': 0.1},
+            {'rate': 16 * MB},
+        ],
+    }
+
+
+def run_mirror(api, context):
+    """主地址慢且会断开、备用地址有错误时的镜像选择和中途切换"""
+    return download_stream(api, context, connections=4)
+
+
+def download_stream(api, context, connections):
+    video_info, error = api.get_video_info('BV1dl0000001')
+    if error:
+        raise RuntimeError(error)
+    video, _, error = api.select_streams(video_info['bvid'], video_info['cid'], 80, 30280)
+    if error:
+        raise RuntimeError(error)
+
+    latencies = []
+    started = time.perf_counter()
+    path = os.path.join(context['workdir'], 'stream.m4s')
+    success, message = api.download_file(
+        video['url'], path, first_byte_timer(started, latencies), connections=connections,
+        resume=False, backup_urls=video['backup_urls']
+    )
+    if not success:
+        raise RuntimeError(message)
+    return {'bytes': os.path.getsize(path), 'requests': 2, 'latencies': latencies}
+
+
+def config_batch(scale):
+    return {
+        'api_latency': 0.02,
+        'video_size': int(8 * MB * scale),
+        'audio_size': int(1 * MB * scale),
+        'cdn': [{'rate': 8 * MB, 'latency': 0.02}, {'rate': 8 * MB}],
+    }
+
+
+def run_batch(api, context):
+    """批量任务的网络部分：多个视频同时获取信息、下载链接并下载音视频流（不做后处理）"""
+    count = max(4, int(12 * context['scale']))
+    lock = threading.Lock()
+    totals = {'bytes': 0}
+    latencies = []
+
+    def job(index):
+        started = time.perf_counter()
+        video_info, error = api.get_video_info(f'BV1bt{index:06d}')
+        if error:
+            raise RuntimeError(error)
+        video, audio, error = api.select_streams(video_info['bvid'], video_info['cid'], 80, 30280)
+        if error:
+            raise RuntimeError(error)
+        streams = [
+            {'url': stream['url'], 'backup_urls': stream['backup_urls'],
+             'path': os.path.join(context['workdir'], f'{index}_{stream["kind"]}.m4s'),
+             'stream_info': {'bvid': video_info['bvid'], 'qn': stream['id']}}
+            for stream in (video, audio)
+        ]
+        success, message = api.download_streams(streams)
+        if not success:
+            raise RuntimeError(message)
+        size = sum(os.path.getsize(stream['path']) for stream in streams)
+        for stream in streams:
+            os.remove(stream['path'])
+        with lock:
+            totals['bytes'] += size
+            latencies.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(job, range(count)))
+    return {'bytes': totals['bytes'], 'requests': count * 2, 'latencies': latencies}
+
+
+def config_pipeline(scale):
+    return {'duration': 10}
+
+
+def run_pipeline(api, context):
+    """完整的 download_video 流程（下载、合并、转码），需要ffmpeg"""
+    count = max(2, int(4 * context['scale']))
+    pool = PostProcessPool()
+    api.postprocess_pool = pool
+    slot = threading.BoundedSemaphore(2)
+    latencies = []
+    sizes = []
+
+    def job(index):
+        started = time.perf_counter()
+        video_info, error = api.get_video_info(f'BV1pl{index:06d}')
+        if error:
+            raise RuntimeError(error)
+        path = os.path.join(context['workdir'], f'{index}.mp4')
+        success, message = api.download_video(
+            video_info['bvid'], video_info['cid'], path, 'merged', 'mp4', 80, 30280,
+            download_slot=slot
+        )
+        if not success:
+            raise RuntimeError(message)
+        latencies.append(time.perf_counter() - started)
+        sizes.append(os.path.getsize(path))
+
+    try:
+        with ThreadPoolExecutor(max_workers=2 + pool.workers) as executor:
+            list(executor.map(job, range(count)))
+    finally:
+        pool.shutdown()
+    return {'bytes': sum(sizes), 'requests': count * 2, 'latencies': latencies}
+
+
+def make_media(workdir, duration):
+    """用ffmpeg生成测试用的音视频文件（fMP4，与B站DASH流相同的封装）"""
+    ffmpeg = get_ffmpeg()
+    media = {
+        'video': os.path.join(workdir, 'media_video.m4s'),
+        'audio': os.path.join(workdir, 'media_audio.m4s'),
+    }
+    common = ['-hide_banner', '-loglevel', 'error', '-y']
+    fragmented = ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4']
+    subprocess.run(
+        [ffmpeg.path] + common + ['-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={duration}',
+                                  '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+        + fragmented + [media['video']], check=True
+    )
+    subprocess.run(
+        [ffmpeg.path] + common + ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                                  '-c:a', 'aac']
+        + fragmented + [media['audio']], check=True
+    )
+    return media
+
+
+SCENARIOS = {
+    'metadata': (config_metadata, run_metadata),
+    'single': (config_single, run_single),
+    'segmented': (config_segmented, run_segmented),
+    'mirror': (config_mirror, run_mirror),
+    'batch': (config_batch, run_batch),
+    'pipeline': (config_pipeline, run_pipeline),
+    'throttled': (config_throttled, run_throttled),
+}
+
+
+# ---- 运行 ----
+
+def cpu_seconds():
+    """本进程和已结束子进程（ffmpeg）的CPU时间"""
+    if resource is None:
+        return time.process_time()
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS上单位为字节，Linux上为KB
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def start_fake_server(config):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'fake_server.py'), '--config', json.dumps(config)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    addresses = json.loads(process.stdout.readline())
+    return process, addresses
+
+
+def run_worker(name, scale):
+    """在子进程中运行一个场景，返回结果dict"""
+    config_func, run_func = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix=f'bili_bench_{name}_')
+    process = None
+    try:
+        config = config_func(scale)
+        if name == 'pipeline':
+            if not get_ffmpeg():
+                return {'scenario': name, 'skipped': "未找到ffmpeg"}
+            config['media'] = make_media(workdir, config['duration'])
+
+        process, addresses = start_fake_server(config)
+        api = make_api(addresses['api'])
+        context = {'scale': scale, 'workdir': workdir, 'cdn': addresses['cdn']}
+
+        cpu_started = cpu_seconds()
+        started = time.perf_counter()
+        result = run_func(api, context)
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu_started
+
+        latencies = [value * 1000 for value in result.get('latencies', [])]
+        record = {
+            'scenario': name,
+            'seconds': elapsed,
+            'bytes': result.get('bytes', 0),
+            'throughput_mb_s': result['bytes'] / MB / elapsed if result.get('bytes') else None,
+            'requests_per_s': result['requests'] / elapsed if result.get('requests') else None,
+            'latency_p50_ms': percentile(latencies, 0.5),
+            'latency_p95_ms': percentile(latencies, 0.95),
+            'latency_p99_ms': percentile(latencies, 0.99),
+            'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'errors': result.get('errors', 0),
+            'mirrors': api.mirrors.stats(),
+            'pools': api.transport.stats(),
+            'scheduler': api.scheduler.stats(),
+        }
+        return record
+    finally:
+        if process is not None:
+            process.stdin.close()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_scenario(name, scale, repeat):
+    """运行 repeat 次，取耗时居中的一次"""
+    records = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', name, '--scale', str(scale)],
+            stdout=subprocess.PIPE, universal_newlines=True
+        )
+        if output.returncode != 0:
+            return {'scenario': name, 'error': f"场景运行失败（退出码 {output.returncode}）"}
+        record = json.loads(output.stdout.strip().splitlines()[-1])
+        if 'seconds' not in record:
+            return record
+        records.append(record)
+    records.sort(key=lambda record: record['seconds'])
+    return records[len(records) // 2]
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.3f}' if value < 100 else f'{value:.1f}'
+    return str(value)
+
+
+def print_results(results, baseline=None, threshold=0.1):
+    """打印结果表；有基线时附上变化比例，返回退化的指标列表"""
+    regressions = []
+    for record in results:
+        name = record['scenario']
+        if 'seconds' not in record:
+            print(f"{name}: {record.get('skipped') or record.get('error')}")
+            continue
+        print(f"{name}:")
+        base = (baseline or {}).get(name) or {}
+        for metric, higher_is_better in METRICS.items():
+            value = record.get(metric)
+            if value is None:
+                continue
+            line = f"  {metric:<18} {format_value(value):>10}"
+            previous = base.get(metric)
+            if previous:
+                change = (value - previous) / previous
+                worse = -change if higher_is_better else change
+                line += f"  ({change:+.1%} 对比基线 {format_value(previous)})"
+                if worse > threshold:
+                    line += "  <-- 退化"
+                    regressions.append((name, metric, previous, value))
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="下载器离线基准测试")
+    parser.add_argument('scenarios', nargs='*', help=f"要运行的场景（默认全部）: {', '.join(SCENARIOS)}")
+    parser.add_argument('--scale', type=float, default=1.0, help="数据量和任务数的倍数（默认1）")
+    parser.add_argument('--repeat', type=int, default=1, help="每个场景的运行次数，取居中的一次")
+    parser.add_argument('--save-baseline', metavar='NAME', help="把结果保存为基线")
+    parser.add_argument('--compare', metavar='NAME', help="与基线比较")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="判定为退化的变化比例（默认0.1，即10%%）")
+    parser.add_argument('--json', action='store_true', help="输出JSON而不是表格")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.json and args.compare:
+        parser.error("--json 不能与 --compare 同时使用")
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.scale)))
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json'), 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    results = [run_scenario(name, args.scale, max(1, args.repeat)) for name in names]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        regressions = []
+    else:
+        regressions = print_results(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'time': time.time(), 'scale': args.scale,
+                       'results': {record['scenario']: record for record in results}},
+                      f, ensure_ascii=False, indent=2)
+        print(f"基线已保存: {path}")
+
+    if regressions:
+        print(f"{len(regressions)} 项指标退化超过 {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
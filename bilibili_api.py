@@ -2,18 +2,35 @@
 Bilibili API客户端
 支持二维码登录、音视频分离下载、多清晰度、Hi-Res音频
 支持登录状态持久化
+
+导入本模块时不加载只在部分功能中用到的依赖：二维码（qrcode、PIL）在生成登录二维码时导入，
+ffmpeg后处理（postprocess、subprocess）在第一次后处理时导入，HTTP库（requests）在创建客户端时导入；
+导入耗时的预算见 benchmarks/import_time.py
 """
-import requests
+import re
 import time
 import json
-import qrcode
 import os
-import subprocess
-from io import BytesIO
-from PIL import Image
+import threading
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from bandwidth import get_limiter
+from filewriter import FileWriter, ResponseReader, FSYNC_CLOSE
+from listing import iter_pages
+from metrics import get_registry, THROUGHPUT_BUCKETS
+from mirrors import MirrorHealth
+from ratelimit import RequestScheduler, parse_retry_after
 
 
 class BilibiliAPI:
+    # 接口地址
+    API_BASE = 'https://api.bilibili.com'
+    PASSPORT_BASE = 'https://passport.bilibili.com'
+
     # 清晰度映射
     QUALITY_MAP = {
         127: "8K超高清",
@@ -37,24 +54,109 @@ class BilibiliAPI:
         30210: "64K流畅"
     }
 
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
+    # 二维码登录轮询状态码
+    QR_STATUS = {
+        86101: ('waiting', '等待扫码...'),
+        86090: ('scanned', '已扫码，请在手机上确认'),
+        86038: ('expired', '二维码已失效')
+    }
+
+    # 分段下载默认参数
+    DOWNLOAD_CONNECTIONS = 4
+    # 多P视频同时下载的分P数，以及并发解析下载链接的线程数
+    PAGE_PARALLEL = 3
+    PREFETCH_WORKERS = 8
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+    SEGMENT_RETRIES = 3
+    # 每次从响应中读取的字节数（流式处理使用；下载文件时由 ResponseReader 自适应调整）
+    CHUNK_SIZE = 64 * 1024
+    # CDN镜像选择：探测请求的大小、传输中测速的间隔，以及判定为过慢的条件
+    MIRROR_PROBE_BYTES = 256 * 1024
+    MIRROR_CHECK_INTERVAL = 2.0
+    MIRROR_SLOW_RATIO = 0.25       # 低于其他镜像实测速度的该比例时切换
+    MIRROR_MIN_SPEED = 64 * 1024   # 低于该速度（字节/秒）时切换
+    MANIFEST_FLUSH_BYTES = 1024 * 1024
+    # 列表枚举：每页条目数（收藏夹接口最多20）和同时请求的页数
+    LIST_PAGE_SIZE = {'season': 100, 'favorites': 20, 'space': 50}
+    LIST_WORKERS = 4
+
+    # WBI签名：混淆表和密钥的缓存时间（秒）
+    WBI_MIXIN_TABLE = [
+        46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+        33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40,
+        61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
+        36, 20, 34, 44, 52
+    ]
+    WBI_KEY_TTL = 3600
+
+    # 连接池大小：接口请求的并发数，以及每个CDN主机的连接数
+    # （同时下载的任务数 × 每个任务的音视频流数 × 每个流的分段连接数）
+    API_POOL_SIZE = 16
+    CDN_POOL_SIZE = 64
+
+    # 自动登录：后台检查（IP和cookies）的超时（秒），以及验证通过后多长时间内不再验证
+    LOGIN_CHECK_TIMEOUT = 3
+    LOGIN_VALIDATE_INTERVAL = 6 * 3600
+    # IP检测服务（第三方，请求时不带cookies），同时请求，取最先返回的结果
+    IP_SERVICES = (
+        'https://api.ipify.org?format=json',
+        'https://api64.ipify.org?format=json',
+        'https://ifconfig.me/ip'
+    )
+
+    def __init__(self, cache_dir=None):
+        """cache_dir: 接口元数据的磁盘缓存目录，为None时只缓存在内存中"""
+        from transport import Transport
+
+        # 接口和CDN分开的连接池，所有线程共享；session 为接口连接池（登录状态的cookies保存在其中）
+        self.transport = Transport({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Referer': 'https://www.bilibili.com'
-        })
+        }, self.API_POOL_SIZE, self.CDN_POOL_SIZE)
+        self.session = self.transport.api
+        # 接口请求调度：被风控时自动降速并重试（见 ratelimit.RequestScheduler）
+        self.scheduler = RequestScheduler()
         self.cookies = {}
         self.is_logged_in = False
 
+        # 分段下载设置（可在外部修改）
+        self.download_connections = self.DOWNLOAD_CONNECTIONS
+        self.min_segment_size = self.MIN_SEGMENT_SIZE
+        # 下载文件的fsync策略（见 filewriter.FSYNC_POLICIES）
+        self.fsync_policy = FSYNC_CLOSE
+        # 限速器（进程内所有下载共用，见 bandwidth.BandwidthLimiter）
+        self.bandwidth = get_limiter()
+
+        # CDN主机健康度，所有下载任务共享
+        self.mirrors = MirrorHealth()
+        self.mirror_min_speed = self.MIRROR_MIN_SPEED
+
+        # ffmpeg路径，为None时自动查找（见 postprocess.find_ffmpeg）
+        self.ffmpeg_path = None
+
+        # 后处理工作池（postprocess.PostProcessPool），为None时在下载线程中直接处理
+        self.postprocess_pool = None
+
+        # 运行指标（见 DownloadMetrics），注册在进程内共用的 metrics 注册表中
+        self.metrics = DownloadMetrics()
+
+        # 视频信息和playurl缓存
+        self.cache = MetadataCache(cache_dir=cache_dir, metrics=self.metrics)
+        # WBI签名密钥 (过期时间, mixin_key)
+        self._wbi_key = None
+
         # 登录状态保存文件
         self.login_data_file = os.path.join(os.path.dirname(__file__), '.bili_login.json')
+        # 距上次验证不超过该秒数时，自动登录不再验证cookies（0表示每次都验证）
+        self.login_validate_interval = self.LOGIN_VALIDATE_INTERVAL
+        # 后台登录检查的结果（Future，结果为 (valid, message)），没有进行检查时为None
+        self.login_check = None
 
     def generate_qr_code(self):
         """生成登录二维码"""
         try:
-            url = 'https://passport.bilibili.com/x/passport-login/web/qrcode/generate'
-            response = self.session.get(url)
-            data = response.json()
+            url = f'{self.PASSPORT_BASE}/x/passport-login/web/qrcode/generate'
+            data = self._api_get('qrcode_generate', url, None, login=True, timeout=10)
 
             if data['code'] != 0:
                 return None, None, "获取二维码失败"
@@ -62,29 +164,36 @@ class BilibiliAPI:
             qr_url = data['data']['url']
             qrcode_key = data['data']['qrcode_key']
 
-            qr = qrcode.QRCode(version=1, box_size=10, border=2)
-            qr.add_data(qr_url)
-            qr.make(fit=True)
+            return self.make_qr_image(qr_url), qrcode_key, None
 
-            img = qr.make_image(fill_color="black", back_color="white")
+        except Exception as e:
+            return None, None, f"生成二维码出错: {str(e)}"
 
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            buffered.seek(0)
-            pil_img = Image.open(buffered)
+    @staticmethod
+    def make_qr_image(qr_url):
+        """把登录链接渲染为二维码图片（PIL.Image）"""
+        from io import BytesIO
 
-            return pil_img, qrcode_key, None
+        import qrcode
+        from PIL import Image
 
-        except Exception as e:
-            return None, None, f"生成二维码出错: {str(e)}"
+        qr = qrcode.QRCode(version=1, box_size=10, border=2)
+        qr.add_data(qr_url)
+        qr.make(fit=True)
+
+        img = qr.make_image(fill_color="black", back_color="white")
+
+        buffered = BytesIO()
+        img.save(buffered, format="PNG")
+        buffered.seek(0)
+        return Image.open(buffered)
 
     def check_qr_status(self, qrcode_key):
         """检查二维码扫描状态"""
         try:
-            url = 'https://passport.bilibili.com/x/passport-login/web/qrcode/poll'
+            url = f'{self.PASSPORT_BASE}/x/passport-login/web/qrcode/poll'
             params = {'qrcode_key': qrcode_key}
-            response = self.session.get(url, params=params)
-            data = response.json()
+            data = self._api_get('qrcode_poll', url, params, login=True, timeout=10)
 
             code = data['data']['code']
 
@@ -99,65 +208,78 @@ class BilibiliAPI:
                 else:
                     return 'error', '登录失败: 未获取到有效凭证'
 
-            elif code == 86101:
-                return 'waiting', '等待扫码...'
-            elif code == 86090:
-                return 'scanned', '已扫码，请在手机上确认'
-            elif code == 86038:
-                return 'expired', '二维码已失效'
+            elif code in self.QR_STATUS:
+                return self.QR_STATUS[code]
             else:
                 return 'error', f'未知状态码: {code}'
 
         except Exception as e:
             return 'error', f'检查状态出错: {str(e)}'
 
-    def get_current_ip(self):
-        """获取当前公网IP地址"""
+    def get_current_ip(self, timeout=None):
+        """
+        获取当前公网IP地址
+        同时请求多个IP检测服务，取最先返回的结果；timeout 秒内都没有结果时返回None
+        """
+        timeout = timeout or self.LOGIN_CHECK_TIMEOUT
+        services = self.IP_SERVICES
+
+        def query(service):
+            # 第三方服务：用不带cookie的独立请求，不能经过保存了登录cookies的接口连接池
+            import requests
+
+            response = requests.get(service, timeout=timeout,
+                                    headers={'User-Agent': self.session.headers['User-Agent']})
+            if response.status_code != 200:
+                return None
+            if 'json' in service:
+                return response.json().get('ip', '')
+            return response.text.strip()
+
+        executor = ThreadPoolExecutor(max_workers=len(services))
         try:
-            # 使用多个IP检测服务作为备选
-            services = [
-                'https://api.ipify.org?format=json',
-                'https://api64.ipify.org?format=json',
-                'https://ifconfig.me/ip'
-            ]
-
-            for service in services:
+            futures = [executor.submit(query, service) for service in services]
+            for future in as_completed(futures, timeout=timeout):
                 try:
-                    response = requests.get(service, timeout=5)
-                    if response.status_code == 200:
-                        if 'json' in service:
-                            return response.json().get('ip', '')
-                        else:
-                            return response.text.strip()
-                except:
+                    ip = future.result()
+                except Exception:
                     continue
+                if ip:
+                    return ip
+        except FutureTimeoutError:
+            pass
+        finally:
+            # 不等待还没返回的检测服务
+            executor.shutdown(wait=False)
+        return None
 
-            return None
-        except Exception as e:
-            return None
+    def _write_login_data(self, login_data):
+        with open(self.login_data_file, 'w', encoding='utf-8') as f:
+            json.dump(login_data, f, ensure_ascii=False, indent=2)
 
     def save_login_state(self):
         """保存登录状态（cookies和IP）"""
         try:
             current_ip = self.get_current_ip()
 
-            login_data = {
+            now = time.time()
+            self._write_login_data({
                 'cookies': self.cookies,
                 'ip': current_ip,
-                'timestamp': time.time()
-            }
-
-            with open(self.login_data_file, 'w', encoding='utf-8') as f:
-                json.dump(login_data, f, ensure_ascii=False, indent=2)
-
+                'timestamp': now,
+                'validated': now
+            })
             return True
         except Exception as e:
             print(f"保存登录状态失败: {e}")
             return False
 
-    def load_login_state(self):
+    def load_login_state(self, on_checked=None):
         """
         加载保存的登录状态
+        立即使用保存的cookies，不等待网络；距上次验证超过 login_validate_interval 时，
+        在后台同时检查IP是否变化和cookies是否有效（见 login_check），
+        检查完成后调用 on_checked(valid, message)（在后台线程中调用），无效时清除登录状态
         返回: (success, message)
         """
         try:
@@ -170,7 +292,6 @@ class BilibiliAPI:
                 login_data = json.load(f)
 
             saved_cookies = login_data.get('cookies', {})
-            saved_ip = login_data.get('ip')
             saved_time = login_data.get('timestamp', 0)
 
             # 检查是否有有效的cookies
@@ -182,40 +303,89 @@ class BilibiliAPI:
                 self.clear_login_state()
                 return False, "登录已过期（超过30天）"
 
-            # 检查IP是否变化
-            current_ip = self.get_current_ip()
-            if current_ip and saved_ip and current_ip != saved_ip:
-                self.clear_login_state()
-                return False, f"IP地址已变化（{saved_ip} → {current_ip}），请重新登录"
-
-            # 验证cookies是否有效
             self.cookies = saved_cookies
             self.session.cookies.update(saved_cookies)
+            self.is_logged_in = True
 
-            if self.validate_cookies():
-                self.is_logged_in = True
+            # 最近验证过时直接使用
+            if time.time() - login_data.get('validated', 0) < self.login_validate_interval:
+                self.login_check = None
                 return True, "自动登录成功"
-            else:
-                self.clear_login_state()
-                return False, "登录凭证已失效"
+
+            self.login_check = Future()
+            threading.Thread(target=self._check_login, args=(login_data, on_checked),
+                             daemon=True).start()
+            return True, "自动登录成功（正在后台验证）"
 
         except Exception as e:
             return False, f"加载登录状态失败: {str(e)}"
 
-    def validate_cookies(self):
-        """验证cookies是否有效"""
+    def _check_login(self, login_data, on_checked=None):
+        """后台登录检查：IP检测和cookies验证同时进行，各自有超时"""
+        saved_cookies = login_data['cookies']
+        saved_ip = login_data.get('ip')
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                ip_future = executor.submit(self.get_current_ip)
+                valid_future = executor.submit(self._check_cookies, saved_cookies,
+                                               self.LOGIN_CHECK_TIMEOUT)
+                current_ip = ip_future.result()
+                valid = valid_future.result()
+
+            if self.cookies != saved_cookies:
+                # 检查期间已重新登录或退出登录
+                valid, message = self.is_logged_in, "登录状态已变更"
+            elif current_ip and saved_ip and current_ip != saved_ip:
+                self.clear_login_state()
+                valid, message = False, f"IP地址已变化（{saved_ip} → {current_ip}），请重新登录"
+            elif valid is False:
+                self.clear_login_state()
+                message = "登录凭证已失效"
+            elif valid is None:
+                # 网络问题无法确认，继续使用保存的登录状态，下次启动时再验证
+                valid, message = True, "无法验证登录状态（网络错误），继续使用保存的登录"
+            else:
+                login_data['validated'] = time.time()
+                login_data['ip'] = current_ip or saved_ip
+                self._write_login_data(login_data)
+                message = "登录状态验证通过"
+        except Exception as e:
+            valid, message = self.is_logged_in, f"验证登录状态出错: {str(e)}"
+
+        self.login_check.set_result((valid, message))
+        if on_checked:
+            on_checked(valid, message)
+
+    def wait_login_check(self, timeout=None):
+        """
+        等待后台登录检查完成
+        返回: (valid, message)；没有进行检查时返回 (is_logged_in, "")，超时返回None
+        """
+        check = self.login_check
+        if check is None:
+            return self.is_logged_in, ""
+        try:
+            return check.result(timeout)
+        except FutureTimeoutError:
+            return None
+
+    def _check_cookies(self, cookies, timeout=None):
+        """
+        向 nav 接口确认cookies是否有效
+        返回: True有效，False无效，None为网络错误无法确认
+        """
         try:
             # 调用B站API验证登录状态
-            url = 'https://api.bilibili.com/x/web-interface/nav'
-            response = self.session.get(url, cookies=self.cookies)
-            data = response.json()
+            url = f'{self.API_BASE}/x/web-interface/nav'
+            data = self.transport.api_get(url, cookies=cookies, timeout=timeout).json()
+        except Exception:
+            return None
+        # code为0且isLogin为True表示登录有效
+        return bool(data.get('code') == 0 and (data.get('data') or {}).get('isLogin'))
 
-            # code为0且isLogin为True表示登录有效
-            if data.get('code') == 0 and data.get('data', {}).get('isLogin'):
-                return True
-            return False
-        except:
-            return False
+    def validate_cookies(self, timeout=None):
+        """验证cookies是否有效"""
+        return self._check_cookies(self.cookies, timeout or self.LOGIN_CHECK_TIMEOUT) is True
 
     def clear_login_state(self):
         """清除保存的登录状态"""
@@ -227,22 +397,124 @@ class BilibiliAPI:
         except:
             pass
 
+    def _cached_get(self, endpoint, url, params):
+        """
+        经过元数据缓存的接口GET请求，返回完整JSON
+        只缓存code为0的响应；同一请求并发时只发出一次
+        """
+        key = self.cache.make_key(endpoint, params, self.cookies.get('DedeUserID', ''))
+        return self.cache.get_or_fetch(endpoint, key,
+                                       lambda: self._api_get(endpoint, url, params))
+
+    def _api_get(self, endpoint, url, params, login=False, **kwargs):
+        """
+        接口GET请求，返回完整JSON，并记录耗时、HTTP状态码和接口返回的code
+        经过请求调度器：被风控、HTTP 429/5xx 或网络错误时降速并重试
+        login: 登录流程的请求，通过 self.session 发出，登录成功时响应设置的cookies保存在其中
+        """
+        def send():
+            if login:
+                response = self.session.get(url, params=params, **kwargs)
+            else:
+                response = self.transport.api_get(url, params=params, cookies=self.cookies,
+                                                  **kwargs)
+            self.metrics.http_responses.inc(kind='api', status=response.status_code)
+            try:
+                data = response.json()
+            except ValueError:
+                # 风控和网关错误常常返回HTML页面
+                data = None
+            return response.status_code, data, parse_retry_after(response.headers.get('Retry-After'))
+
+        def on_retry(reason, delay):
+            self.metrics.api_retries.inc(endpoint=endpoint, reason=reason)
+
+        started = time.monotonic()
+        code = 'error'
+        try:
+            data = self.scheduler.run(send, on_retry)
+            code = data.get('code')
+            return data
+        finally:
+            self.metrics.api_requests.inc(endpoint=endpoint, code=code)
+            self.metrics.api_seconds.observe(time.monotonic() - started, endpoint=endpoint)
+            self.metrics.api_rate_limit.set(self.scheduler.rate or 0)
+
+    @staticmethod
+    def parse_video_params(url):
+        """从视频URL或BV/av号中解析查询参数，无法识别时返回None"""
+        if 'BV' in url:
+            bvid = url.split('BV')[1].split('/')[0].split('?')[0]
+            return {'bvid': 'BV' + bvid}
+        elif 'av' in url:
+            aid = url.split('av')[1].split('/')[0].split('?')[0]
+            return {'aid': aid}
+        return None
+
+    @staticmethod
+    def parse_page_number(url):
+        """从视频URL的 ?p= 参数中解析分P页码，没有时返回None"""
+        values = parse_qs(urlsplit(url).query).get('p')
+        if values and values[0].isdigit():
+            return int(values[0])
+        return None
+
+    @staticmethod
+    def parse_page_spec(spec, page_count):
+        """
+        解析分P选择，如 'all'、'3'、'1-5,8'、'10-'
+        返回: 页码列表（从1开始，去重并保持顺序），格式错误或超出范围时抛出ValueError
+        """
+        spec = str(spec).strip().lower()
+        if spec in ('', 'all', '全部'):
+            return list(range(1, page_count + 1))
+
+        pages = []
+        for part in spec.replace('，', ',').split(','):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                if '-' in part:
+                    start, _, end = part.partition('-')
+                    start = int(start) if start.strip() else 1
+                    end = int(end) if end.strip() else page_count
+                else:
+                    start = end = int(part)
+            except ValueError:
+                raise ValueError(f"无法识别的分P: {part}")
+            if start < 1 or end > page_count or start > end:
+                raise ValueError(f"分P范围无效: {part}（共{page_count}P）")
+            pages.extend(range(start, end + 1))
+        return list(dict.fromkeys(pages))
+
+    def get_pages(self, video_info, spec=None):
+        """
+        选出要下载的分P
+        spec: 分P选择（见 parse_page_spec），为None时只选第一P
+        返回: ([{'page': 1, 'cid': ..., 'part': ..., 'duration': ...}, ...], error)
+        """
+        pages = video_info.get('pages') or [
+            {'page': 1, 'cid': video_info['cid'], 'part': video_info.get('title', '')}
+        ]
+        if spec is None:
+            return pages[:1], None
+        try:
+            numbers = self.parse_page_spec(spec, len(pages))
+        except ValueError as e:
+            return [], str(e)
+        by_number = {page['page']: page for page in pages}
+        return [by_number.get(n, pages[n - 1]) for n in numbers], None
+
     def get_video_info(self, url):
         """获取视频信息"""
         try:
-            if 'BV' in url:
-                bvid = url.split('BV')[1].split('/')[0].split('?')[0]
-                bvid = 'BV' + bvid
-                params = {'bvid': bvid}
-            elif 'av' in url:
-                aid = url.split('av')[1].split('/')[0].split('?')[0]
-                params = {'aid': aid}
-            else:
+            params = self.parse_video_params(url)
+            if not params:
                 return None, "无效的视频URL"
 
-            info_url = 'https://api.bilibili.com/x/web-interface/view'
-            response = self.session.get(info_url, params=params, cookies=self.cookies)
-            data = response.json()
+            info_url = f'{self.API_BASE}/x/web-interface/view'
+            data = self._cached_get('view', info_url, params)
 
             if data['code'] != 0:
                 return None, f"获取视频信息失败: {data.get('message', '未知错误')}"
@@ -253,227 +525,1202 @@ class BilibiliAPI:
         except Exception as e:
             return None, f"获取视频信息出错: {str(e)}"
 
-    def get_available_qualities(self, bvid, cid):
-        """获取视频可用的清晰度列表"""
-        try:
-            url = 'https://api.bilibili.com/x/player/playurl'
-            params = {
-                'bvid': bvid,
-                'cid': cid,
-                'qn': 127,  # 请求最高清晰度以获取完整列表
-                'fnval': 4048,  # 支持音视频分离和多种格式
-                'fourk': 1
-            }
+    @staticmethod
+    def parse_list_url(url):
+        """
+        识别合集、收藏夹和UP主空间的地址
+        返回: ('season', {'mid', 'season_id'})、('favorites', {'media_id', 'mid'})
+              或 ('space', {'mid'})，不是列表地址时返回None
+        """
+        parts = urlsplit(url if '://' in url else 'https://' + url)
+        query = parse_qs(parts.query)
 
-            response = self.session.get(url, params=params, cookies=self.cookies)
-            data = response.json()
+        match = re.search(r'/(?:medialist/detail|list)/ml(\d+)', parts.path)
+        if match:
+            return 'favorites', {'media_id': match.group(1), 'mid': None}
+
+        path = [p for p in parts.path.split('/') if p]
+        if parts.netloc.lower() != 'space.bilibili.com' or not path or not path[0].isdigit():
+            return None
+        mid = path[0]
+        section = path[1] if len(path) > 1 else ''
+
+        if section == 'channel' and path[2:3] == ['collectiondetail'] and query.get('sid'):
+            return 'season', {'mid': mid, 'season_id': query['sid'][0]}
+        if section == 'lists' and len(path) > 2 and query.get('type', ['season'])[0] == 'season':
+            return 'season', {'mid': mid, 'season_id': path[2]}
+        if section == 'favlist':
+            # 没有fid时为默认收藏夹
+            return 'favorites', {'media_id': (query.get('fid') or [None])[0], 'mid': mid}
+        if section in ('', 'video', 'upload'):
+            return 'space', {'mid': mid}
+        return None
+
+    def wbi_sign(self, params):
+        """给请求参数加上WBI签名（wts和w_rid），UP主投稿列表等接口需要"""
+        now = int(time.time())
+        if not self._wbi_key or now >= self._wbi_key[0]:
+            data = self._api_get('nav', f'{self.API_BASE}/x/web-interface/nav', None, timeout=10)
+            wbi = (data.get('data') or {}).get('wbi_img') or {}
+            raw = ''.join(
+                os.path.splitext(wbi.get(key, '').rsplit('/', 1)[-1])[0]
+                for key in ('img_url', 'sub_url')
+            )
+            if not raw:
+                raise RuntimeError("获取WBI签名密钥失败")
+            mixin_key = ''.join(raw[i] for i in self.WBI_MIXIN_TABLE if i < len(raw))[:32]
+            self._wbi_key = (now + self.WBI_KEY_TTL, mixin_key)
+
+        params = dict(params, wts=now)
+        # 签名前按键排序，并去掉值中的 !'()* 字符
+        params = {k: ''.join(c for c in str(params[k]) if c not in "!'()*")
+                  for k in sorted(params)}
+        query = urlencode(params)
+        params['w_rid'] = hashlib.md5((query + self._wbi_key[1]).encode()).hexdigest()
+        return params
+
+    def _get_list_page(self, endpoint, url, params, sign=False):
+        """请求列表接口的一页，失败时抛出RuntimeError"""
+        if sign:
+            params = self.wbi_sign(params)
+        data = self._api_get(endpoint, url, params, timeout=10)
+        if data['code'] != 0:
+            raise RuntimeError(f"获取列表失败: {data.get('message', '未知错误')}")
+        return data.get('data') or {}
+
+    @staticmethod
+    def _list_item(entry):
+        return {
+            'bvid': entry.get('bvid') or entry.get('bv_id'),
+            'aid': entry['aid'] if 'aid' in entry else entry.get('id'),
+            'title': entry.get('title', ''),
+        }
+
+    def iter_season(self, mid, season_id, workers=None):
+        """逐条产出合集（ugc_season）中的视频: {'bvid', 'aid', 'title'}"""
+        url = f'{self.API_BASE}/x/polymer/web-space/seasons_archives_list'
+        page_size = self.LIST_PAGE_SIZE['season']
+
+        def fetch_page(pn):
+            data = self._get_list_page('season', url, {
+                'mid': mid, 'season_id': season_id, 'page_num': pn, 'page_size': page_size,
+            })
+            items = [self._list_item(entry) for entry in data.get('archives') or []]
+            return items, (data.get('page') or {}).get('total')
+
+        return iter_pages(fetch_page, page_size, workers or self.LIST_WORKERS)
+
+    def iter_favorites(self, media_id, mid=None, workers=None):
+        """
+        逐条产出收藏夹中的视频（跳过音频等其他类型）
+        media_id为None时使用 mid 用户的默认收藏夹
+        """
+        if media_id is None:
+            data = self._get_list_page('fav_folders',
+                                       f'{self.API_BASE}/x/v3/fav/folder/created/list-all',
+                                       {'up_mid': mid})
+            folders = data.get('list') or []
+            if not folders:
+                raise RuntimeError("该用户没有公开的收藏夹")
+            media_id = folders[0]['id']
+
+        url = f'{self.API_BASE}/x/v3/fav/resource/list'
+        page_size = self.LIST_PAGE_SIZE['favorites']
+
+        def fetch_page(pn):
+            data = self._get_list_page('favorites', url, {
+                'media_id': media_id, 'pn': pn, 'ps': page_size, 'platform': 'web',
+            })
+            # type为2的是视频
+            items = [self._list_item(entry) for entry in data.get('medias') or []
+                     if entry.get('type', 2) == 2]
+            return items, (data.get('info') or {}).get('media_count')
+
+        yield from iter_pages(fetch_page, page_size, workers or self.LIST_WORKERS)
+
+    def iter_space(self, mid, workers=None):
+        """逐条产出UP主的全部投稿（按发布时间从新到旧）"""
+        url = f'{self.API_BASE}/x/space/wbi/arc/search'
+        page_size = self.LIST_PAGE_SIZE['space']
+
+        def fetch_page(pn):
+            data = self._get_list_page('space', url, {
+                'mid': mid, 'pn': pn, 'ps': page_size, 'order': 'pubdate',
+            }, sign=True)
+            items = [self._list_item(entry)
+                     for entry in ((data.get('list') or {}).get('vlist') or [])]
+            return items, (data.get('page') or {}).get('count')
+
+        return iter_pages(fetch_page, page_size, workers or self.LIST_WORKERS)
+
+    def iter_list(self, url, workers=None):
+        """
+        逐条产出合集、收藏夹或UP主空间地址中的视频（惰性生成器，按需请求后续页）
+        请求失败时在迭代中抛出RuntimeError，不是列表地址时抛出ValueError
+        """
+        parsed = self.parse_list_url(url)
+        if not parsed:
+            raise ValueError(f"不是合集、收藏夹或UP主空间的地址: {url}")
+        kind, params = parsed
+        if kind == 'season':
+            return self.iter_season(params['mid'], params['season_id'], workers)
+        if kind == 'favorites':
+            return self.iter_favorites(params['media_id'], params['mid'], workers)
+        return self.iter_space(params['mid'], workers)
+
+    @staticmethod
+    def playurl_params(bvid, cid, qn=127):
+        """playurl接口的请求参数"""
+        return {
+            'bvid': bvid,
+            'cid': cid,
+            'qn': qn,
+            'fnval': 4048,  # 支持音视频分离和多种格式
+            'fourk': 1
+        }
+
+    def get_stream_catalog(self, bvid, cid, qn=127):
+        """
+        获取视频的流目录（一次playurl请求，结果经过缓存）
+        返回: (StreamCatalog, error)
+        """
+        try:
+            url = f'{self.API_BASE}/x/player/playurl'
+            data = self._cached_get('playurl', url, self.playurl_params(bvid, cid, qn))
 
             if data['code'] != 0:
-                return [], [], f"获取清晰度列表失败: {data.get('message', '未知错误')}"
-
-            result = data['data']
-
-            # 获取视频清晰度列表
-            video_qualities = []
-            if 'dash' in result:
-                dash_data = result['dash']
-
-                # 视频流
-                if 'video' in dash_data:
-                    for video in dash_data['video']:
-                        qn = video['id']
-                        if qn in self.QUALITY_MAP:
-                            video_qualities.append({
-                                'id': qn,
-                                'name': self.QUALITY_MAP[qn],
-                                'bandwidth': video.get('bandwidth', 0),
-                                'codecs': video.get('codecs', ''),
-                                'width': video.get('width', 0),
-                                'height': video.get('height', 0)
-                            })
-
-                # 音频流
-                audio_qualities = []
-                if 'audio' in dash_data:
-                    for audio in dash_data['audio']:
-                        aq = audio['id']
-                        if aq in self.AUDIO_QUALITY_MAP:
-                            audio_qualities.append({
-                                'id': aq,
-                                'name': self.AUDIO_QUALITY_MAP[aq],
-                                'bandwidth': audio.get('bandwidth', 0),
-                                'codecs': audio.get('codecs', '')
-                            })
-
-                return video_qualities, audio_qualities, None
-
-            # 如果没有dash数据，返回传统格式
-            accept_quality = result.get('accept_quality', [])
-            for qn in accept_quality:
-                if qn in self.QUALITY_MAP:
-                    video_qualities.append({
-                        'id': qn,
-                        'name': self.QUALITY_MAP[qn],
-                        'bandwidth': 0,
-                        'codecs': '',
-                        'width': 0,
-                        'height': 0
-                    })
+                return None, data.get('message', '未知错误')
 
-            return video_qualities, [], None
+            return StreamCatalog(data['data']), None
 
         except Exception as e:
-            return [], [], f"获取清晰度列表出错: {str(e)}"
+            return None, str(e)
+
+    def get_available_qualities(self, bvid, cid):
+        """获取视频可用的清晰度列表"""
+        # 请求最高清晰度以获取完整列表
+        catalog, error = self.get_stream_catalog(bvid, cid)
+        if error:
+            return [], [], f"获取清晰度列表失败: {error}"
+
+        video_qualities, audio_qualities = catalog.qualities(self.QUALITY_MAP, self.AUDIO_QUALITY_MAP)
+        return video_qualities, audio_qualities, None
+
+    def select_streams(self, bvid, cid, qn=80, audio_qn=30280, codecs=None):
+        """
+        从流目录中选出要下载的视频流和音频流
+        DASH响应包含全部清晰度，直接复用获取清晰度列表时的流目录
+        codecs: 可选，同一清晰度有多种编码时指定编码（如 'hev1.1.6.L150.90'）
+        返回: (video_stream, audio_stream, error)，流为 StreamCatalog 中的dict
+        """
+        catalog, error = self.get_stream_catalog(bvid, cid)
+
+        # 传统格式只返回所请求清晰度的链接，清晰度不符时按指定清晰度重新请求
+        if not error and not catalog.is_dash and catalog.quality != qn \
+                and qn in catalog.accept_quality:
+            catalog, error = self.get_stream_catalog(bvid, cid, qn)
+
+        if error:
+            return None, None, f"获取下载链接失败: {error}"
 
-    def get_download_urls(self, bvid, cid, qn=80, audio_qn=30280):
+        return catalog.select_streams(qn, audio_qn, codecs)
+
+    def get_download_urls(self, bvid, cid, qn=80, audio_qn=30280, codecs=None):
         """
         获取音视频下载链接（支持分离下载）
         返回: (video_url, audio_url, video_size, audio_size, error)
         """
+        video_stream, audio_stream, error = self.select_streams(bvid, cid, qn, audio_qn, codecs)
+        if error:
+            return None, None, 0, 0, error
+
+        return (
+            video_stream['url'] if video_stream else None,
+            audio_stream['url'] if audio_stream else None,
+            video_stream['size'] if video_stream else 0,
+            audio_stream['size'] if audio_stream else 0,
+            None
+        )
+
+    def _download_headers(self):
+        """下载CDN资源时使用的请求头"""
+        return {
+            'User-Agent': self.session.headers['User-Agent'],
+            'Referer': 'https://www.bilibili.com',
+        }
+
+    def probe_file_size(self, url):
+        """
+        探测远程文件大小及是否支持Range请求
+        返回: (total_size, accept_ranges, validator)
+        validator为ETag或Last-Modified，用于判断远程文件是否变化
+        """
+        total_size, accept_ranges, validator, _ = self._probe(url, 1)
+        return total_size, accept_ranges, validator
+
+    def _probe(self, url, probe_bytes):
+        """
+        请求文件开头的 probe_bytes 字节，同时测量该地址的速度
+        返回: (total_size, accept_ranges, validator, speed)，失败时 total_size 为0
+        """
         try:
-            url = 'https://api.bilibili.com/x/player/playurl'
-            params = {
-                'bvid': bvid,
-                'cid': cid,
-                'qn': qn,
-                'fnval': 4048,  # 音视频分离
-                'fourk': 1
-            }
+            headers = self._download_headers()
+            headers['Range'] = f'bytes=0-{probe_bytes - 1}'
+            started = time.monotonic()
+            response = self.transport.cdn.get(url, headers=headers, cookies=self.cookies,
+                                              stream=True, timeout=10)
+            self.metrics.http_responses.inc(kind='probe', status=response.status_code)
+            received = 0
+            try:
+                if response.status_code == 206 and probe_bytes > 1:
+                    for chunk in ResponseReader(response, limit=probe_bytes):
+                        received += len(chunk)
+            finally:
+                response.close()
+            elapsed = time.monotonic() - started
+
+            validator = response.headers.get('etag') or response.headers.get('last-modified')
+            speed = received / elapsed if received and elapsed > 0 else 0.0
+
+            if response.status_code == 206:
+                # Content-Range: bytes 0-0/123456
+                content_range = response.headers.get('content-range', '')
+                total = content_range.rsplit('/', 1)[-1]
+                if total.isdigit():
+                    return int(total), True, validator, speed
+
+            if response.status_code == 200:
+                return int(response.headers.get('content-length', 0)), False, validator, speed
+
+            return 0, False, None, 0.0
+        except Exception:
+            return 0, False, None, 0.0
+
+    def select_mirror(self, urls):
+        """
+        用小的Range请求同时探测所有候选地址（baseUrl和backupUrl），按实测速度排序
+        探测失败或文件大小与最快地址不一致的地址被排除
+        返回: (ranked_urls, total_size, accept_ranges, validator)
+        """
+        urls = list(dict.fromkeys(u for u in urls if u))
+        if len(urls) == 1:
+            total_size, accept_ranges, validator = self.probe_file_size(urls[0])
+            return urls, total_size, accept_ranges, validator
+
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            probes = list(executor.map(lambda u: self._probe(u, self.MIRROR_PROBE_BYTES), urls))
+
+        available = {}
+        for url, probe in zip(urls, probes):
+            if not probe[0]:
+                self.mirrors.record_failure(url)
+                continue
+            available[url] = probe
+            self.mirrors.record_speed(url, probe[3])
+
+        if not available:
+            return urls, 0, False, None
+
+        ranked = self.mirrors.rank(list(available))
+        total_size, accept_ranges, validator, _ = available[ranked[0]]
+        ranked = [url for url in ranked if available[url][0] == total_size]
+        return ranked, total_size, accept_ranges, validator
+
+    def _mirror_too_slow(self, url, speed, urls):
+        """传输中测得的速度是否过慢，需要换到其他镜像"""
+        host = self.mirrors.host(url)
+        others = [u for u in urls if self.mirrors.host(u) != host]
+        if not others:
+            return False
+        # 其他镜像明显更快
+        best_other = max(self.mirrors.speed(u) for u in others)
+        if speed < best_other * self.MIRROR_SLOW_RATIO:
+            return True
+        # 低于最低速度时，只在还有未测速或更快的镜像可换时切换
+        return speed < self.mirror_min_speed and any(
+            self.mirrors.score(u) is None or self.mirrors.speed(u) > speed for u in others
+        )
+
+    def download_file(self, url, save_path, progress_callback=None, desc="",
+                      connections=None, min_segment_size=None, stream_info=None, resume=True,
+                      cancel_event=None, backup_urls=None, job_limit=None):
+        """
+        下载文件
+        服务器支持Range时按字节区间分段，多连接并发下载并写入对应偏移，
+        并在 save_path 旁保存断点清单，中断后再次调用会从已完成的区间继续；
+        否则退回单连接顺序下载
+
+        stream_info: 流标识，如 {'bvid': ..., 'cid': ..., 'qn': ..., 'codec': ...}，
+                     用于确认续传的是同一个流
+        cancel_event: threading.Event，置位后尽快停止下载并保留断点
+        backup_urls: 备用CDN地址；先探测所有地址选出最快的，传输中出错或过慢时
+                     剩余区间改从其他地址下载
+        job_limit: 单任务限速的令牌桶（bandwidth.BandwidthLimiter.job），全局限速总是生效
+        """
+        try:
+            connections = connections or self.download_connections
+            min_segment_size = min_segment_size or self.min_segment_size
 
-            response = self.session.get(url, params=params, cookies=self.cookies)
-            data = response.json()
+            urls, total_size, accept_ranges, validator = self.select_mirror(
+                [url] + list(backup_urls or [])
+            )
+            if accept_ranges and total_size > 0:
+                identity = dict(stream_info or {'path': urlsplit(url).path})
+                identity['size'] = total_size
+                # 不同CDN主机的ETag不一定相同，有备用地址时不用它判断是否同一文件
+                identity['validator'] = validator if len(urls) == 1 else None
+
+                if resume:
+                    manifest = DownloadManifest.load(save_path, identity)
+                else:
+                    manifest = DownloadManifest(save_path, identity)
+
+                return self._download_segmented(
+                    urls, save_path, total_size, manifest, connections, min_segment_size,
+                    progress_callback, desc, cancel_event, job_limit
+                )
+
+            # 不支持Range时只能整个文件重新下载，按顺序尝试各地址
+            message = "下载失败"
+            for candidate in urls:
+                success, message = self._download_single(candidate, save_path, progress_callback,
+                                                         desc, cancel_event, job_limit)
+                if success or (cancel_event is not None and cancel_event.is_set()):
+                    return success, message
+                self.mirrors.record_failure(candidate)
+            return False, message
 
-            if data['code'] != 0:
-                return None, None, 0, 0, f"获取下载链接失败: {data.get('message', '未知错误')}"
+        except Exception as e:
+            return False, f"下载出错: {str(e)}"
 
-            result = data['data']
+    def _download_single(self, url, save_path, progress_callback=None, desc="",
+                         cancel_event=None, job_limit=None):
+        """单连接顺序下载"""
+        started = time.monotonic()
+        response = self.transport.cdn.get(url, headers=self._download_headers(),
+                                          cookies=self.cookies, stream=True)
+        self.metrics.http_responses.inc(kind='cdn', status=response.status_code)
 
-            # 优先使用DASH格式（音视频分离）
-            if 'dash' in result:
-                dash_data = result['dash']
+        if response.status_code != 200:
+            return False, f"下载失败: HTTP {response.status_code}"
 
-                video_url = None
-                video_size = 0
-                audio_url = None
-                audio_size = 0
+        total_size = int(response.headers.get('content-length', 0))
+        downloaded_size = 0
 
-                # 获取视频流
-                if 'video' in dash_data and len(dash_data['video']) > 0:
-                    # 选择匹配的清晰度或最高清晰度
-                    video_stream = None
-                    for v in dash_data['video']:
-                        if v['id'] == qn:
-                            video_stream = v
-                            break
+        with FileWriter(save_path, fsync=self.fsync_policy) as writer:
+            if total_size > 0:
+                writer.preallocate(total_size)
 
-                    if not video_stream:
-                        video_stream = dash_data['video'][0]
+            try:
+                for chunk in ResponseReader(response):
+                    if cancel_event is not None and cancel_event.is_set():
+                        return False, "下载已取消"
+                    writer.write(chunk)
+                    downloaded_size += len(chunk)
+
+                    if progress_callback and total_size > 0:
+                        progress = (downloaded_size / total_size) * 100
+                        progress_callback(progress, downloaded_size, total_size, desc)
+
+                    if not self.bandwidth.consume(len(chunk), job_limit, cancel_event):
+                        return False, "下载已取消"
+            finally:
+                response.close()
+                self.metrics.download_bytes.inc(downloaded_size, host=self.mirrors.host(url))
+
+            if total_size > 0 and downloaded_size != total_size:
+                writer.truncate(downloaded_size)
+                return False, f"下载不完整: {downloaded_size}/{total_size}"
+
+        self.metrics.observe_transfer('single', downloaded_size, time.monotonic() - started)
+        return True, "下载完成"
+
+    @staticmethod
+    def split_ranges(length, connections, min_segment_size, offset=0):
+        """
+        将 [offset, offset+length) 按字节区间切分
+        返回 [(start, end), ...]，end为闭区间
+        """
+        count = max(1, min(connections, length // min_segment_size))
+        segment_size = -(-length // count)  # 向上取整
+        ranges = []
+        start = offset
+        stop = offset + length
+        while start < stop:
+            end = min(start + segment_size, stop) - 1
+            ranges.append((start, end))
+            start = end + 1
+        return ranges
+
+    def _download_segmented(self, urls, save_path, total_size, manifest, connections,
+                            min_segment_size, progress_callback=None, desc="", cancel_event=None,
+                            job_limit=None):
+        """多连接分段下载，进度同步写入断点清单；urls 为按速度排好序的候选地址"""
+        resume = bool(manifest.completed) and os.path.exists(save_path)
+        if not resume:
+            manifest.completed = []
+
+        # 预先分配完整大小的文件，各分段写入自己的偏移
+        started = time.monotonic()
+        existing = manifest.completed_bytes()
+        writer = FileWriter(save_path, resume=resume, fsync=self.fsync_policy)
+        try:
+            writer.preallocate(total_size)
+            success, message = self._fetch_segments(urls, writer, total_size, manifest,
+                                                    connections, min_segment_size,
+                                                    progress_callback, desc, cancel_event,
+                                                    job_limit)
+        finally:
+            writer.close()
+        if success:
+            self.metrics.observe_transfer('segmented', total_size - existing,
+                                          time.monotonic() - started)
+        return success, message
+
+    def _fetch_segments(self, urls, writer, total_size, manifest, connections, min_segment_size,
+                        progress_callback, desc, cancel_event, job_limit=None):
+        """
+        并发下载清单中缺失的区间，写入 writer 的对应偏移
+        每个分段从当前得分最高的地址下载，出错或测得速度过慢时记入该主机的健康度，
+        并从断开的位置改用其他地址继续
+        """
+        ranges = []
+        for start, stop in manifest.missing(total_size):
+            ranges.extend(self.split_ranges(stop - start, connections, min_segment_size, start))
+
+        lock = threading.Lock()
+        stop_event = threading.Event()
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        state = {'downloaded': manifest.completed_bytes()}
+
+        def on_chunk(size):
+            with lock:
+                state['downloaded'] += size
+                if progress_callback:
+                    downloaded = state['downloaded']
+                    progress_callback(downloaded / total_size * 100, downloaded, total_size, desc)
+
+        def fetch(segment):
+            start, end = segment
+            position = start
+            committed = start
+            last_error = None
+
+            # 出错和因过慢切换分别计数，避免所有镜像都慢时反复切换
+            failures = 0
+            switches = 0
+            while failures < self.SEGMENT_RETRIES + len(urls) - 1:
+                if stop_event.is_set() or cancel_event.is_set():
+                    return
+                url = self.mirrors.rank(urls)[0]
+                window_start = time.monotonic()
+                window_bytes = 0
+                too_slow = False
+                response_start = position
+                try:
+                    headers = self._download_headers()
+                    headers['Range'] = f'bytes={position}-{end}'
+                    response = self.transport.cdn.get(url, headers=headers, cookies=self.cookies,
+                                                      stream=True, timeout=30)
+                    self.metrics.http_responses.inc(kind='cdn', status=response.status_code)
+                    if response.status_code != 206:
+                        raise IOError(f"HTTP {response.status_code}")
+
+                    try:
+                        for chunk in ResponseReader(response, limit=end + 1 - position):
+                            if stop_event.is_set() or cancel_event.is_set():
+                                break
+                            writer.pwrite(chunk, position)
+                            position += len(chunk)
+                            window_bytes += len(chunk)
+                            on_chunk(len(chunk))
+
+                            # 限速等待的时间不计入镜像测速
+                            waited = time.monotonic()
+                            self.bandwidth.consume(len(chunk), job_limit, cancel_event)
+                            window_start += time.monotonic() - waited
+
+                            # 数据写入后再记入清单
+                            if position - committed >= self.MANIFEST_FLUSH_BYTES:
+                                writer.checkpoint()
+                                manifest.add(committed, position)
+                                committed = position
+
+                            # 定期测速，过慢时换到其他镜像
+                            elapsed = time.monotonic() - window_start
+                            if elapsed >= self.MIRROR_CHECK_INTERVAL:
+                                self.mirrors.record(url, window_bytes, elapsed)
+                                if switches < 2 * len(urls) and \
+                                        self._mirror_too_slow(url, window_bytes / elapsed, urls):
+                                    too_slow = True
+                                    break
+                                window_start = time.monotonic()
+                                window_bytes = 0
+                    finally:
+                        response.close()
+                        writer.checkpoint()
+                        manifest.add(committed, position)
+                        committed = position
+                        self.metrics.download_bytes.inc(position - response_start,
+                                                        host=self.mirrors.host(url))
+
+                    if position > end or stop_event.is_set() or cancel_event.is_set():
+                        if window_bytes >= self.MIRROR_PROBE_BYTES:
+                            self.mirrors.record(url, window_bytes, time.monotonic() - window_start)
+                        return
+                    if too_slow:
+                        switches += 1
+                        self.mirrors.record_failure(url)
+                        self.metrics.download_retries.inc(reason='slow')
+                        continue
+                    last_error = IOError("连接提前关闭")
+                    failures += 1
+                    self.mirrors.record_failure(url)
+                    self.metrics.download_retries.inc(reason='error')
+                except Exception as e:
+                    last_error = e
+                    failures += 1
+                    self.mirrors.record_failure(url)
+                    self.metrics.download_retries.inc(reason='error')
+
+            raise IOError(f"分段 {start}-{end} 下载失败: {last_error}")
+
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, min(connections, len(ranges)))) as executor:
+            futures = [executor.submit(fetch, r) for r in ranges]
+            for future in as_completed(futures):
+                if future.exception():
+                    error = future.exception()
+                    stop_event.set()
+                    break
+
+        if error or manifest.completed_bytes() != total_size:
+            manifest.save(force=True)
+            if error:
+                return False, f"下载出错: {str(error)}（已保存断点，可重试续传）"
+            if cancel_event.is_set():
+                return False, "下载已取消"
+            return False, f"下载不完整: {manifest.completed_bytes()}/{total_size}"
+
+        manifest.remove()
+        return True, "下载完成"
+
+    def download_streams(self, streams, progress_callback=None, desc="下载音视频",
+                         cancel_event=None, job_limit=None):
+        """
+        并发下载多个流（如DASH的视频流和音频流）
+        streams: [{'url': ..., 'path': ..., 'stream_info': {...}, 'backup_urls': [...]}, ...]
+        progress_callback 收到所有流合计的进度；任一流失败时取消其余流
+        返回: (success, message)
+        """
+        cancel_event = cancel_event or threading.Event()
+        lock = threading.Lock()
+        downloaded = [0] * len(streams)
+        totals = [0] * len(streams)
+
+        def make_callback(index):
+            def callback(progress, done, total, _desc=""):
+                with lock:
+                    downloaded[index] = done
+                    totals[index] = total
+                    all_done = sum(downloaded)
+                    all_total = sum(totals)
+                if progress_callback and all_total > 0:
+                    progress_callback(all_done / all_total * 100, all_done, all_total, desc)
+            return callback
+
+        def run(index, stream):
+            success, message = self.download_file(
+                stream['url'], stream['path'], make_callback(index), desc,
+                stream_info=stream.get('stream_info'), cancel_event=cancel_event,
+                backup_urls=stream.get('backup_urls'), job_limit=job_limit
+            )
+            if not success:
+                cancel_event.set()
+            return success, message
 
-                    video_url = video_stream['baseUrl']
-                    video_size = video_stream.get('bandwidth', 0) // 8  # 转换为字节
+        results = []
+        with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+            futures = [executor.submit(run, i, s) for i, s in enumerate(streams)]
+            for future in futures:
+                results.append(future.result())
 
-                # 获取音频流
-                if 'audio' in dash_data and len(dash_data['audio']) > 0:
-                    # 选择匹配的音质或最高音质
-                    audio_stream = None
-                    for a in dash_data['audio']:
-                        if a['id'] == audio_qn:
-                            audio_stream = a
-                            break
+        # 优先返回真正出错的流的信息，而不是被连带取消的流
+        failures = [message for success, message in results if not success]
+        if failures:
+            errors = [m for m in failures if m != "下载已取消"]
+            return False, (errors or failures)[0]
 
-                    if not audio_stream:
-                        audio_stream = dash_data['audio'][0]
+        return True, "下载完成"
 
-                    audio_url = audio_stream['baseUrl']
-                    audio_size = audio_stream.get('bandwidth', 0) // 8
+    def can_stream(self, input_count=1):
+        """
+        判断当前环境能否边下载边交给ffmpeg处理
+        单输入走stdin；多输入需要额外的管道描述符，仅POSIX系统支持
+        """
+        if input_count > 1 and os.name != 'posix':
+            return False
+        return self.get_ffmpeg() is not None
 
-                return video_url, audio_url, video_size, audio_size, None
+    def get_ffmpeg(self):
+        """获取ffmpeg能力信息（进程内缓存），找不到ffmpeg时返回None"""
+        from postprocess import get_ffmpeg
 
-            # 传统格式（音视频合并）
-            elif 'durl' in result:
-                durl = result['durl'][0]
-                video_url = durl['url']
-                file_size = durl.get('size', 0)
-                return video_url, None, file_size, 0, None
+        return get_ffmpeg(self.ffmpeg_path)
 
-            return None, None, 0, 0, "未找到可用的下载链接"
+    def stream_to_ffmpeg(self, urls, output_path, codec_args, progress_callback=None,
+                         desc="", cancel_event=None, job_limit=None):
+        """
+        边下载边把数据写入ffmpeg，不落地临时文件
+        第一个输入经stdin传入，其余输入经额外管道(pipe:N)传入
+        codec_args: 输入与输出文件之间的ffmpeg参数
+        返回: (success, message)
+        """
+        if not self.can_stream(len(urls)):
+            return False, "当前环境不支持流式处理"
+        ffmpeg = self.get_ffmpeg()
+
+        cancel_event = cancel_event or threading.Event()
+        # 内部停止（下载出错或ffmpeg已退出），与调用方的取消分开，出错时调用方仍可退回临时文件方式
+        stop_event = threading.Event()
+        lock = threading.Lock()
+        downloaded = [0] * len(urls)
+        totals = [0] * len(urls)
+        errors = []
+
+        extra_pipes = [os.pipe() for _ in urls[1:]]
+        cmd = [ffmpeg.path, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0']
+        for read_fd, _ in extra_pipes:
+            cmd.extend(['-i', f'pipe:{read_fd}'])
+        cmd.extend(codec_args)
+        cmd.extend(['-y', output_path])
+
+        import subprocess
 
+        try:
+            process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                pass_fds=[read_fd for read_fd, _ in extra_pipes]
+            )
         except Exception as e:
-            return None, None, 0, 0, f"获取下载链接出错: {str(e)}"
+            for read_fd, write_fd in extra_pipes:
+                os.close(read_fd)
+                os.close(write_fd)
+            return False, f"启动ffmpeg失败: {str(e)}"
+
+        # 读端已交给ffmpeg，父进程只保留写端
+        writers = [process.stdin]
+        for read_fd, write_fd in extra_pipes:
+            os.close(read_fd)
+            writers.append(os.fdopen(write_fd, 'wb'))
+
+        # 持续读取stderr，避免ffmpeg输出过多时阻塞
+        stderr_chunks = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+        )
+        stderr_thread.start()
+
+        def kill():
+            if process.poll() is None:
+                process.kill()
+
+        def watch_cancel():
+            # 取消时先结束ffmpeg再关闭输入管道：ffmpeg读到输入结束会把不完整的文件当作正常完成
+            while process.poll() is None:
+                if cancel_event.wait(0.2):
+                    kill()
+                    return
+
+        threading.Thread(target=watch_cancel, daemon=True).start()
+
+        def feed(index, url, writer):
+            try:
+                response = self.transport.cdn.get(url, headers=self._download_headers(),
+                                                  cookies=self.cookies, stream=True, timeout=30)
+                self.metrics.http_responses.inc(kind='cdn', status=response.status_code)
+                if response.status_code != 200:
+                    raise IOError(f"HTTP {response.status_code}")
+
+                totals[index] = int(response.headers.get('content-length', 0))
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    if cancel_event.is_set():
+                        kill()
+                        break
+                    if stop_event.is_set():
+                        break
+                    if not chunk:
+                        continue
+                    writer.write(chunk)
+                    with lock:
+                        downloaded[index] += len(chunk)
+                        all_done = sum(downloaded)
+                        all_total = sum(totals)
+                    if progress_callback and all_total > 0:
+                        progress_callback(all_done / all_total * 100, all_done, all_total, desc)
+                    self.bandwidth.consume(len(chunk), job_limit, cancel_event)
+                response.close()
+            except BrokenPipeError:
+                # ffmpeg已退出，错误信息以ffmpeg输出为准
+                stop_event.set()
+            except Exception as e:
+                errors.append(f"下载出错: {str(e)}")
+                stop_event.set()
+                # 结束ffmpeg，避免其他输入的写入一直阻塞
+                kill()
+            finally:
+                if cancel_event.is_set():
+                    kill()
+                self.metrics.download_bytes.inc(downloaded[index], host=self.mirrors.host(url))
+                try:
+                    writer.close()
+                except OSError:
+                    pass
+
+        feeders = [threading.Thread(target=feed, args=(i, url, writers[i]), daemon=True)
+                   for i, url in enumerate(urls)]
+        for thread in feeders:
+            thread.start()
+        for thread in feeders:
+            thread.join()
+
+        if cancel_event.is_set() or stop_event.is_set():
+            kill()
+        process.wait()
+        stderr_thread.join()
+        stderr = b''.join(stderr_chunks).decode('utf-8', errors='replace')
+
+        # 取消时即使ffmpeg正常退出，输出也是不完整的
+        cancelled = cancel_event.is_set()
+        if cancelled or errors or process.returncode != 0:
+            try:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            except OSError:
+                pass
+            if cancelled:
+                return False, "处理已取消"
+            if errors:
+                return False, errors[0]
+            return False, f"处理失败: {stderr}"
 
-    def download_file(self, url, save_path, progress_callback=None, desc=""):
-        """下载文件"""
-        try:
-            headers = {
-                'User-Agent': self.session.headers['User-Agent'],
-                'Referer': 'https://www.bilibili.com',
+        if progress_callback:
+            progress_callback(100, 0, 0, "处理完成")
+
+        return True, "处理完成"
+
+    def plan_postprocess(self, output_path, output_format=None, video_codec=None,
+                         audio_codec=None, has_video=True, has_audio=True):
+        """
+        生成后处理方案（见 postprocess.plan_postprocess）
+        返回: (ffmpeg, plan, error)
+        """
+        from postprocess import plan_postprocess
+
+        ffmpeg = self.get_ffmpeg()
+        if not ffmpeg:
+            return None, None, "未找到ffmpeg，请先安装ffmpeg"
+
+        plan, error = plan_postprocess(ffmpeg, output_path, output_format, video_codec,
+                                       audio_codec, has_video, has_audio)
+        return ffmpeg, plan, error
+
+    def stream_merge(self, video_url, audio_url, output_path, progress_callback=None,
+                     cancel_event=None, video_codec=None, audio_codec=None, job_limit=None):
+        """流式下载音视频并直接合并到输出文件"""
+        ffmpeg, plan, error = self.plan_postprocess(output_path, None, video_codec, audio_codec)
+        if error:
+            return False, error
+        return self.stream_to_ffmpeg([video_url, audio_url], output_path, plan.codec_args,
+                                     progress_callback, "下载并合并音视频", cancel_event, job_limit)
+
+    def stream_convert_video(self, video_url, output_path, progress_callback=None,
+                             cancel_event=None, video_codec=None, job_limit=None):
+        """流式下载视频并直接封装为输出格式"""
+        ffmpeg, plan, error = self.plan_postprocess(output_path, None, video_codec,
+                                                    has_audio=False)
+        if error:
+            return False, error
+        return self.stream_to_ffmpeg([video_url], output_path, plan.codec_args,
+                                     progress_callback, "下载并转换视频", cancel_event, job_limit)
+
+    def stream_convert_audio(self, audio_url, output_path, output_format, progress_callback=None,
+                             cancel_event=None, audio_codec=None, job_limit=None):
+        """流式下载音频并直接转换为目标格式"""
+        ffmpeg, plan, error = self.plan_postprocess(output_path, output_format,
+                                                    audio_codec=audio_codec, has_video=False)
+        if error:
+            return False, error
+        return self.stream_to_ffmpeg([audio_url], output_path, plan.codec_args, progress_callback,
+                                     f"下载并转换为{output_format.upper()}格式", cancel_event,
+                                     job_limit)
+
+    @staticmethod
+    def make_filename(title, output_format):
+        """根据视频标题生成合法的文件名"""
+        filename = f"{title}.{output_format}"
+        return "".join(c for c in filename if c not in r'\/:*?"<>|')
+
+    @classmethod
+    def make_page_filename(cls, title, page, page_count, output_format):
+        """
+        多P视频中一个分P的文件名：标题_P03_分P标题.格式
+        页码按总页数补零，按文件名排序即为分P顺序
+        """
+        width = len(str(page_count))
+        name = f"{title}_P{page['page']:0{width}d}"
+        part = page.get('part', '').strip()
+        if part and part != title:
+            name += f"_{part}"
+        return cls.make_filename(name, output_format)
+
+    def prefetch_catalogs(self, items, workers=None):
+        """
+        并发解析多个视频/分P的下载链接，结果进入缓存，之后的下载直接使用
+        items: [(bvid, cid), ...]
+        返回: {(bvid, cid): error}，只包含失败的项
+        """
+        items = list(dict.fromkeys(items))
+        if not items:
+            return {}
+
+        errors = {}
+        workers = min(len(items), workers or self.PREFETCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.get_stream_catalog, bvid, cid): (bvid, cid)
+                       for bvid, cid in items}
+            for future in as_completed(futures):
+                _, error = future.result()
+                if error:
+                    errors[futures[future]] = error
+        return errors
+
+    def download_pages(self, video_info, output_dir, pages=None, download_type="merged",
+                       output_format="mp4", video_qn=80, audio_qn=30216, progress_callback=None,
+                       streaming=True, cancel_event=None, max_parallel=None, max_rate=None):
+        """
+        下载多P视频的多个分P：先并发解析所有分P的下载链接，再最多 max_parallel 个分P同时下载
+        pages: get_pages 返回的分P列表，为None时下载全部分P
+        progress_callback 收到所有分P合计的进度
+        返回: [{'page', 'cid', 'part', 'path', 'success', 'message', 'timings'}, ...]，按分P顺序
+        """
+        bvid = video_info['bvid']
+        if pages is None:
+            pages, _ = self.get_pages(video_info, 'all')
+        page_count = len(video_info.get('pages') or pages)
+        cancel_event = cancel_event or threading.Event()
+
+        self.prefetch_catalogs([(bvid, page['cid']) for page in pages])
+
+        lock = threading.Lock()
+        progress = [0.0] * len(pages)
+        finished = [0]
+
+        def report():
+            if progress_callback:
+                with lock:
+                    overall = sum(progress) / len(pages)
+                    done = finished[0]
+                progress_callback(overall, 0, 0,
+                                  f"分P {done}/{len(pages)} 已完成，总进度 {overall:.1f}%")
+
+        def run(index, page):
+            path = os.path.join(output_dir, self.make_page_filename(
+                video_info['title'], page, page_count, output_format
+            ))
+
+            def on_progress(percent, downloaded, total, desc=""):
+                with lock:
+                    progress[index] = percent
+                report()
+
+            timings = {}
+            if cancel_event.is_set():
+                success, message = False, "下载已取消"
+            else:
+                success, message = self.download_video(
+                    bvid, page['cid'], path, download_type, output_format, video_qn, audio_qn,
+                    on_progress, streaming, cancel_event=cancel_event, timings=timings,
+                    max_rate=max_rate
+                )
+            with lock:
+                progress[index] = 100.0
+                finished[0] += 1
+            report()
+            return {
+                'page': page['page'], 'cid': page['cid'], 'part': page.get('part', ''),
+                'path': path, 'success': success, 'message': message, 'timings': timings,
             }
 
-            response = self.session.get(url, headers=headers, cookies=self.cookies, stream=True)
+        workers = max(1, min(len(pages), max_parallel or self.PAGE_PARALLEL))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, range(len(pages)), pages))
 
-            if response.status_code != 200:
-                return False, f"下载失败: HTTP {response.status_code}"
+    def download_video(self, bvid, cid, save_path, download_type="merged", output_format="mp4",
+                       video_qn=80, audio_qn=30216, progress_callback=None, streaming=True,
+                       video_codec='', audio_codec='', cancel_event=None, timings=None,
+                       download_slot=None, max_rate=None):
+        """
+        完整的下载任务：获取下载链接、下载音视频流并完成合并/格式转换
+        download_type: merged / video_only / audio_only
+        streaming: 环境支持时边下载边交给ffmpeg处理，失败时退回临时文件方式
+        timings: 可选的dict，写入各阶段耗时（秒）
+        download_slot: 可选的信号量，只在占用网络的阶段持有，后处理排队时释放给其他任务
+        max_rate: 本任务的速度上限（字节/秒），全局限速见 self.bandwidth
+        返回: (success, message)
+        """
+        timings = timings if timings is not None else {}
+        held = [False]
+        if download_slot is not None:
+            download_slot.acquire()
+            held[0] = True
+
+        def release_slot():
+            if held[0]:
+                held[0] = False
+                download_slot.release()
+
+        known_stages = set(timings)
+        success = False
+        try:
+            success, message = self._download_job(
+                bvid, cid, save_path, download_type, output_format, video_qn, audio_qn,
+                progress_callback, streaming, video_codec, audio_codec, cancel_event, timings,
+                release_slot, self.bandwidth.job(max_rate)
+            )
+            return success, message
+        finally:
+            release_slot()
+            for stage, seconds in timings.items():
+                if stage not in known_stages:
+                    self.metrics.stage_seconds.observe(seconds, stage=stage)
+            if success:
+                result = 'success'
+            elif cancel_event is not None and cancel_event.is_set():
+                result = 'cancelled'
+            else:
+                result = 'failed'
+            self.metrics.jobs.inc(type=download_type, result=result)
 
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
+    def _postprocess(self, name, timings, release_slot, func, *args):
+        """
+        执行后处理步骤：设置了工作池时提交到工作池并释放下载名额，否则直接执行
+        返回: (success, message)
+        """
+        pool = self.postprocess_pool
+        if pool is None:
+            started = time.time()
+            result = func(*args)
+            timings['process'] = time.time() - started
+            return result
+
+        release_slot()
+        success, message, queue_time, encode_time = pool.run(name, func, *args)
+        timings['queue'] = queue_time
+        timings['process'] = encode_time
+        return success, message
+
+    def _download_job(self, bvid, cid, save_path, download_type, output_format, video_qn,
+                      audio_qn, progress_callback, streaming, video_codec, audio_codec,
+                      cancel_event, timings, release_slot, job_limit):
+        """download_video 的实际流程"""
+
+        # 获取下载链接
+        started = time.time()
+        video_stream, audio_stream, error = self.select_streams(
+            bvid, cid, video_qn, audio_qn, video_codec or None
+        )
+        timings['playurl'] = time.time() - started
+        if error:
+            return False, error
+
+        if download_type in ["merged", "video_only"] and not video_stream:
+            return False, "未找到视频流"
+        if download_type in ["merged", "audio_only"] and not audio_stream:
+            return False, "未找到音频流"
+
+        video_url = video_stream['url'] if video_stream else None
+        audio_url = audio_stream['url'] if audio_stream else None
+        video_backups = video_stream.get('backup_urls', []) if video_stream else []
+        audio_backups = audio_stream.get('backup_urls', []) if audio_stream else []
+        # 源编码，用于后处理时决定哪些流可以直接复制
+        video_codec = video_stream.get('codecs', '') if video_stream else video_codec
+        audio_codec = audio_stream.get('codecs', '') if audio_stream else audio_codec
+        # 时长用于计算后处理进度
+        duration = (video_stream or audio_stream).get('duration')
+
+        # 流标识，用于断点续传时确认是同一个流
+        video_info = {'bvid': bvid, 'cid': cid, 'qn': video_qn, 'codec': video_codec}
+        audio_info = {'bvid': bvid, 'cid': cid, 'qn': audio_qn, 'codec': audio_codec}
+
+        # 使用工作池时，需要转码的任务先下载再排队转码，避免在下载线程中占用CPU
+        if streaming and self.postprocess_pool is not None:
+            _, plan, error = self.plan_postprocess(
+                save_path, output_format, video_codec, audio_codec,
+                has_video=download_type != "audio_only",
+                has_audio=download_type != "video_only"
+            )
+            streaming = bool(plan) and plan.stream_copy_only
+
+        # 流式处理
+        if streaming:
+            started = time.time()
+            streamed = None
+            # 流式处理无法中途换地址，开始前选出最快的镜像
+            if video_url and video_backups and download_type != "audio_only":
+                video_url = self.select_mirror([video_url] + video_backups)[0][0]
+            if audio_url and audio_backups and download_type != "video_only":
+                audio_url = self.select_mirror([audio_url] + audio_backups)[0][0]
+            if download_type == "merged" and self.can_stream(2):
+                streamed, message = self.stream_merge(
+                    video_url, audio_url, save_path, progress_callback, cancel_event,
+                    video_codec, audio_codec, job_limit
+                )
+            elif download_type == "audio_only" and self.can_stream(1):
+                streamed, message = self.stream_convert_audio(
+                    audio_url, save_path, output_format, progress_callback, cancel_event,
+                    audio_codec, job_limit
+                )
+            elif download_type == "video_only" and output_format == "mp4" and self.can_stream(1):
+                streamed, message = self.stream_convert_video(
+                    video_url, save_path, progress_callback, cancel_event, video_codec, job_limit
+                )
+
+            if streamed is not None:
+                timings['stream'] = time.time() - started
+                if streamed:
+                    return True, message
+                if cancel_event is not None and cancel_event.is_set():
+                    return False, message
+
+        if download_type == "video_only":
+            # 仅下载视频
+            if output_format == "mp4" and save_path.endswith('.mp4'):
+                temp_path = save_path.replace('.mp4', '_temp.m4s')
+            else:
+                temp_path = save_path
 
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
+            started = time.time()
+            success, message = self.download_file(
+                video_url, temp_path, progress_callback, "下载视频",
+                stream_info=video_info, cancel_event=cancel_event, backup_urls=video_backups,
+                job_limit=job_limit
+            )
+            timings['download'] = time.time() - started
+            if not success:
+                return False, message
+
+            # 转换格式
+            if output_format == "mp4" and temp_path != save_path:
+                success, message = self._postprocess(
+                    save_path, timings, release_slot,
+                    self.convert_to_mp4, temp_path, save_path, progress_callback, video_codec,
+                    duration
+                )
+                if not success:
+                    return False, message
+
+        elif download_type == "audio_only":
+            # 仅下载音频
+            temp_path = save_path.replace(f'.{output_format}', '_temp.m4s')
+
+            started = time.time()
+            success, message = self.download_file(
+                audio_url, temp_path, progress_callback, "下载音频",
+                stream_info=audio_info, cancel_event=cancel_event, backup_urls=audio_backups,
+                job_limit=job_limit
+            )
+            timings['download'] = time.time() - started
+            if not success:
+                return False, message
+
+            # 转换格式
+            success, message = self._postprocess(
+                save_path, timings, release_slot, self.convert_audio_format,
+                temp_path, save_path, output_format, progress_callback, audio_codec, duration
+            )
+            if not success:
+                return False, message
+
+        else:  # merged
+            base_path = save_path.replace(f'.{output_format}', '')
+            video_temp = base_path + '_video.m4s'
+            audio_temp = base_path + '_audio.m4s'
+
+            # 同时下载视频和音频
+            started = time.time()
+            success, message = self.download_streams([
+                {'url': video_url, 'path': video_temp, 'stream_info': video_info,
+                 'backup_urls': video_backups},
+                {'url': audio_url, 'path': audio_temp, 'stream_info': audio_info,
+                 'backup_urls': audio_backups},
+            ], progress_callback, cancel_event=cancel_event, job_limit=job_limit)
+            timings['download'] = time.time() - started
+            if not success:
+                return False, message
+
+            # 合并（MP4/FLV都一次完成）
+            success, message = self._postprocess(
+                save_path, timings, release_slot, self.merge_video_audio,
+                video_temp, audio_temp, save_path, progress_callback, video_codec, audio_codec,
+                duration
+            )
+            if not success:
+                return False, message
 
-                        if progress_callback and total_size > 0:
-                            progress = (downloaded_size / total_size) * 100
-                            progress_callback(progress, downloaded_size, total_size, desc)
+        return True, "下载完成"
 
-            return True, "下载完成"
+    def _run_plan(self, ffmpeg, plan, input_paths, progress_callback=None, desc="",
+                  duration=None):
+        """
+        执行后处理方案，按ffmpeg的 -progress 输出实时报告进度和剩余时间
+        duration: 输出时长（秒），未知时只报告已处理的时长
+        返回: (returncode, stderr)
+        """
+        from postprocess import format_eta, run_ffmpeg
+
+        # 在工作池中转码时限制ffmpeg的线程数
+        pre_output = ()
+        if self.postprocess_pool is not None and not plan.stream_copy_only:
+            pre_output = self.postprocess_pool.ffmpeg_args()
+
+        on_progress = None
+        if progress_callback:
+            def on_progress(progress):
+                if progress.duration:
+                    text = f"{desc} {progress.percent:.1f}% 剩余 {format_eta(progress.eta)}"
+                else:
+                    text = f"{desc} 已处理 {format_eta(progress.out_time)}"
+                progress_callback(progress.percent, 0, 0, text)
 
-        except Exception as e:
-            return False, f"下载出错: {str(e)}"
+        return run_ffmpeg(plan.command(ffmpeg.path, input_paths, pre_output), duration, on_progress)
 
-    def merge_video_audio(self, video_path, audio_path, output_path, progress_callback=None):
-        """使用ffmpeg合并音视频"""
+    def merge_video_audio(self, video_path, audio_path, output_path, progress_callback=None,
+                          video_codec=None, audio_codec=None, duration=None):
+        """
+        使用ffmpeg合并音视频
+        一次调用直接输出目标容器（MP4/FLV），容器支持的流直接复制，只转码必须转码的流
+        """
         try:
             if progress_callback:
-                progress_callback(0, 0, 100, "正在合并音视频")
+                progress_callback(0, 0, 0, "正在合并音视频")
 
-            # 检查ffmpeg是否可用
-            try:
-                subprocess.run(['ffmpeg', '-version'],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                return False, "未找到ffmpeg，请先安装ffmpeg"
-
-            # 构建ffmpeg命令
-            cmd = [
-                'ffmpeg',
-                '-i', video_path,
-                '-i', audio_path,
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-strict', 'experimental',
-                '-y',  # 覆盖输出文件
-                output_path
-            ]
-
-            # 执行合并
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
+            ffmpeg, plan, error = self.plan_postprocess(output_path, None, video_codec, audio_codec)
+            if error:
+                return False, error
 
-            stdout, stderr = process.communicate()
+            returncode, stderr = self._run_plan(ffmpeg, plan, [video_path, audio_path],
+                                                progress_callback, "正在合并音视频", duration)
 
-            if process.returncode != 0:
+            if returncode != 0:
                 return False, f"合并失败: {stderr}"
 
             if progress_callback:
-                progress_callback(100, 100, 100, "合并完成")
+                progress_callback(100, 0, 0, "合并完成")
 
             # 删除临时文件
             try:
@@ -489,43 +1736,26 @@ class BilibiliAPI:
         except Exception as e:
             return False, f"合并出错: {str(e)}"
 
-    def convert_to_mp4(self, input_path, output_path, progress_callback=None):
-        """转换视频格式为MP4"""
+    def convert_to_mp4(self, input_path, output_path, progress_callback=None, video_codec=None,
+                       duration=None):
+        """转换视频格式（按输出文件扩展名确定容器，默认MP4）"""
         try:
             if progress_callback:
-                progress_callback(0, 0, 100, "正在转换格式")
+                progress_callback(0, 0, 0, "正在转换格式")
 
-            try:
-                subprocess.run(['ffmpeg', '-version'],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                return False, "未找到ffmpeg，请先安装ffmpeg"
-
-            cmd = [
-                'ffmpeg',
-                '-i', input_path,
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-y',
-                output_path
-            ]
+            ffmpeg, plan, error = self.plan_postprocess(output_path, None, video_codec,
+                                                        has_audio=False)
+            if error:
+                return False, error
 
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-
-            stdout, stderr = process.communicate()
+            returncode, stderr = self._run_plan(ffmpeg, plan, [input_path],
+                                                progress_callback, "正在转换格式", duration)
 
-            if process.returncode != 0:
+            if returncode != 0:
                 return False, f"转换失败: {stderr}"
 
             if progress_callback:
-                progress_callback(100, 100, 100, "转换完成")
+                progress_callback(100, 0, 0, "转换完成")
 
             # 删除原文件
             try:
@@ -539,87 +1769,31 @@ class BilibiliAPI:
         except Exception as e:
             return False, f"转换出错: {str(e)}"
 
-    def convert_audio_format(self, input_path, output_path, output_format, progress_callback=None):
+    def convert_audio_format(self, input_path, output_path, output_format, progress_callback=None,
+                             audio_codec=None, duration=None):
         """
         转换音频格式
         支持格式: mp3, wav, flac, m4a, aac
+        源编码与目标格式一致时（如AAC→M4A、FLAC→FLAC）直接复制，不重新编码
         """
         try:
+            desc = f"正在转换为{output_format.upper()}格式"
             if progress_callback:
-                progress_callback(0, 0, 100, f"正在转换为{output_format.upper()}格式")
-
-            # 检查ffmpeg是否可用
-            try:
-                subprocess.run(['ffmpeg', '-version'],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                return False, "未找到ffmpeg，请先安装ffmpeg"
-
-            # 根据格式选择编码器和参数
-            format_settings = {
-                'mp3': {
-                    'codec': 'libmp3lame',
-                    'quality': ['-q:a', '0'],  # VBR最高质量
-                    'extra': []
-                },
-                'wav': {
-                    'codec': 'pcm_s16le',
-                    'quality': [],
-                    'extra': []
-                },
-                'flac': {
-                    'codec': 'flac',
-                    'quality': ['-compression_level', '8'],  # 最高压缩
-                    'extra': []
-                },
-                'm4a': {
-                    'codec': 'aac',
-                    'quality': ['-b:a', '320k'],
-                    'extra': ['-strict', 'experimental']
-                },
-                'aac': {
-                    'codec': 'aac',
-                    'quality': ['-b:a', '320k'],
-                    'extra': ['-strict', 'experimental']
-                }
-            }
-
-            settings = format_settings.get(output_format.lower())
-            if not settings:
-                return False, f"不支持的音频格式: {output_format}"
-
-            # 构建ffmpeg命令
-            cmd = ['ffmpeg', '-i', input_path]
-
-            # 添加音频编码器
-            cmd.extend(['-c:a', settings['codec']])
+                progress_callback(0, 0, 0, desc)
 
-            # 添加质量参数
-            cmd.extend(settings['quality'])
+            ffmpeg, plan, error = self.plan_postprocess(output_path, output_format,
+                                                        audio_codec=audio_codec, has_video=False)
+            if error:
+                return False, error
 
-            # 添加额外参数
-            cmd.extend(settings['extra'])
+            returncode, stderr = self._run_plan(ffmpeg, plan, [input_path],
+                                                progress_callback, desc, duration)
 
-            # 添加输出文件
-            cmd.extend(['-y', output_path])
-
-            # 执行转换
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-
-            stdout, stderr = process.communicate()
-
-            if process.returncode != 0:
+            if returncode != 0:
                 return False, f"转换失败: {stderr}"
 
             if progress_callback:
-                progress_callback(100, 100, 100, "转换完成")
+                progress_callback(100, 0, 0, "转换完成")
 
             # 删除原文件
             try:
@@ -632,3 +1806,580 @@ class BilibiliAPI:
 
         except Exception as e:
             return False, f"转换出错: {str(e)}"
+
+
+class DownloadManifest:
+    """
+    断点续传清单
+    以 sidecar 文件（<save_path>.manifest.json）保存流标识和已完成的字节区间
+    """
+
+    SUFFIX = '.manifest.json'
+    SAVE_INTERVAL = 1.0  # 两次写盘的最小间隔（秒）
+
+    def __init__(self, save_path, identity):
+        self.path = save_path + self.SUFFIX
+        self.identity = identity
+        self.completed = []  # 已合并的半开区间 [[start, stop), ...]
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, save_path, identity):
+        """读取已有清单；流标识不一致或数据文件丢失时返回空清单"""
+        manifest = cls(save_path, identity)
+        try:
+            if not os.path.exists(manifest.path) or not os.path.exists(save_path):
+                return manifest
+
+            with open(manifest.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+
+            if cls._same_stream(data.get('identity', {}), identity):
+                manifest.completed = [list(r) for r in data.get('completed', [])]
+        except Exception:
+            manifest.completed = []
+        return manifest
+
+    @staticmethod
+    def _same_stream(saved, current):
+        """比较流标识；validator只有两边都有时才参与比较"""
+        for key in set(saved) | set(current):
+            if key == 'validator' and (not saved.get(key) or not current.get(key)):
+                continue
+            if saved.get(key) != current.get(key):
+                return False
+        return True
+
+    def add(self, start, stop):
+        """记录已完成区间 [start, stop)"""
+        if stop <= start:
+            return
+        with self._lock:
+            ranges = sorted(self.completed + [[start, stop]])
+            merged = [ranges[0]]
+            for s, e in ranges[1:]:
+                if s <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], e)
+                else:
+                    merged.append([s, e])
+            self.completed = merged
+        self.save()
+
+    def completed_bytes(self):
+        with self._lock:
+            return sum(e - s for s, e in self.completed)
+
+    def missing(self, total_size):
+        """返回尚未下载的半开区间列表"""
+        with self._lock:
+            gaps = []
+            position = 0
+            for s, e in self.completed:
+                if s > position:
+                    gaps.append((position, s))
+                position = max(position, e)
+            if position < total_size:
+                gaps.append((position, total_size))
+            return gaps
+
+    def save(self, force=False):
+        """写入清单（先写临时文件再替换，避免中断时损坏）"""
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_save < self.SAVE_INTERVAL:
+                return
+            self._last_save = now
+            data = {'identity': self.identity, 'completed': self.completed}
+            try:
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            except OSError:
+                pass
+
+    def remove(self):
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+class StreamCatalog:
+    """
+    一次playurl响应解析出的全部可用流
+    DASH响应包含所有清晰度和编码的音视频流，清晰度列表和下载链接都从这里读取，
+    不必为每个清晰度重复请求playurl
+    """
+
+    # codecid -> 编码简称
+    CODEC_NAMES = {7: 'avc', 12: 'hevc', 13: 'av1'}
+
+    def __init__(self, result):
+        self.result = result
+        self.quality = result.get('quality', 0)
+        self.accept_quality = result.get('accept_quality', [])
+        self.video = []
+        self.audio = []
+        self.durl = []
+
+        dash = result.get('dash')
+        self.is_dash = bool(dash)
+        self.duration = (dash or {}).get('duration') or result.get('timelength', 0) // 1000
+
+        if dash:
+            for stream in dash.get('video') or []:
+                self.video.append(self._parse_stream('video', stream))
+
+            for stream in self.dash_audio(dash):
+                self.audio.append(self._parse_stream('audio', stream))
+
+        for durl in result.get('durl') or []:
+            self.durl.append({
+                'kind': 'durl',
+                'id': self.quality,
+                'url': durl['url'],
+                'backup_urls': list(durl.get('backup_url') or []),
+                'size': durl.get('size', 0),
+                'length': durl.get('length', 0),
+                'duration': durl.get('length', 0) / 1000 or self.duration,
+            })
+
+        # 按 清晰度id -> [流, ...] 建立索引，保持接口返回的顺序
+        self.video_by_id = {}
+        for stream in self.video:
+            self.video_by_id.setdefault(stream['id'], []).append(stream)
+        self.audio_by_id = {}
+        for stream in self.audio:
+            self.audio_by_id.setdefault(stream['id'], []).append(stream)
+
+    @staticmethod
+    def dash_audio(dash):
+        """DASH响应中的全部音频流：普通音频，以及单独字段中的Hi-Res和杜比音频"""
+        audio_streams = list(dash.get('audio') or [])
+        flac = dash.get('flac') or {}
+        if flac.get('audio'):
+            audio_streams.append(flac['audio'])
+        dolby = dash.get('dolby') or {}
+        audio_streams.extend(dolby.get('audio') or [])
+        return audio_streams
+
+    def _parse_stream(self, kind, stream):
+        bandwidth = stream.get('bandwidth', 0)
+        codecs = stream.get('codecs', '')
+        segment_base = stream.get('segment_base') or stream.get('SegmentBase') or {}
+        return {
+            'kind': kind,
+            'id': stream['id'],
+            'codecs': codecs,
+            'codec': self.CODEC_NAMES.get(stream.get('codecid'), codecs.split('.')[0]),
+            'bandwidth': bandwidth,
+            'width': stream.get('width', 0),
+            'height': stream.get('height', 0),
+            'frame_rate': stream.get('frame_rate') or stream.get('frameRate', ''),
+            'mime_type': stream.get('mime_type') or stream.get('mimeType', ''),
+            'url': stream.get('baseUrl') or stream.get('base_url'),
+            'backup_urls': list(stream.get('backupUrl') or stream.get('backup_url') or []),
+            # DASH流不返回文件大小，按码率和时长估算
+            'size': bandwidth * self.duration // 8 if self.duration else 0,
+            'duration': self.duration,
+            'segment_base': {
+                'initialization': segment_base.get('initialization') or segment_base.get('Initialization', ''),
+                'index_range': segment_base.get('index_range') or segment_base.get('indexRange', ''),
+            },
+        }
+
+    def qualities(self, quality_map, audio_quality_map):
+        """
+        可用清晰度列表，格式与 get_available_qualities 的返回值相同
+        返回: (video_qualities, audio_qualities)
+        """
+        video_qualities = []
+        audio_qualities = []
+
+        if self.is_dash:
+            for stream in self.video:
+                if stream['id'] in quality_map:
+                    video_qualities.append({
+                        'id': stream['id'],
+                        'name': quality_map[stream['id']],
+                        'bandwidth': stream['bandwidth'],
+                        'codecs': stream['codecs'],
+                        'width': stream['width'],
+                        'height': stream['height']
+                    })
+
+            for stream in self.audio:
+                if stream['id'] in audio_quality_map:
+                    audio_qualities.append({
+                        'id': stream['id'],
+                        'name': audio_quality_map[stream['id']],
+                        'bandwidth': stream['bandwidth'],
+                        'codecs': stream['codecs']
+                    })
+
+            return video_qualities, audio_qualities
+
+        # 如果没有dash数据，返回传统格式
+        for qn in self.accept_quality:
+            if qn in quality_map:
+                video_qualities.append({
+                    'id': qn,
+                    'name': quality_map[qn],
+                    'bandwidth': 0,
+                    'codecs': '',
+                    'width': 0,
+                    'height': 0
+                })
+
+        return video_qualities, audio_qualities
+
+    def select_video(self, qn, codecs=None):
+        """选择匹配清晰度（及编码）的视频流，没有时返回最高清晰度"""
+        candidates = self.video_by_id.get(qn, [])
+        for stream in candidates:
+            if not codecs or stream['codecs'] == codecs:
+                return stream
+        if candidates:
+            return candidates[0]
+        return self.video[0] if self.video else None
+
+    def select_audio(self, audio_qn):
+        """选择匹配音质的音频流，没有时返回第一个音频流"""
+        candidates = self.audio_by_id.get(audio_qn)
+        if candidates:
+            return candidates[0]
+        return self.audio[0] if self.audio else None
+
+    def select_streams(self, qn=80, audio_qn=30280, codecs=None):
+        """
+        选出要下载的视频流和音频流
+        返回: (video_stream, audio_stream, error)
+        """
+        # 优先使用DASH格式（音视频分离）
+        if self.is_dash:
+            return self.select_video(qn, codecs), self.select_audio(audio_qn), None
+
+        # 传统格式（音视频合并）
+        if self.durl:
+            return self.durl[0], None, None
+
+        return None, None, "未找到可用的下载链接"
+
+    def download_urls(self, qn=80, audio_qn=30280, codecs=None):
+        """
+        选出下载链接
+        返回: (video_url, audio_url, video_size, audio_size, error)
+        """
+        video_stream, audio_stream, error = self.select_streams(qn, audio_qn, codecs)
+        if error:
+            return None, None, 0, 0, error
+
+        return (
+            video_stream['url'] if video_stream else None,
+            audio_stream['url'] if audio_stream else None,
+            video_stream['size'] if video_stream else 0,
+            audio_stream['size'] if audio_stream else 0,
+            None
+        )
+
+
+class MetadataCache:
+    """
+    接口元数据缓存
+    内存LRU + 可选的磁盘存储，按接口设置过期时间；
+    playurl的结果还会在CDN链接的deadline之前过期。
+    同一个key的并发请求会合并为一次实际请求
+    """
+
+    # 各接口默认缓存时间（秒）
+    DEFAULT_TTL = {
+        'view': 600,
+        'playurl': 1800,
+    }
+    # CDN链接到期前预留的时间（秒）
+    DEADLINE_MARGIN = 120
+
+    def __init__(self, max_entries=256, cache_dir=None, ttl=None, metrics=None):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.cache_dir = cache_dir
+        self.ttl = dict(self.DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+
+        self._entries = OrderedDict()  # key -> (expires, value)
+        # key -> {'event': Event, 'futures': [(事件循环, Future), ...], 'value': ..., 'error': ...}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(endpoint, params, user=''):
+        """缓存key：接口名 + 排序后的参数 + 登录用户（不同账号可见的清晰度不同）"""
+        query = '&'.join(f'{k}={params[k]}' for k in sorted(params))
+        return f'{endpoint}?{query}#{user}'
+
+    @staticmethod
+    def playurl_deadline(data):
+        """从playurl响应的CDN链接中取最早的deadline，没有时返回None"""
+        result = data.get('data') or {}
+        urls = []
+        dash = result.get('dash') or {}
+        for stream in (dash.get('video') or []) + StreamCatalog.dash_audio(dash):
+            urls.append(stream.get('baseUrl') or stream.get('base_url') or '')
+            urls.extend(stream.get('backupUrl') or stream.get('backup_url') or [])
+        for durl in result.get('durl') or []:
+            urls.append(durl.get('url', ''))
+
+        deadlines = []
+        for url in urls:
+            values = parse_qs(urlsplit(url).query).get('deadline')
+            if values and values[0].isdigit():
+                deadlines.append(int(values[0]))
+        return min(deadlines) if deadlines else None
+
+    def _expires(self, endpoint, data):
+        expires = time.time() + self.ttl.get(endpoint, 0)
+        if endpoint == 'playurl':
+            deadline = self.playurl_deadline(data)
+            if deadline:
+                expires = min(expires, deadline - self.DEADLINE_MARGIN)
+        return expires
+
+    def _disk_path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def get(self, key):
+        """读取未过期的缓存，未命中返回None（不计入统计）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['key'] == key and entry['expires'] > now:
+                self._remember(key, entry['expires'], entry['value'])
+                return entry['value']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def put(self, endpoint, key, value):
+        """写入缓存，只应传入接口成功的响应"""
+        expires = self._expires(endpoint, value)
+        if expires <= time.time():
+            return
+        self._remember(key, expires, value)
+
+        if self.cache_dir:
+            try:
+                path = self._disk_path(key)
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'expires': expires, 'value': value}, f,
+                              ensure_ascii=False)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass
+
+    def _remember(self, key, expires, value):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, endpoint, key, fetch):
+        """
+        读缓存，未命中时调用 fetch() 获取接口JSON；
+        同一key已有请求在进行时等待其结果而不是重复请求
+        """
+        value, waiter, leader = self._lookup(endpoint, key)
+        if waiter is None:
+            return value
+        if not leader:
+            waiter['event'].wait()
+            return self._result(waiter)
+
+        try:
+            value = fetch()
+            waiter['value'] = value
+            if isinstance(value, dict) and value.get('code') == 0:
+                self.put(endpoint, key, value)
+            return value
+        except Exception as e:
+            waiter['error'] = e
+            raise
+        finally:
+            self._release(key, waiter)
+
+    async def get_or_fetch_async(self, endpoint, key, fetch):
+        """
+        get_or_fetch 的异步版本，fetch 为协程函数；等待时不阻塞事件循环
+        与同步调用方共用同一张进行中请求表，同一key的请求无论来自哪个客户端都只发出一次
+        """
+        import asyncio
+
+        value, waiter, leader = self._lookup(endpoint, key)
+        if waiter is None:
+            return value
+        if not leader:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self._lock:
+                pending = not waiter['event'].is_set()
+                if pending:
+                    waiter['futures'].append((loop, future))
+            if pending:
+                await future
+            return self._result(waiter)
+
+        try:
+            value = await fetch()
+            waiter['value'] = value
+            if isinstance(value, dict) and value.get('code') == 0:
+                self.put(endpoint, key, value)
+            return value
+        except BaseException as e:
+            # 包括任务被取消，等待者收到同样的异常
+            waiter['error'] = e
+            raise
+        finally:
+            self._release(key, waiter)
+
+    def _lookup(self, endpoint, key):
+        """
+        查缓存并登记进行中的请求
+        返回: (缓存的值, None, False)；未命中时为 (None, 等待项, 是否由调用方发出请求)
+        """
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            self._record(endpoint, 'hit')
+            return value, None, False
+
+        with self._lock:
+            waiter = self._in_flight.get(key)
+            leader = waiter is None
+            if leader:
+                self.misses += 1
+                waiter = {'event': threading.Event(), 'futures': [], 'value': None,
+                          'error': None}
+                self._in_flight[key] = waiter
+            else:
+                self.coalesced += 1
+        self._record(endpoint, 'miss' if leader else 'coalesced')
+        return None, waiter, leader
+
+    def _release(self, key, waiter):
+        """请求结束：唤醒同步和异步的等待者"""
+        with self._lock:
+            del self._in_flight[key]
+            waiter['event'].set()
+            futures, waiter['futures'] = waiter['futures'], []
+        for loop, future in futures:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # 等待者的事件循环已经关闭
+                pass
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    @staticmethod
+    def _result(waiter):
+        if waiter['error']:
+            raise waiter['error']
+        return waiter['value']
+
+    def _record(self, endpoint, result):
+        if self.metrics is not None:
+            self.metrics.cache_lookups.inc(endpoint=endpoint, result=result)
+
+    def invalidate(self, key=None):
+        """删除指定key或全部内存缓存"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """命中/未命中/合并请求计数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'entries': len(self._entries),
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+class DownloadMetrics:
+    """
+    下载流程各阶段的指标（名称以 bili_ 开头），注册在 metrics 注册表中
+    同一进程内的多个 BilibiliAPI 实例共用同一组指标
+    """
+
+    def __init__(self, registry=None):
+        registry = registry or get_registry()
+        self.registry = registry
+        self.api_requests = registry.counter(
+            'bili_api_requests_total', "接口请求数（code为接口返回的错误码，error为请求失败）",
+            ('endpoint', 'code'))
+        self.api_seconds = registry.histogram(
+            'bili_api_request_seconds', "接口请求耗时（秒，包括重试）", ('endpoint',))
+        self.api_retries = registry.counter(
+            'bili_api_retries_total',
+            "接口请求的重试（rate_limited风控或429/server_error 5xx/network_error网络错误）",
+            ('endpoint', 'reason'))
+        self.api_rate_limit = registry.gauge(
+            'bili_api_rate_limit', "接口请求调度器当前的速率上限（请求/秒，0表示不限速）")
+        self.http_responses = registry.counter(
+            'bili_http_responses_total', "HTTP响应数（kind: api接口/cdn下载/probe镜像探测）",
+            ('kind', 'status'))
+        self.cache_lookups = registry.counter(
+            'bili_cache_lookups_total', "元数据缓存查询（hit命中/miss未命中/coalesced等待进行中的请求）",
+            ('endpoint', 'result'))
+        self.download_bytes = registry.counter(
+            'bili_download_bytes_total', "从CDN下载的字节数", ('host',))
+        self.download_retries = registry.counter(
+            'bili_download_retries_total', "分段下载的重试（error出错/slow过慢换镜像）", ('reason',))
+        self.transfer_seconds = registry.histogram(
+            'bili_transfer_seconds', "单个文件的下载耗时（秒）", ('mode',))
+        self.transfer_throughput = registry.histogram(
+            'bili_transfer_throughput_bytes_per_second', "单个文件的平均下载速度（字节/秒）",
+            ('mode',), buckets=THROUGHPUT_BUCKETS)
+        self.stage_seconds = registry.histogram(
+            'bili_stage_seconds', "下载任务各阶段耗时（秒）: playurl/download/stream/queue/process",
+            ('stage',))
+        self.jobs = registry.counter(
+            'bili_jobs_total', "下载任务数（按下载类型和结果）", ('type', 'result'))
+
+    def observe_transfer(self, mode, size, elapsed):
+        """记录一个文件的下载耗时和平均速度"""
+        self.transfer_seconds.observe(elapsed, mode=mode)
+        if elapsed > 0 and size > 0:
+            self.transfer_throughput.observe(size / elapsed, mode=mode)
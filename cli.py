@@ -0,0 +1,469 @@
+"""
+Bilibili视频下载器命令行模式
+无界面批量下载，适合服务器和定时任务使用
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
+from archive import DownloadArchive, file_sha256
+from bandwidth import parse_rate, parse_schedule
+from bilibili_api import BilibiliAPI
+from filewriter import FSYNC_POLICIES, FSYNC_CLOSE
+from listing import ordered_map
+from metrics import serve as serve_metrics
+from postprocess import PostProcessPool
+
+
+# 每批预取下载链接的任务数（任务按批从列表中取出，长列表不会一次全部展开）
+PREFETCH_BATCH = 32
+
+
+class JobJournal:
+    """
+    任务日志（JSON Lines，只追加）
+    每次状态变化写一行并立即落盘，崩溃后重新运行时据此跳过已完成的任务
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """读取每个任务最后一次记录的状态，忽略崩溃时写了一半的行"""
+        states = {}
+        if not os.path.exists(self.path):
+            return states
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                states[record['job']] = record
+        return states
+
+    def record(self, job, status, **fields):
+        """追加一条状态记录"""
+        record = {'job': job, 'status': status, 'time': time.time()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False)
+
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        return record
+
+
+def read_targets(args):
+    """合并命令行参数和列表文件中的视频地址，去重并保持顺序"""
+    targets = list(args.targets)
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    targets.append(line)
+    return list(dict.fromkeys(targets))
+
+
+def iter_targets(api, targets, on_error):
+    """
+    逐个产出视频地址：合集、收藏夹和UP主空间的地址展开为其中的视频（按需分页请求），
+    同一视频只产出一次；列表获取失败时调用 on_error(target, message)
+    """
+    seen = set()
+    for target in targets:
+        if api.parse_list_url(target) is None:
+            yield target
+            continue
+        try:
+            for item in api.iter_list(target):
+                bvid = item['bvid']
+                if bvid and bvid not in seen:
+                    seen.add(bvid)
+                    yield bvid
+        except Exception as e:
+            on_error(target, str(e))
+
+
+def explicit_pages(api, spec):
+    """
+    不需要知道视频总P数就能确定的页码列表（如 3、'1-5,8'）
+    'all'、'10-' 等依赖总P数的选择，以及无法解析的选择返回None
+    """
+    parts = [part.strip() for part in str(spec).replace('，', ',').split(',') if part.strip()]
+    if not parts or any(part.endswith('-') for part in parts):
+        return None
+    numbers = [int(n) for n in re.findall(r'\d+', str(spec))]
+    if not numbers:
+        return None
+    try:
+        return api.parse_page_spec(spec, max(numbers))
+    except ValueError:
+        return None
+
+
+def iter_jobs(api, targets, args, archive=None):
+    """
+    把视频地址展开为下载任务，多P视频按 --pages（或地址中的 ?p=）每个分P一个任务
+    archive: 下载存档，分P选择不依赖总P数且所选分P都已下载时直接产出这些任务，不再请求视频信息
+    逐个产出: {'id': 任务标识, 'target': 视频地址, 'page': 页码或None}
+    """
+    def expand(target):
+        spec = args.pages or api.parse_page_number(target)
+        if spec is None:
+            return [{'id': target, 'target': target, 'page': None}]
+
+        if archive is not None:
+            page_numbers = explicit_pages(api, spec)
+            if page_numbers:
+                jobs = [{'id': f"{target}#P{page}", 'target': target, 'page': page}
+                        for page in page_numbers]
+                # 之后由 skip_archived 跳过
+                if not skip_archived(api, archive, jobs, args)[0]:
+                    return jobs
+
+        video_info, error = api.get_video_info(target)
+        if error:
+            # 错误在执行任务时报告
+            return [{'id': target, 'target': target, 'page': None}]
+
+        pages, error = api.get_pages(video_info, spec)
+        if error or len(video_info.get('pages') or []) <= 1:
+            return [{'id': target, 'target': target, 'page': pages[0]['page'] if pages else None}]
+        return [{'id': f"{target}#P{page['page']}", 'target': target, 'page': page['page']}
+                for page in pages]
+
+    for jobs in ordered_map(expand, targets, api.PREFETCH_WORKERS):
+        yield from jobs
+
+
+def prefetch(api, jobs):
+    """并发获取所有任务的视频信息和下载链接，下载任务开始时直接使用缓存"""
+    def resolve(job):
+        video_info, error = api.get_video_info(job['target'])
+        if error:
+            return
+        pages, _ = api.get_pages(video_info, job['page'])
+        if pages:
+            api.get_stream_catalog(video_info['bvid'], pages[0]['cid'])
+
+    with ThreadPoolExecutor(max_workers=api.PREFETCH_WORKERS) as executor:
+        list(executor.map(resolve, jobs))
+
+
+def requested_quality(args):
+    """存档中比较的清晰度：仅音频时为音质"""
+    return args.audio_quality if args.type == 'audio_only' else args.quality
+
+
+def skip_archived(api, archive, jobs, args):
+    """
+    一次性查询存档，去掉已经下载过的任务（在获取视频信息和下载链接之前进行）
+    返回: (未下载的任务, 已下载的任务)
+    """
+    videos = []
+    for job in jobs:
+        video = dict(api.parse_video_params(job['target']) or {})
+        video['page'] = job['page']
+        videos.append(video)
+    existing = archive.find_existing(videos, args.type, args.format, requested_quality(args))
+    return ([job for i, job in enumerate(jobs) if i not in existing],
+            [job for i, job in enumerate(jobs) if i in existing])
+
+
+def archive_download(api, archive, video_info, cid, page, save_path, args):
+    """把完成的下载写入存档（实际清晰度和编码取自缓存的下载链接，不再请求网络）"""
+    video_stream, audio_stream, _ = api.select_streams(
+        video_info['bvid'], cid, args.quality, args.audio_quality
+    )
+    stream = audio_stream if args.type == 'audio_only' else video_stream
+    archive.record(
+        video_info['bvid'], cid,
+        stream['id'] if stream else requested_quality(args),
+        stream['codec'] if stream else '',
+        args.format, args.type, os.path.abspath(save_path),
+        aid=video_info.get('aid'), page=page,
+        requested_quality=requested_quality(args),
+        title=video_info['title'],
+        size=os.path.getsize(save_path),
+        sha256=file_sha256(save_path)
+    )
+
+
+def run_job(api, job, args, journal, output_lock, download_slot=None, archive=None):
+    """执行单个下载任务：获取视频信息、下载、后处理，并输出一行JSON结果"""
+    started = time.time()
+    timings = {}
+    target = job['target']
+    result = {'target': target}
+    journal.record(job['id'], 'running')
+
+    try:
+        # 获取视频信息
+        stage_started = time.time()
+        video_info, error = api.get_video_info(target)
+        timings['metadata'] = time.time() - stage_started
+        if error:
+            raise RuntimeError(error)
+
+        result['bvid'] = video_info['bvid']
+        result['title'] = video_info['title']
+
+        cid = video_info['cid']
+        page_number = 1
+        filename = api.make_filename(video_info['title'], args.format)
+        if job['page'] is not None:
+            pages, error = api.get_pages(video_info, job['page'])
+            if error:
+                raise RuntimeError(error)
+            page = pages[0]
+            cid = page['cid']
+            page_number = page['page']
+            result['page'] = page['page']
+            result['part'] = page.get('part', '')
+            page_count = len(video_info.get('pages') or pages)
+            if page_count > 1:
+                filename = api.make_page_filename(video_info['title'], page, page_count,
+                                                  args.format)
+
+        save_path = os.path.join(args.output_dir, filename)
+        result['output'] = save_path
+
+        success, message = api.download_video(
+            video_info['bvid'], cid, save_path,
+            args.type, args.format, args.quality, args.audio_quality,
+            streaming=not args.no_stream,
+            timings=timings,
+            download_slot=download_slot,
+            max_rate=args.job_rate
+        )
+        if not success:
+            raise RuntimeError(message)
+
+        result['status'] = 'done'
+        result['message'] = message
+        result['size'] = os.path.getsize(save_path)
+
+        if archive is not None:
+            stage_started = time.time()
+            archive_download(api, archive, video_info, cid, page_number, save_path, args)
+            timings['archive'] = time.time() - stage_started
+
+    except Exception as e:
+        result['status'] = 'failed'
+        result['message'] = str(e)
+
+    timings['total'] = time.time() - started
+    result['timings'] = {k: round(v, 3) for k, v in timings.items()}
+
+    journal.record(job['id'], result['status'], result=result)
+    with output_lock:
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+    return result
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Bilibili视频下载器（命令行批量模式）"
+    )
+    parser.add_argument('targets', nargs='*',
+                        help="视频URL或BV/av号，也可以是合集、收藏夹或UP主空间的地址")
+    parser.add_argument('-i', '--input', help="视频列表文件，每行一个地址或BV/av号")
+    parser.add_argument('-o', '--output-dir', default='.', help="输出目录（默认当前目录）")
+    parser.add_argument('-t', '--type', default='merged',
+                        choices=['merged', 'video_only', 'audio_only'], help="下载类型")
+    parser.add_argument('-f', '--format', default=None,
+                        help="输出格式：mp4/flv 或 mp3/flac/wav/m4a/aac")
+    parser.add_argument('-q', '--quality', type=int, default=127,
+                        help="视频清晰度代码，不可用时自动选择最高清晰度（默认127）")
+    parser.add_argument('-a', '--audio-quality', type=int, default=30280,
+                        help="音频质量代码（默认30280 Hi-Res）")
+    parser.add_argument('-p', '--pages', default=None,
+                        help="多P视频下载的分P，如 all、1-5,8（默认按地址中的 ?p=，没有时只下载第一P）")
+    parser.add_argument('-j', '--jobs', type=int, default=3, help="同时进行的任务数（默认3）")
+    parser.add_argument('--journal', help="任务日志路径（默认为输出目录下的 .bili_journal.jsonl）")
+    parser.add_argument('--force', action='store_true',
+                        help="忽略任务日志和下载存档，重新下载全部任务")
+    parser.add_argument('--archive', help="下载存档路径（默认为输出目录下的 .bili_archive.db）")
+    parser.add_argument('--no-archive', action='store_true', help="不使用下载存档")
+    parser.add_argument('--archive-report', action='store_true',
+                        help="输出下载存档的统计信息（JSON）后退出")
+    parser.add_argument('--no-stream', action='store_true', help="不使用流式处理，先下载临时文件")
+    parser.add_argument('--no-login', action='store_true', help="不加载保存的登录状态")
+    parser.add_argument('--login-check-interval', type=float, default=None, metavar='HOURS',
+                        help="距上次验证不超过该小时数时不再验证保存的登录状态"
+                             f"（默认{BilibiliAPI.LOGIN_VALIDATE_INTERVAL // 3600}，0表示每次都验证）")
+    parser.add_argument('--cache-dir', help="视频信息和下载链接的磁盘缓存目录")
+    parser.add_argument('--ffmpeg', help="ffmpeg可执行文件路径（默认自动查找）")
+    parser.add_argument('--fsync', default=FSYNC_CLOSE, choices=FSYNC_POLICIES,
+                        help="下载文件的落盘策略：never 不主动落盘，close 完成时落盘（默认），"
+                             "checkpoint 每次记录断点前落盘")
+    parser.add_argument('--limit-rate', type=parse_rate, default=None,
+                        help="所有任务合计的下载速度上限，如 10M、500K（默认不限速）")
+    parser.add_argument('--job-rate', type=parse_rate, default=None,
+                        help="单个任务的下载速度上限")
+    parser.add_argument('--schedule', type=parse_schedule, default=None,
+                        help="按时段限速，如 09:00-18:00=2M,18:00-23:00=10M（时段外使用 --limit-rate）")
+    parser.add_argument('--api-rate', type=float, default=None,
+                        help="接口请求速率上限（请求/秒，默认不限；被风控时都会自动降速）")
+    parser.add_argument('--cpu-budget', type=int, default=None,
+                        help="后处理（合并/转码）可占用的CPU核数（默认全部核数）")
+    parser.add_argument('--ffmpeg-threads', type=int, default=1,
+                        help="每个转码任务的ffmpeg线程数（默认1）")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="全部任务结束后把运行指标写入文件（.prom 为Prometheus文本格式，否则为JSON）")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="在该端口提供Prometheus抓取地址 /metrics（仅监听127.0.0.1）")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.format is None:
+        args.format = 'mp3' if args.type == 'audio_only' else 'mp4'
+
+    archive_path = args.archive or os.path.join(args.output_dir, '.bili_archive.db')
+    if args.archive_report:
+        if not os.path.exists(archive_path):
+            parser.error(f"下载存档不存在: {archive_path}")
+        archive = DownloadArchive(archive_path)
+        try:
+            print(json.dumps(archive.summary(), ensure_ascii=False, indent=2))
+        finally:
+            archive.close()
+        return 0
+
+    targets = read_targets(args)
+    if not targets:
+        parser.error("请提供至少一个视频URL或BV/av号")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    journal = JobJournal(args.journal or os.path.join(args.output_dir, '.bili_journal.jsonl'))
+    archive = None if args.no_archive else DownloadArchive(archive_path)
+
+    api = BilibiliAPI(cache_dir=args.cache_dir)
+    api.ffmpeg_path = args.ffmpeg
+    api.fsync_policy = args.fsync
+    api.bandwidth.set_rate(args.limit_rate)
+    api.bandwidth.set_schedule(args.schedule)
+    api.scheduler.set_max_rate(args.api_rate)
+    # 下载和后处理分为两个阶段：最多 jobs 个任务同时下载，下载完的任务排队等待后处理
+    pool = PostProcessPool(args.cpu_budget, args.ffmpeg_threads)
+    api.postprocess_pool = pool
+    download_slot = threading.BoundedSemaphore(max(1, args.jobs))
+    if not args.no_login:
+        if args.login_check_interval is not None:
+            api.login_validate_interval = args.login_check_interval * 3600
+        def on_login_checked(valid, message):
+            if not valid:
+                print(message, file=sys.stderr)
+
+        # 登录验证在后台进行，失效时清除登录状态并提示，任务不等待验证结果
+        success, message = api.load_login_state(on_login_checked)
+        print(message, file=sys.stderr)
+    if args.metrics_port is not None:
+        server = serve_metrics(api.metrics.registry, args.metrics_port)
+        print(f"运行指标: http://127.0.0.1:{server.server_port}/metrics", file=sys.stderr)
+
+    output_lock = threading.Lock()
+    counts = {'failed': 0, 'skipped': 0, 'archived': 0}
+
+    def list_failed(target, message):
+        counts['failed'] += 1
+        result = {'target': target, 'status': 'failed', 'message': message}
+        with output_lock:
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    # 跳过日志中已完成的任务，未完成的（包括崩溃时正在运行的）重新执行
+    states = {} if args.force else journal.load()
+
+    def pending_jobs():
+        jobs = iter_jobs(api, iter_targets(api, targets, list_failed), args,
+                         None if args.force else archive)
+        for job in jobs:
+            if states.get(job['id'], {}).get('status') == 'done':
+                counts['skipped'] += 1
+                continue
+            yield job
+
+    def collect(futures):
+        for future in futures:
+            if future.result()['status'] != 'done':
+                counts['failed'] += 1
+
+    # 任务按批取出并预取下载链接，同时提交的任务数有上限，列表再长内存占用也保持平稳
+    workers = max(1, args.jobs) + pool.workers
+    jobs = pending_jobs()
+    running = set()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(islice(jobs, PREFETCH_BATCH))
+                if not batch:
+                    break
+                if archive is not None and not args.force:
+                    batch, archived = skip_archived(api, archive, batch, args)
+                    counts['archived'] += len(archived)
+                for job in batch:
+                    journal.record(job['id'], 'pending')
+                prefetch(api, batch)
+
+                for job in batch:
+                    if len(running) >= workers * 2:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    running.add(executor.submit(run_job, api, job, args, journal, output_lock,
+                                                download_slot, archive))
+            collect(running)
+    finally:
+        # 批处理中出错时也要结束后处理工作池并关闭存档
+        pool.shutdown()
+        if archive is not None:
+            archive.close()
+
+    stats = pool.stats()
+    print(
+        f"后处理: 完成 {stats['completed']} 个，失败 {stats['failed']} 个，"
+        f"最大排队 {stats['max_queued']} 个，平均编码耗时 {stats['avg_encode_time']:.2f} 秒"
+        f"（{stats['workers']} 个工作线程 × {stats['threads_per_job']} 线程）",
+        file=sys.stderr
+    )
+
+    if args.metrics:
+        api.metrics.registry.write(args.metrics)
+
+    pools = api.transport.stats()
+    for name, label in (('api', '接口'), ('cdn', 'CDN')):
+        hosts = pools[name].values()
+        print(f"{label}连接池: {sum(h['requests'] for h in hosts)} 次请求，"
+              f"新建 {sum(h.get('connections', 0) for h in hosts)} 个连接（{len(hosts)} 个主机）",
+              file=sys.stderr)
+
+    requests_stats = api.scheduler.stats()
+    if requests_stats['retries'] or requests_stats['rate_limited']:
+        rate = f"{requests_stats['rate']:g} 次/秒" if requests_stats['rate'] else "不限"
+        print(f"接口请求: 被限制 {requests_stats['rate_limited']} 次，"
+              f"重试 {requests_stats['retries']} 次，当前速率上限 {rate}", file=sys.stderr)
+
+    if counts['skipped']:
+        print(f"跳过 {counts['skipped']} 个已完成的任务", file=sys.stderr)
+    if counts['archived']:
+        print(f"跳过 {counts['archived']} 个已在下载存档中的任务", file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
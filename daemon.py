@@ -0,0 +1,742 @@
+"""
+Bilibili视频下载器服务模式
+常驻进程，在本地提供HTTP/JSON接口：提交下载任务、查询状态和进度、取消任务、订阅任务事件（SSE）
+所有任务共用一个 BilibiliAPI：连接池、元数据缓存和登录状态在任务之间保持，任务不再有启动开销
+
+接口（默认只监听127.0.0.1，设置 --token 后需要 Authorization: Bearer <token>）:
+    POST   /jobs               提交任务，JSON: {"url" 或 "urls", "type", "format", "quality",
+                               "audio_quality", "pages", "output_dir", "job_rate", "force"}
+                               立即返回提交记录（202），地址在后台展开，展开出的任务陆续加入队列
+                               output_dir 为服务输出目录（-o）下的子目录，不能超出该目录
+    GET    /jobs               任务列表（?status=running 按状态、?submission=<id> 按提交筛选）
+    GET    /jobs/<id>          任务详情
+    DELETE /jobs/<id>          取消任务（也可以 POST /jobs/<id>/cancel）
+    GET    /submissions        提交记录列表
+    GET    /submissions/<id>   提交记录：展开状态、已加入的任务和展开时的错误
+    DELETE /submissions/<id>   停止展开并取消该提交的所有任务（也可以 POST /submissions/<id>/cancel）
+    GET    /events             任务事件流（text/event-stream，?since=序号 补发之前的事件，?job=<id> 只看一个任务）
+    GET    /status             服务状态：登录、任务数、接口调度、连接池、缓存
+    GET    /metrics            运行指标（Prometheus文本格式，/metrics.json 为JSON）
+
+用法: python main.py serve --port 8765 -o downloads
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from archive import DownloadArchive
+from bandwidth import parse_rate
+from bilibili_api import BilibiliAPI
+from cli import (PREFETCH_BATCH, archive_download, build_parser, iter_jobs, iter_targets,
+                 skip_archived)
+from postprocess import PostProcessPool
+
+
+# 任务状态（提交记录另有 EXPANDING：正在展开地址）
+EXPANDING = 'expanding'
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ARCHIVED = 'archived'
+FINISHED = {DONE, FAILED, CANCELLED, ARCHIVED}
+
+# 提交任务时可以设置的选项（名称同命令行参数），未设置的取命令行的默认值
+JOB_OPTIONS = ('type', 'format', 'quality', 'audio_quality', 'pages', 'job_rate')
+
+
+class EventLog:
+    """
+    任务事件（带递增序号），保留最近的 maxlen 条
+    订阅者按序号等待新事件，断线重连时用上次收到的序号补发
+    """
+
+    def __init__(self, maxlen=10000):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=maxlen)
+        self._seq = 0
+
+    def publish(self, event, job_id, **data):
+        with self._cond:
+            self._seq += 1
+            self._events.append({'seq': self._seq, 'time': time.time(), 'event': event,
+                                 'job': job_id, 'data': data})
+            self._cond.notify_all()
+
+    @property
+    def last_seq(self):
+        with self._cond:
+            return self._seq
+
+    def wait(self, since, timeout=None):
+        """返回序号大于 since 的事件，没有时最多等待 timeout 秒"""
+        with self._cond:
+            if self._seq <= since:
+                self._cond.wait(timeout)
+            return [event for event in self._events if event['seq'] > since]
+
+
+class Job:
+    """一个下载任务（一个视频或一个分P）"""
+
+    # 进度事件的最小间隔（秒），避免高速下载时刷屏
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, spec, options, output_dir, submission=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.submission = submission
+        self.target = spec['target']
+        self.page = spec['page']
+        self.options = options
+        self.output_dir = output_dir
+        self.status = QUEUED
+        self.message = ''
+        self.progress = {'percent': 0.0, 'downloaded': 0, 'total': 0, 'stage': ''}
+        self.result = {}
+        self.timings = {}
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self._last_progress = 0.0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'submission': self.submission,
+            'target': self.target,
+            'page': self.page,
+            'status': self.status,
+            'message': self.message,
+            'progress': dict(self.progress),
+            'result': dict(self.result),
+            'timings': {k: round(v, 3) for k, v in self.timings.items()},
+            'options': {name: getattr(self.options, name) for name in JOB_OPTIONS},
+            'output_dir': self.output_dir,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class Submission:
+    """一次提交：地址在后台逐批展开为任务"""
+
+    def __init__(self, targets, options, output_dir):
+        self.id = uuid.uuid4().hex[:12]
+        self.targets = targets
+        self.options = options
+        self.output_dir = output_dir
+        self.status = EXPANDING
+        self.message = ''
+        self.job_ids = []
+        self.archived = 0
+        self.errors = []
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'targets': list(self.targets),
+            'jobs': list(self.job_ids),
+            'archived': self.archived,
+            'errors': list(self.errors),
+            'options': {name: getattr(self.options, name) for name in JOB_OPTIONS},
+            'output_dir': self.output_dir,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """
+    任务队列：最多 jobs 个任务同时下载，下载完的任务在后处理工作池中排队
+    已结束的任务保留最近的 keep_finished 个供查询
+    提交的地址由 expand_workers 个线程在后台展开，HTTP请求不等待合集、收藏夹的分页和分P查询
+    """
+
+    EXPAND_WORKERS = 2
+    # 提交的分P选择中允许的最大页码（在知道总P数之前检查格式时使用）
+    MAX_PAGE = 10000
+
+    def __init__(self, api, output_dir, jobs=3, archive=None, keep_finished=1000):
+        self.api = api
+        self.output_dir = output_dir
+        self.archive = archive
+        self.keep_finished = keep_finished
+        self.events = EventLog()
+        self.defaults = build_parser().parse_args([])
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._submissions = OrderedDict()
+        self.expander = ThreadPoolExecutor(max_workers=self.EXPAND_WORKERS,
+                                           thread_name_prefix='expand')
+        self.download_slot = threading.BoundedSemaphore(max(1, jobs))
+        workers = max(1, jobs) + (api.postprocess_pool.workers if api.postprocess_pool else 0)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def make_options(self, request):
+        """把提交的JSON转为任务选项（与命令行参数同名），取值不合法时抛出ValueError"""
+        options = argparse.Namespace(**vars(self.defaults))
+        for name in JOB_OPTIONS:
+            value = request.get(name)
+            if value is None:
+                continue
+            # JSON中的 true/false 在Python中是int的子类，需要单独排除
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)) or \
+                    (not isinstance(value, str) and value < 0):
+                raise ValueError(f"选项 {name} 应为字符串或非负数")
+            setattr(options, name, value)
+        if options.type not in ('merged', 'video_only', 'audio_only'):
+            raise ValueError(f"不支持的下载类型: {options.type}")
+        if options.format is not None and not re.fullmatch(r'[A-Za-z0-9]+', str(options.format)):
+            # 格式用作文件扩展名，不能带路径分隔符
+            raise ValueError(f"不支持的输出格式: {options.format}")
+        try:
+            options.quality = int(options.quality)
+            options.audio_quality = int(options.audio_quality)
+        except (TypeError, ValueError):
+            raise ValueError("清晰度和音质应为整数代码")
+        options.job_rate = parse_rate(options.job_rate)
+        if options.format is None:
+            options.format = 'mp3' if options.type == 'audio_only' else 'mp4'
+        if options.pages is not None:
+            options.pages = str(options.pages)
+            self.check_page_spec(options.pages)
+        options.force = bool(request.get('force'))
+        return options
+
+    def check_page_spec(self, spec):
+        """在不知道总P数的情况下检查分P选择的格式，无法识别或页码超过 MAX_PAGE 时抛出ValueError"""
+        numbers = [int(n) for n in re.findall(r'\d+', spec)]
+        page_count = max(numbers, default=1)
+        if page_count > self.MAX_PAGE:
+            raise ValueError(f"分P页码超出范围: {spec}")
+        self.api.parse_page_spec(spec, page_count)
+
+    def resolve_output_dir(self, requested):
+        """
+        提交的输出目录：相对于服务的输出目录解析（符号链接解析后再比较）
+        超出服务的输出目录时抛出ValueError
+        """
+        if not requested:
+            return self.output_dir
+        if not isinstance(requested, str):
+            raise ValueError("output_dir 应为字符串")
+        root = os.path.realpath(self.output_dir)
+        path = os.path.realpath(os.path.join(root, requested))
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError(f"输出目录必须位于服务的输出目录之内: {requested}")
+        return path
+
+    def submit(self, request):
+        """
+        提交任务：检查选项后立即返回提交记录，地址在后台展开
+        合集、收藏夹和UP主空间的地址展开为其中的视频，多P视频按 pages 每个分P一个任务
+        选项不合法时抛出ValueError
+        """
+        targets = request.get('urls') or ([request['url']] if request.get('url') else [])
+        if isinstance(targets, str):
+            targets = [targets]
+        if not isinstance(targets, list) or not all(isinstance(t, str) for t in targets):
+            raise ValueError("url 应为字符串，urls 应为字符串列表")
+        targets = [target.strip() for target in targets if target.strip()]
+        if not targets:
+            raise ValueError("请提供 url 或 urls")
+        options = self.make_options(request)
+        output_dir = self.resolve_output_dir(request.get('output_dir'))
+        os.makedirs(output_dir, exist_ok=True)
+
+        submission = Submission(targets, options, output_dir)
+        with self._lock:
+            self._submissions[submission.id] = submission
+        self.events.publish('submitted', None, submission=submission.id, targets=len(targets))
+        self.expander.submit(self._expand, submission)
+        return submission
+
+    def _expand(self, submission):
+        """展开提交的地址（在展开线程中）：每展开一批就跳过已存档的任务并加入队列"""
+        options = submission.options
+        archive = None if options.force else self.archive
+
+        def list_failed(target, message):
+            error = {'target': target, 'message': message}
+            submission.errors.append(error)
+            self.events.publish('list_failed', None, submission=submission.id, **error)
+
+        specs = iter_jobs(self.api, iter_targets(self.api, submission.targets, list_failed),
+                          options, archive)
+        status, message = DONE, ''
+        try:
+            while not submission.cancel_event.is_set():
+                batch = list(islice(specs, PREFETCH_BATCH))
+                if not batch:
+                    break
+                archived = []
+                if archive is not None:
+                    batch, archived = skip_archived(self.api, archive, batch, options)
+                for spec in batch:
+                    job = self._add_job(submission, spec)
+                    if job.cancel_event.is_set():
+                        # 提交在这一批展开期间被取消
+                        self._finish(job, CANCELLED, "已取消")
+                    else:
+                        job.future = self.executor.submit(self._run, job)
+                for spec in archived:
+                    self._finish(self._add_job(submission, spec), ARCHIVED, "已在下载存档中")
+                submission.archived += len(archived)
+                self._prune()
+            if submission.cancel_event.is_set():
+                status, message = CANCELLED, "已取消"
+        except Exception as e:
+            status, message = FAILED, f"展开地址出错: {e}"
+        finally:
+            specs.close()
+
+        submission.status = status
+        submission.message = message
+        submission.finished = time.time()
+        self.events.publish('expanded', None, submission=submission.id, status=status,
+                            message=message, jobs=len(submission.job_ids),
+                            archived=submission.archived, errors=len(submission.errors))
+
+    def _add_job(self, submission, spec):
+        job = Job(spec, submission.options, submission.output_dir, submission.id)
+        with self._lock:
+            self._jobs[job.id] = job
+            submission.job_ids.append(job.id)
+        if submission.cancel_event.is_set():
+            job.cancel_event.set()
+        self.events.publish('queued', job.id, submission=submission.id, target=job.target,
+                            page=job.page)
+        return job
+
+    def get_submission(self, submission_id):
+        with self._lock:
+            return self._submissions.get(submission_id)
+
+    def list_submissions(self):
+        with self._lock:
+            return list(self._submissions.values())
+
+    def cancel_submission(self, submission_id):
+        """停止展开并取消该提交中所有未结束的任务"""
+        submission = self.get_submission(submission_id)
+        if submission is None:
+            return None
+        submission.cancel_event.set()
+        with self._lock:
+            job_ids = list(submission.job_ids)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        return submission
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self, status=None, submission=None):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in jobs if (status is None or job.status == status) and
+                (submission is None or job.submission == submission)]
+
+    def cancel(self, job_id):
+        """取消任务：排队中的任务直接取消，运行中的任务尽快停止（保留断点）"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.status in FINISHED:
+            return job
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, CANCELLED, "已取消")
+        return job
+
+    def counts(self):
+        counts = {}
+        for job in self.list_jobs():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED]
+            for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self._jobs[job_id]
+            expanded = [submission_id for submission_id, submission in self._submissions.items()
+                        if submission.status != EXPANDING]
+            for submission_id in expanded[:max(0, len(expanded) - self.keep_finished)]:
+                del self._submissions[submission_id]
+
+    def _finish(self, job, status, message, **fields):
+        job.status = status
+        job.message = message
+        job.finished = time.time()
+        self.events.publish(status, job.id, message=message, **fields)
+
+    def _progress_callback(self, job):
+        def callback(percent, downloaded, total, desc=""):
+            job.progress = {'percent': round(percent, 1), 'downloaded': downloaded,
+                            'total': total, 'stage': desc}
+            now = time.monotonic()
+            if now - job._last_progress >= job.PROGRESS_INTERVAL or percent >= 100:
+                job._last_progress = now
+                self.events.publish('progress', job.id, **job.progress)
+        return callback
+
+    def _run(self, job):
+        """执行任务（在工作线程中）：获取视频信息、下载、后处理，并写入下载存档"""
+        if job.cancel_event.is_set():
+            self._finish(job, CANCELLED, "已取消")
+            return
+        api = self.api
+        options = job.options
+        job.status = RUNNING
+        job.started = time.time()
+        self.events.publish('started', job.id)
+
+        try:
+            started = time.time()
+            video_info, error = api.get_video_info(job.target)
+            job.timings['metadata'] = time.time() - started
+            if error:
+                raise RuntimeError(error)
+            job.result.update(bvid=video_info['bvid'], title=video_info['title'])
+
+            cid = video_info['cid']
+            page_number = 1
+            filename = api.make_filename(video_info['title'], options.format)
+            if job.page is not None:
+                pages, error = api.get_pages(video_info, job.page)
+                if error:
+                    raise RuntimeError(error)
+                page = pages[0]
+                cid = page['cid']
+                page_number = page['page']
+                job.result.update(page=page['page'], part=page.get('part', ''))
+                page_count = len(video_info.get('pages') or pages)
+                if page_count > 1:
+                    filename = api.make_page_filename(video_info['title'], page, page_count,
+                                                      options.format)
+
+            save_path = os.path.join(job.output_dir, filename)
+            job.result['output'] = save_path
+
+            success, message = api.download_video(
+                video_info['bvid'], cid, save_path,
+                options.type, options.format, options.quality, options.audio_quality,
+                progress_callback=self._progress_callback(job),
+                streaming=not options.no_stream,
+                cancel_event=job.cancel_event,
+                timings=job.timings,
+                download_slot=self.download_slot,
+                max_rate=options.job_rate
+            )
+            if job.cancel_event.is_set():
+                self._finish(job, CANCELLED, "已取消")
+                return
+            if not success:
+                raise RuntimeError(message)
+
+            job.result['size'] = os.path.getsize(save_path)
+            if self.archive is not None:
+                started = time.time()
+                archive_download(api, self.archive, video_info, cid, page_number, save_path,
+                                 options)
+                job.timings['archive'] = time.time() - started
+            self._finish(job, DONE, message, output=save_path, size=job.result['size'])
+
+        except Exception as e:
+            self._finish(job, FAILED, str(e))
+        finally:
+            self._prune()
+
+    def shutdown(self):
+        """停止展开地址，取消所有未结束的任务并等待工作线程退出"""
+        for submission in self.list_submissions():
+            submission.cancel_event.set()
+        self.expander.shutdown(wait=True)
+        for job in self.list_jobs():
+            if job.status not in FINISHED:
+                self.cancel(job.id)
+        self.executor.shutdown(wait=True)
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 事件流中没有新事件时发送注释行的间隔（秒），保持连接并及时发现客户端断开
+    KEEPALIVE_INTERVAL = 15
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        self.send_json({'error': message}, status)
+
+    def authorized(self):
+        token = self.server.token
+        authorization = self.headers.get('Authorization') or ''
+        if not token or hmac.compare_digest(authorization.encode('utf-8'),
+                                            f'Bearer {token}'.encode('utf-8')):
+            return True
+        self.send_error_json(401, "需要有效的访问令牌")
+        return False
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length < 0:
+            raise ValueError("Content-Length 无效")
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        if not isinstance(body, dict):
+            raise ValueError("请求体应为JSON对象")
+        return body
+
+    def route(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        return [p for p in parts.path.split('/') if p], query
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path, query = self.route()
+        manager = self.server.manager
+
+        if path == ['jobs']:
+            jobs = manager.list_jobs(query.get('status'), query.get('submission'))
+            return self.send_json({'jobs': [job.to_dict() for job in jobs]})
+        if len(path) == 2 and path[0] == 'jobs':
+            job = manager.get(path[1])
+            if job is None:
+                return self.send_error_json(404, "任务不存在")
+            return self.send_json(job.to_dict())
+        if path == ['submissions']:
+            return self.send_json({'submissions': [submission.to_dict()
+                                                   for submission in manager.list_submissions()]})
+        if len(path) == 2 and path[0] == 'submissions':
+            submission = manager.get_submission(path[1])
+            if submission is None:
+                return self.send_error_json(404, "提交记录不存在")
+            return self.send_json(submission.to_dict())
+        if path == ['events']:
+            return self.stream_events(query)
+        if path == ['status']:
+            return self.send_json(self.server.status())
+        if path == ['metrics']:
+            return self.send_text(manager.api.metrics.registry.to_prometheus(),
+                                  'text/plain; version=0.0.4; charset=utf-8')
+        if path == ['metrics.json']:
+            return self.send_text(manager.api.metrics.registry.to_json(),
+                                  'application/json; charset=utf-8')
+        self.send_error_json(404, "未知的地址")
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        path, _ = self.route()
+        manager = self.server.manager
+
+        if path == ['jobs']:
+            try:
+                submission = manager.submit(self.read_json())
+            except (TypeError, ValueError) as e:
+                return self.send_error_json(400, str(e))
+            return self.send_json(submission.to_dict(), 202)
+        if len(path) == 3 and path[0] == 'jobs' and path[2] == 'cancel':
+            return self.cancel(path[1])
+        if len(path) == 3 and path[0] == 'submissions' and path[2] == 'cancel':
+            return self.cancel_submission(path[1])
+        self.send_error_json(404, "未知的地址")
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        path, _ = self.route()
+        if len(path) == 2 and path[0] == 'jobs':
+            return self.cancel(path[1])
+        if len(path) == 2 and path[0] == 'submissions':
+            return self.cancel_submission(path[1])
+        self.send_error_json(404, "未知的地址")
+
+    def cancel(self, job_id):
+        job = self.server.manager.cancel(job_id)
+        if job is None:
+            return self.send_error_json(404, "任务不存在")
+        self.send_json(job.to_dict())
+
+    def cancel_submission(self, submission_id):
+        submission = self.server.manager.cancel_submission(submission_id)
+        if submission is None:
+            return self.send_error_json(404, "提交记录不存在")
+        self.send_json(submission.to_dict())
+
+    def send_text(self, text, content_type):
+        data = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream_events(self, query):
+        """Server-Sent Events：每个事件一条，id 为事件序号（重连时浏览器会带上 Last-Event-ID）"""
+        events = self.server.manager.events
+        since = query.get('since') or self.headers.get('Last-Event-ID')
+        since = int(since) if since and since.isdigit() else events.last_seq
+        job_id = query.get('job')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            while not self.server.stopping.is_set():
+                batch = events.wait(since, self.KEEPALIVE_INTERVAL)
+                if not batch:
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+                for event in batch:
+                    since = event['seq']
+                    if job_id and event['job'] != job_id:
+                        continue
+                    data = json.dumps(event, ensure_ascii=False)
+                    self.wfile.write(f"id: {event['seq']}\nevent: {event['event']}\n"
+                                     f"data: {data}\n\n".encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端断开
+            pass
+
+
+class DownloadDaemon(ThreadingHTTPServer):
+    """服务模式的HTTP服务器，持有任务队列和共用的 BilibiliAPI"""
+
+    daemon_threads = True
+
+    def __init__(self, manager, host='127.0.0.1', port=8765, token=None):
+        super().__init__((host, port), DaemonHandler)
+        self.manager = manager
+        self.token = token
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+    def status(self):
+        api = self.manager.api
+        pool = api.postprocess_pool
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'logged_in': api.is_logged_in,
+            'jobs': self.manager.counts(),
+            'last_event': self.manager.events.last_seq,
+            'scheduler': api.scheduler.stats(),
+            'cache': api.cache.stats(),
+            'pools': api.transport.stats(),
+            'postprocess': pool.stats() if pool is not None else None,
+        }
+
+    def shutdown(self):
+        self.stopping.set()
+        super().shutdown()
+
+
+def build_daemon_parser():
+    parser = argparse.ArgumentParser(prog="main.py serve", description="Bilibili视频下载器（服务模式）")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认127.0.0.1）")
+    parser.add_argument('--port', type=int, default=8765, help="监听端口（默认8765）")
+    parser.add_argument('--token', default=os.environ.get('BILI_DAEMON_TOKEN'),
+                        help="访问令牌（也可以用环境变量 BILI_DAEMON_TOKEN 设置）")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="输出目录，提交的 output_dir 只能是其中的子目录（默认当前目录）")
+    parser.add_argument('-j', '--jobs', type=int, default=3, help="同时下载的任务数（默认3）")
+    parser.add_argument('--archive', help="下载存档路径（默认为输出目录下的 .bili_archive.db）")
+    parser.add_argument('--no-archive', action='store_true', help="不使用下载存档")
+    parser.add_argument('--no-login', action='store_true', help="不加载保存的登录状态")
+    parser.add_argument('--cache-dir', help="视频信息和下载链接的磁盘缓存目录")
+    parser.add_argument('--ffmpeg', help="ffmpeg可执行文件路径（默认自动查找）")
+    parser.add_argument('--limit-rate', type=parse_rate, default=None,
+                        help="所有任务合计的下载速度上限，如 10M、500K（默认不限速）")
+    parser.add_argument('--api-rate', type=float, default=None,
+                        help="接口请求速率上限（请求/秒，默认不限；被风控时都会自动降速）")
+    parser.add_argument('--cpu-budget', type=int, default=None,
+                        help="后处理（合并/转码）可占用的CPU核数（默认全部核数）")
+    parser.add_argument('--ffmpeg-threads', type=int, default=1,
+                        help="每个转码任务的ffmpeg线程数（默认1）")
+    return parser
+
+
+def main(argv=None):
+    args = build_daemon_parser().parse_args(argv)
+    if args.host not in ('127.0.0.1', 'localhost', '::1') and not args.token:
+        print("警告: 监听非本机地址且未设置 --token，任何人都可以提交任务", file=sys.stderr)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    archive = None
+    if not args.no_archive:
+        archive = DownloadArchive(args.archive or
+                                  os.path.join(args.output_dir, '.bili_archive.db'))
+
+    api = BilibiliAPI(cache_dir=args.cache_dir)
+    api.ffmpeg_path = args.ffmpeg
+    api.bandwidth.set_rate(args.limit_rate)
+    api.scheduler.set_max_rate(args.api_rate)
+    pool = PostProcessPool(args.cpu_budget, args.ffmpeg_threads)
+    api.postprocess_pool = pool
+    if not args.no_login:
+        def on_login_checked(valid, message):
+            if not valid:
+                print(message, file=sys.stderr)
+
+        success, message = api.load_login_state(on_login_checked)
+        print(message, file=sys.stderr)
+
+    manager = JobManager(api, args.output_dir, args.jobs, archive)
+    server = DownloadDaemon(manager, args.host, args.port, args.token)
+    print(f"服务已启动: http://{args.host}:{server.server_port}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+        manager.shutdown()
+        pool.shutdown()
+        if archive is not None:
+            archive.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,53 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, scrolledtext
 from PIL import Image, ImageTk
 import threading
+import queue
 import os
 from bilibili_api import BilibiliAPI
 
 
+class ProgressChannel:
+    """
+    工作线程到界面的进度通道
+    工作线程调用 update 只记录最新的进度，界面线程按固定间隔取出并刷新，
+    多次更新合并为一次；post 把任意操作（如弹窗）转交界面线程执行
+    Tk控件只能在主循环所在的线程中操作
+    """
+
+    def __init__(self, root, handler, interval=100):
+        self.root = root
+        self.handler = handler
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._latest = None
+        self._calls = queue.Queue()
+        self.root.after(self.interval, self._poll)
+
+    def update(self, *args):
+        """记录最新进度（可在任意线程调用，开销很小）"""
+        with self._lock:
+            self._latest = args
+
+    def post(self, func, *args):
+        """在界面线程中执行 func(*args)"""
+        self._calls.put((func, args))
+
+    def _poll(self):
+        with self._lock:
+            latest, self._latest = self._latest, None
+        if latest is not None:
+            self.handler(*latest)
+
+        while True:
+            try:
+                func, args = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            func(*args)
+
+        self.root.after(self.interval, self._poll)
+
+
 class BilibiliDownloaderGUI:
     def __init__(self, root):
         self.root = root
@@ -26,6 +69,9 @@ class BilibiliDownloaderGUI:
 
         self.setup_ui()
 
+        # 下载进度经此通道定时刷新到界面
+        self.progress_channel = ProgressChannel(self.root, self.show_progress)
+
         # 尝试自动恢复登录状态
         self.root.after(100, self.try_auto_login)
 
@@ -112,6 +158,14 @@ class BilibiliDownloaderGUI:
         )
         self.info_text.pack(fill="x")
 
+        # 分P选择（多P视频时显示）
+        self.page_frame = tk.Frame(info_frame)
+        self.page_label = tk.Label(self.page_frame, text="分P:", font=("Arial", 9, "bold"))
+        self.page_label.pack(side="left")
+        self.page_spec_var = tk.StringVar(value="全部")
+        tk.Entry(self.page_frame, textvariable=self.page_spec_var, width=20).pack(side="left", padx=5)
+        tk.Label(self.page_frame, text="如: 全部、3、1-5,8", fg="gray", font=("Arial", 9)).pack(side="left")
+
         # 下载选项框架
         options_frame = tk.LabelFrame(self.root, text="下载选项", padx=10, pady=10)
         options_frame.pack(padx=20, pady=5, fill="both", expand=True)
@@ -142,6 +196,14 @@ class BilibiliDownloaderGUI:
             )
             rb.pack(side="left", padx=5)
 
+        # 流式处理：边下载边交给ffmpeg，不保存临时文件
+        self.streaming_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            type_frame,
+            text="边下载边处理（不保存临时文件）",
+            variable=self.streaming_var
+        ).pack(anchor="w", padx=20)
+
         # 视频清晰度选择
         self.video_quality_frame = tk.Frame(options_frame)
         # 不立即pack，由on_download_type_change控制
@@ -326,36 +388,51 @@ class BilibiliDownloaderGUI:
             self.progress_label.config(text="", fg="black")
 
     def try_auto_login(self):
-        """尝试自动恢复登录状态"""
-        def load_login():
-            success, message = self.api.load_login_state()
-
-            if success:
-                # 自动登录成功
-                self.login_status_label.config(
-                    text="已登录（自动恢复） - 可下载高清内容",
-                    fg="green"
-                )
-                self.logout_button.config(state="normal")
+        """尝试自动恢复登录状态（只读本地文件，不等待网络；验证在后台进行）"""
+        def on_checked(valid, message):
+            # 在后台线程中调用，转到主线程更新界面
+            self.progress_channel.post(self.show_login_check, valid, message)
+
+        success, message = self.api.load_login_state(on_checked)
+
+        if success:
+            # 自动登录成功
+            self.login_status_label.config(
+                text="已登录（自动恢复） - 可下载高清内容",
+                fg="green"
+            )
+            self.logout_button.config(state="normal")
+            self.progress_label.config(
+                text=f"✅ {message}",
+                fg="green"
+            )
+            # 3秒后清除提示
+            self.root.after(3000, lambda: self.progress_label.config(text="", fg="black"))
+        else:
+            # 自动登录失败，如果不是"无保存的登录状态"就显示原因
+            if "无保存的登录状态" not in message:
                 self.progress_label.config(
-                    text=f"✅ {message}",
-                    fg="green"
+                    text=f"ℹ️ {message}",
+                    fg="orange"
                 )
-                # 3秒后清除提示
-                self.root.after(3000, lambda: self.progress_label.config(text="", fg="black"))
-            else:
-                # 自动登录失败，如果不是"无保存的登录状态"就显示原因
-                if "无保存的登录状态" not in message:
-                    self.progress_label.config(
-                        text=f"ℹ️ {message}",
-                        fg="orange"
-                    )
-                    # 5秒后清除提示
-                    self.root.after(5000, lambda: self.progress_label.config(text="", fg="black"))
-
-        # 在后台线程中加载
-        thread = threading.Thread(target=load_login, daemon=True)
-        thread.start()
+                # 5秒后清除提示
+                self.root.after(5000, lambda: self.progress_label.config(text="", fg="black"))
+
+    def show_login_check(self, valid, message):
+        """显示后台登录验证的结果"""
+        if valid:
+            return
+        self.login_status_label.config(
+            text="未登录 (部分高清内容需要登录)",
+            fg="red"
+        )
+        self.logout_button.config(state="disabled")
+        self.progress_label.config(
+            text=f"ℹ️ {message}",
+            fg="orange"
+        )
+        # 5秒后清除提示
+        self.root.after(5000, lambda: self.progress_label.config(text="", fg="black"))
 
     def logout(self):
         """退出登录"""
@@ -476,11 +553,19 @@ class BilibiliDownloaderGUI:
             info_str += f"时长: {video_info['duration']}秒 | "
             info_str += f"播放: {video_info['stat']['view']}"
 
+            pages = video_info.get('pages') or []
+            if len(pages) > 1:
+                info_str += f" | 分P: {len(pages)}个"
+
             self.info_text.config(state="normal")
             self.info_text.delete(1.0, tk.END)
             self.info_text.insert(tk.END, info_str)
             self.info_text.config(state="disabled")
 
+            # 多P视频显示分P选择，默认为地址中的 ?p=，没有时为全部（转到界面线程）
+            self.progress_channel.post(self.show_page_selector, len(pages),
+                                       self.api.parse_page_number(url))
+
             # 获取可用清晰度
             bvid = video_info['bvid']
             cid = video_info['cid']
@@ -533,6 +618,27 @@ class BilibiliDownloaderGUI:
         thread = threading.Thread(target=fetch_info, daemon=True)
         thread.start()
 
+    def show_page_selector(self, page_count, page=None):
+        """多P视频显示分P选择，单P视频隐藏（在界面线程中由进度通道调用）"""
+        if page_count > 1:
+            self.page_spec_var.set(str(page) if page else "全部")
+            self.page_label.config(text=f"分P (共{page_count}个):")
+            self.page_frame.pack(fill="x", pady=(5, 0))
+        else:
+            self.page_frame.pack_forget()
+
+    def show_progress(self, progress, downloaded, total, desc=""):
+        """刷新进度条和进度文字（在界面线程中由进度通道调用）"""
+        self.progress_var.set(progress)
+        if total > 0:
+            size_mb = downloaded / (1024 * 1024)
+            total_mb = total / (1024 * 1024)
+            self.progress_label.config(
+                text=f"{desc}: {size_mb:.2f}MB / {total_mb:.2f}MB ({progress:.1f}%)"
+            )
+        else:
+            self.progress_label.config(text=desc)
+
     def start_download(self):
         """开始下载"""
         if not hasattr(self, 'video_info'):
@@ -544,6 +650,8 @@ class BilibiliDownloaderGUI:
         # 获取选中的清晰度
         video_qn = None
         audio_qn = None
+        video_codec = ''
+        audio_codec = ''
 
         if download_type in ["merged", "video_only"]:
             selection = self.video_quality_listbox.curselection()
@@ -551,6 +659,7 @@ class BilibiliDownloaderGUI:
                 messagebox.showwarning("警告", "请选择视频清晰度")
                 return
             video_qn = self.video_qualities[selection[0]]['id']
+            video_codec = self.video_qualities[selection[0]]['codecs']
 
         if download_type in ["merged", "audio_only"]:
             selection = self.audio_quality_listbox.curselection()
@@ -558,6 +667,7 @@ class BilibiliDownloaderGUI:
                 messagebox.showwarning("警告", "请选择音频质量")
                 return
             audio_qn = self.audio_qualities[selection[0]]['id']
+            audio_codec = self.audio_qualities[selection[0]]['codecs']
 
         # 检查登录状态（高清内容）
         if video_qn and video_qn >= 80 and not self.api.is_logged_in:
@@ -568,10 +678,33 @@ class BilibiliDownloaderGUI:
             if not result:
                 return
 
-        # 选择保存路径
+        # 多P视频：选出要下载的分P
         output_format = self.output_format_var.get()
-        default_filename = f"{self.video_info['title']}.{output_format}"
-        default_filename = "".join(c for c in default_filename if c not in r'\/:*?"<>|')
+        page_count = len(self.video_info.get('pages') or [])
+        pages = None
+        if page_count > 1:
+            pages, error = self.api.get_pages(self.video_info, self.page_spec_var.get())
+            if error:
+                messagebox.showwarning("警告", error)
+                return
+
+        if pages and len(pages) > 1:
+            # 多个分P保存到同一个文件夹，文件名按分P编号
+            output_dir = filedialog.askdirectory(title=f"选择保存文件夹（共{len(pages)}个分P）")
+            if not output_dir:
+                return
+            self.start_download_pages(pages, output_dir, download_type, output_format,
+                                      video_qn, audio_qn)
+            return
+
+        # 选择保存路径
+        cid = self.video_info['cid']
+        default_filename = self.api.make_filename(self.video_info['title'], output_format)
+        if pages:
+            cid = pages[0]['cid']
+            default_filename = self.api.make_page_filename(
+                self.video_info['title'], pages[0], page_count, output_format
+            )
 
         filetypes = []
         if output_format == "mp4":
@@ -601,136 +734,86 @@ class BilibiliDownloaderGUI:
         self.download_button.config(state="disabled")
         self.get_info_button.config(state="disabled")
         self.progress_var.set(0)
+        streaming = self.streaming_var.get()
 
         def download():
             bvid = self.video_info['bvid']
-            cid = self.video_info['cid']
 
-            # 获取下载链接
-            video_url, audio_url, video_size, audio_size, error = self.api.get_download_urls(
-                bvid, cid, video_qn if video_qn else 80, audio_qn if audio_qn else 30216
-            )
+            # 下载线程只记录进度，由进度通道在界面线程中刷新
+            progress_callback = self.progress_channel.update
+            post = self.progress_channel.post
 
-            if error:
-                messagebox.showerror("错误", error)
+            def finish(label_text):
+                self.progress_label.config(text=label_text)
                 self.download_button.config(state="normal")
                 self.get_info_button.config(state="normal")
-                return
-
-            def progress_callback(progress, downloaded, total, desc=""):
-                self.progress_var.set(progress)
-                if total > 0:
-                    size_mb = downloaded / (1024 * 1024)
-                    total_mb = total / (1024 * 1024)
-                    self.progress_label.config(
-                        text=f"{desc}: {size_mb:.2f}MB / {total_mb:.2f}MB ({progress:.1f}%)"
-                    )
-                else:
-                    self.progress_label.config(text=desc)
 
             try:
-                if download_type == "video_only":
-                    # 仅下载视频
-                    if output_format == "mp4" and save_path.endswith('.mp4'):
-                        temp_path = save_path.replace('.mp4', '_temp.m4s')
-                    else:
-                        temp_path = save_path
-
-                    success, message = self.api.download_file(
-                        video_url, temp_path, progress_callback, "下载视频"
-                    )
-
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                    # 转换格式
-                    if output_format == "mp4" and temp_path != save_path:
-                        success, message = self.api.convert_to_mp4(
-                            temp_path, save_path, progress_callback
-                        )
-                        if not success:
-                            messagebox.showerror("错误", message)
-                            return
-
-                elif download_type == "audio_only":
-                    # 仅下载音频
-                    temp_path = save_path.replace(f'.{output_format}', '_temp.m4s')
-
-                    success, message = self.api.download_file(
-                        audio_url, temp_path, progress_callback, "下载音频"
-                    )
-
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                    # 转换格式 - 使用新的音频格式转换函数
-                    self.progress_var.set(0)
-                    success, message = self.api.convert_audio_format(
-                        temp_path, save_path, output_format, progress_callback
-                    )
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                else:  # merged
-                    # 下载视频和音频并合并
-                    base_path = save_path.replace(f'.{output_format}', '')
-                    video_temp = base_path + '_video.m4s'
-                    audio_temp = base_path + '_audio.m4s'
-
-                    # 下载视频
-                    success, message = self.api.download_file(
-                        video_url, video_temp, progress_callback, "下载视频"
-                    )
-
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                    # 下载音频
-                    self.progress_var.set(0)
-                    success, message = self.api.download_file(
-                        audio_url, audio_temp, progress_callback, "下载音频"
-                    )
-
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                    # 合并
-                    self.progress_var.set(0)
-                    if output_format == "mp4":
-                        success, message = self.api.merge_video_audio(
-                            video_temp, audio_temp, save_path, progress_callback
-                        )
-                    else:  # flv
-                        # FLV格式先合并为MP4再转换
-                        temp_mp4 = base_path + '_temp.mp4'
-                        success, message = self.api.merge_video_audio(
-                            video_temp, audio_temp, temp_mp4, progress_callback
-                        )
-                        if success:
-                            success, message = self.api.convert_to_mp4(
-                                temp_mp4, save_path, progress_callback
-                            )
-
-                    if not success:
-                        messagebox.showerror("错误", message)
-                        return
-
-                messagebox.showinfo("成功", f"下载完成！\n保存位置: {save_path}")
-                self.progress_label.config(text="下载完成")
+                success, message = self.api.download_video(
+                    bvid, cid, save_path, download_type, output_format,
+                    video_qn if video_qn else 80, audio_qn if audio_qn else 30216,
+                    progress_callback,
+                    streaming=streaming,
+                    video_codec=video_codec,
+                    audio_codec=audio_codec
+                )
+
+                if not success:
+                    post(finish, "下载失败")
+                    post(messagebox.showerror, "错误", message)
+                    return
+
+                post(finish, "下载完成")
+                post(messagebox.showinfo, "成功", f"下载完成！\n保存位置: {save_path}")
 
             except Exception as e:
-                messagebox.showerror("错误", f"下载出错: {str(e)}")
-                self.progress_label.config(text="下载失败")
+                post(finish, "下载失败")
+                post(messagebox.showerror, "错误", f"下载出错: {str(e)}")
 
-            finally:
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+
+    def start_download_pages(self, pages, output_dir, download_type, output_format,
+                             video_qn, audio_qn):
+        """同时下载多个分P"""
+        self.download_button.config(state="disabled")
+        self.get_info_button.config(state="disabled")
+        self.progress_var.set(0)
+        streaming = self.streaming_var.get()
+        video_info = self.video_info
+
+        def download():
+            post = self.progress_channel.post
+
+            def finish(label_text):
+                self.progress_label.config(text=label_text)
                 self.download_button.config(state="normal")
                 self.get_info_button.config(state="normal")
 
+            try:
+                results = self.api.download_pages(
+                    video_info, output_dir, pages, download_type, output_format,
+                    video_qn if video_qn else 80, audio_qn if audio_qn else 30216,
+                    self.progress_channel.update,
+                    streaming=streaming
+                )
+
+                failed = [r for r in results if not r['success']]
+                if failed:
+                    details = "\n".join(f"P{r['page']}: {r['message']}" for r in failed[:10])
+                    post(finish, f"{len(failed)}个分P下载失败")
+                    post(messagebox.showerror, "错误",
+                         f"{len(results) - len(failed)}个分P下载完成，{len(failed)}个失败：\n{details}")
+                    return
+
+                post(finish, "下载完成")
+                post(messagebox.showinfo, "成功",
+                     f"{len(results)}个分P下载完成！\n保存位置: {output_dir}")
+
+            except Exception as e:
+                post(finish, "下载失败")
+                post(messagebox.showerror, "错误", f"下载出错: {str(e)}")
+
         thread = threading.Thread(target=download, daemon=True)
         thread.start()
 
@@ -0,0 +1,46 @@
+"""
+列表接口的分页枚举
+合集、收藏夹、UP主投稿等列表按页请求：最多同时请求 workers 页，按顺序逐条产出，
+已产出的页不再保留（上万条的列表内存占用也保持平稳）
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, islice
+
+
+def ordered_map(func, iterable, workers=4):
+    """
+    惰性的有序并发map：最多同时执行 workers 个调用，按输入顺序产出结果
+    与 Executor.map 不同，不会一次提交全部输入；调用方停止迭代后不再提交新的调用
+    """
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        window = deque(executor.submit(func, item) for item in islice(iterator, max(1, workers)))
+        while window:
+            future = window.popleft()
+            for item in islice(iterator, 1):
+                window.append(executor.submit(func, item))
+            yield future.result()
+
+
+def iter_pages(fetch_page, page_size, workers=4):
+    """
+    逐条产出分页列表的全部条目
+    fetch_page(pn): 请求第 pn 页（从1开始），返回 (items, total)，total为条目总数，未知时为None
+                    （总数未知时 items 应为该页的全部条目，不能过滤）
+    先请求第一页得到总数，其余的页并发请求；总数未知时逐页请求直到某页不满
+    """
+    items, total = fetch_page(1)
+    yield from items
+
+    if total is None:
+        for pn in count(2):
+            if len(items) < page_size:
+                return
+            items, _ = fetch_page(pn)
+            yield from items
+        return
+
+    page_count = (total + page_size - 1) // page_size
+    for items, _ in ordered_map(fetch_page, range(2, page_count + 1), workers):
+        yield from items
@@ -1,8 +1,18 @@
 """
 Bilibili视频下载器
 主程序入口
+带参数运行时进入命令行批量模式（见 cli.py），第一个参数为 serve 时进入服务模式（见 daemon.py），
+否则启动图形界面
 """
-from gui import main
+import sys
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from daemon import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1:
+        from cli import main
+        sys.exit(main())
+    else:
+        from gui import main
+        main()
\ No newline at end of file
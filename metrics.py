@@ -0,0 +1,268 @@
+"""
+运行指标
+计数器、仪表和直方图（带标签），可以输出为Prometheus文本格式供抓取，也可以导出为JSON；
+进程内所有下载共用一个注册表（见 get_registry）
+"""
+import json
+import math
+import threading
+import time
+
+
+# 耗时直方图的默认分桶（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                    600, 1800)
+# 速度直方图的分桶（字节/秒），64KB/s 到 256MB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(7))
+
+
+def _format_number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """指标基类：按标签值保存各序列的数据"""
+
+    type = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labels}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        """[(标签dict, 值), ...]"""
+        with self._lock:
+            items = list(self._series.items())
+        return [(dict(zip(self.labels, key)), self._snapshot(value)) for key, value in items]
+
+    def _snapshot(self, value):
+        return value
+
+    def prometheus_lines(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._series.items())
+        for key, value in items:
+            lines.append(f'{self.name}{self._label_text(key)} {_format_number(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """按分桶统计观测值的分布，同时记录总数和总和"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0,
+                                              'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def _cumulative(self, series):
+        total = 0
+        cumulative = []
+        for count in series['counts']:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def _snapshot(self, series):
+        return {
+            'count': series['count'],
+            'sum': series['sum'],
+            'buckets': {_format_number(bound): count
+                        for bound, count in zip(self.buckets, self._cumulative(series))},
+        }
+
+    def prometheus_lines(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted((key, dict(series, counts=list(series['counts'])))
+                           for key, series in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, self._cumulative(series)):
+                labels = self._label_text(key, ('le', _format_number(bound)))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = self._label_text(key)
+            lines.append(f'{self.name}_sum{labels} {_format_number(series["sum"])}')
+            lines.append(f'{self.name}_count{labels} {series["count"]}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+    counter/gauge/histogram 按名称取已有的指标，不存在时创建（同名指标的类型和标签必须一致）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.created = time.time()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError(f"指标 {name} 已以不同的类型或标签注册")
+            return metric
+
+    def counter(self, name, help_text='', labels=()):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', labels=()):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', labels=(), buckets=DURATION_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def to_prometheus(self):
+        """Prometheus文本格式（0.0.4）"""
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.prometheus_lines())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {
+            'created': self.created,
+            'time': time.time(),
+            'metrics': {
+                metric.name: {
+                    'type': metric.type,
+                    'help': metric.help,
+                    'samples': [{'labels': labels, 'value': value}
+                                for labels, value in metric.samples()],
+                }
+                for metric in self.metrics()
+            },
+        }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=indent)
+
+    def write(self, path):
+        """写入文件：扩展名为 .prom 时为Prometheus文本格式，否则为JSON"""
+        content = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+
+def _make_handler():
+    # http.server 只在提供抓取地址时导入
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            registry = self.server.registry
+            if self.path.split('?')[0] == '/metrics.json':
+                body, content_type = registry.to_json(), 'application/json; charset=utf-8'
+            else:
+                body, content_type = (registry.to_prometheus(),
+                                      'text/plain; version=0.0.4; charset=utf-8')
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return MetricsHandler
+
+
+def serve(registry=None, port=9464, host='127.0.0.1'):
+    """
+    在后台线程中提供指标抓取地址：/metrics 为Prometheus文本格式，/metrics.json 为JSON
+    返回: HTTP服务器对象（调用 shutdown() 停止）
+    """
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), _make_handler())
+    server.daemon_threads = True
+    server.registry = registry or get_registry()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_default_registry = MetricsRegistry()
+
+
+def get_registry():
+    """进程内共用的指标注册表"""
+    return _default_registry
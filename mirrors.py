@@ -0,0 +1,112 @@
+"""
+CDN镜像健康度
+记录每个CDN主机的实测吞吐量和最近的失败，用于在 baseUrl 和 backupUrl 之间选择下载地址
+同一个 BilibiliAPI 实例的所有下载任务共享，后面的任务直接受益于前面任务的测量结果
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class MirrorHealth:
+    """各CDN主机的健康度：吞吐量的指数滑动平均，最近失败次数越多得分越低"""
+
+    ALPHA = 0.3               # 滑动平均中新样本的权重
+    FAILURE_PENALTY = 0.5     # 每次近期失败把得分乘以该系数
+    FAILURE_COOLDOWN = 300    # 失败记录的有效期（秒）
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    @staticmethod
+    def host(url):
+        return urlsplit(url).netloc
+
+    def _entry(self, url):
+        return self._hosts.setdefault(self.host(url), {
+            'speed': 0.0, 'samples': 0, 'bytes': 0, 'failures': [],
+        })
+
+    def record(self, url, size, elapsed):
+        """记录一次传输的字节数和耗时"""
+        if size <= 0 or elapsed <= 0:
+            return
+        self.record_speed(url, size / elapsed, size)
+
+    def record_speed(self, url, speed, size=0):
+        """记录一次测得的速度（字节/秒）"""
+        if speed <= 0:
+            return
+        with self._lock:
+            entry = self._entry(url)
+            if entry['samples']:
+                entry['speed'] += self.ALPHA * (speed - entry['speed'])
+            else:
+                entry['speed'] = speed
+            entry['samples'] += 1
+            entry['bytes'] += size
+
+    def record_failure(self, url):
+        """记录一次失败（连接错误、HTTP错误或速度过慢）"""
+        with self._lock:
+            self._entry(url)['failures'].append(time.time())
+
+    def _recent_failures(self, entry):
+        deadline = time.time() - self.FAILURE_COOLDOWN
+        entry['failures'] = [t for t in entry['failures'] if t > deadline]
+        return len(entry['failures'])
+
+    def speed(self, url):
+        """实测吞吐量（字节/秒），没有测量过时为0"""
+        with self._lock:
+            entry = self._hosts.get(self.host(url))
+            return entry['speed'] if entry else 0.0
+
+    def score(self, url):
+        """
+        得分：吞吐量按近期失败次数打折
+        没有测量过的主机返回None
+        """
+        with self._lock:
+            entry = self._hosts.get(self.host(url))
+            if not entry:
+                return None
+            failures = self._recent_failures(entry)
+            if not entry['samples']:
+                return 0.0 if failures else None
+            return entry['speed'] * self.FAILURE_PENALTY ** failures
+
+    def recent_failures(self, url):
+        with self._lock:
+            entry = self._hosts.get(self.host(url))
+            return self._recent_failures(entry) if entry else 0
+
+    def rank(self, urls):
+        """
+        排序：近期没有失败的已测速主机按速度在前，其次是未测量的主机（保持原有顺序），
+        最后是近期失败过的主机（按得分）
+        """
+        def key(item):
+            index, url = item
+            score = self.score(url)
+            if score is None:
+                return (1, 0, index)
+            if self.recent_failures(url):
+                return (2, -score, index)
+            return (0, -score, index)
+
+        return [url for _, url in sorted(enumerate(urls), key=key)]
+
+    def stats(self):
+        """各主机的健康度快照"""
+        with self._lock:
+            return {
+                host: {
+                    'speed': entry['speed'],
+                    'samples': entry['samples'],
+                    'bytes': entry['bytes'],
+                    'recent_failures': self._recent_failures(entry),
+                }
+                for host, entry in self._hosts.items()
+            }
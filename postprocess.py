@@ -0,0 +1,539 @@
+"""
+ffmpeg后处理工具
+查找ffmpeg并缓存其版本和支持的编码器、封装格式、协议，每个进程只探测一次
+生成单次调用的后处理方案，并提供限制CPU占用的后处理工作池
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FFmpegInfo:
+    """一个ffmpeg可执行文件的能力信息，各项在首次使用时探测并缓存"""
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self._lock = threading.Lock()
+        self._lists = {}
+
+    def _list(self, option):
+        """解析 ffmpeg -encoders / -muxers / -protocols 的输出"""
+        with self._lock:
+            if option in self._lists:
+                return self._lists[option]
+
+            try:
+                output = subprocess.run(
+                    [self.path, '-hide_banner', option],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    universal_newlines=True
+                ).stdout
+            except OSError:
+                output = ''
+
+            names = set()
+            if option == '-protocols':
+                # 格式: "Input:\n  file\n  http\n...Output:\n  file\n..."
+                for line in output.splitlines():
+                    line = line.strip()
+                    if line and not line.endswith(':'):
+                        names.add(line)
+            else:
+                # 格式: " V....D libx264   H.264 ..." / "  E mp4   MP4 ..."，说明部分之后以 "--" 分隔
+                body = output.split('--', 1)[-1]
+                for line in body.splitlines():
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        names.update(parts[1].split(','))
+
+            self._lists[option] = names
+            return names
+
+    @property
+    def encoders(self):
+        return self._list('-encoders')
+
+    @property
+    def muxers(self):
+        return self._list('-muxers')
+
+    @property
+    def protocols(self):
+        return self._list('-protocols')
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_muxer(self, name):
+        return name in self.muxers
+
+    def first_encoder(self, candidates):
+        """返回候选列表中第一个可用的编码器，都不可用时返回None"""
+        for name in candidates:
+            if self.has_encoder(name):
+                return name
+        return None
+
+
+_configured_path = None
+_probe_cache = {}
+_probe_lock = threading.Lock()
+
+
+def set_ffmpeg_path(path):
+    """指定ffmpeg可执行文件路径（为None时自动查找）"""
+    global _configured_path
+    _configured_path = path
+
+
+def find_ffmpeg(path=None):
+    """
+    查找ffmpeg可执行文件
+    顺序: 参数 > set_ffmpeg_path > 环境变量 BILI_FFMPEG > PATH > 程序目录
+    """
+    for candidate in (path, _configured_path, os.environ.get('BILI_FFMPEG')):
+        if candidate:
+            return candidate
+
+    found = shutil.which('ffmpeg')
+    if found:
+        return found
+
+    # Windows用户可以把ffmpeg.exe直接放在程序目录下
+    program_dir = os.path.dirname(os.path.abspath(__file__))
+    local = os.path.join(program_dir, 'ffmpeg.exe' if sys.platform == 'win32' else 'ffmpeg')
+    if os.path.isfile(local):
+        return local
+
+    return None
+
+
+def get_ffmpeg(path=None, refresh=False):
+    """
+    获取ffmpeg能力信息（同一路径在进程内只探测一次）
+    找不到或无法运行时返回None
+    """
+    executable = find_ffmpeg(path)
+    if not executable:
+        return None
+
+    with _probe_lock:
+        if executable in _probe_cache and not refresh:
+            return _probe_cache[executable]
+
+        try:
+            output = subprocess.run(
+                [executable, '-hide_banner', '-version'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True
+            ).stdout
+            match = re.search(r'ffmpeg version (\S+)', output)
+            info = FFmpegInfo(executable, match.group(1) if match else '')
+        except (subprocess.CalledProcessError, OSError):
+            info = None
+
+        _probe_cache[executable] = info
+        return info
+
+
+class FFmpegProgress:
+    """
+    解析ffmpeg -progress 输出（每行 key=value，每组以 progress=continue/end 结束）
+    duration: 输出的总时长（秒），未知时只能报告已处理的时长
+    """
+
+    def __init__(self, duration=None):
+        self.duration = duration or 0
+        self.out_time = 0.0
+        self.speed = 0.0
+        self.finished = False
+        self.started = time.time()
+
+    def feed(self, line):
+        """读入一行，一组数据结束时返回True"""
+        key, _, value = line.strip().partition('=')
+        if key in ('out_time_us', 'out_time_ms'):
+            # 两者单位都是微秒（out_time_ms 是ffmpeg历史遗留的错误命名）
+            try:
+                self.out_time = max(0, int(value)) / 1000000
+            except ValueError:
+                pass
+        elif key == 'speed':
+            try:
+                self.speed = float(value.rstrip('x'))
+            except ValueError:
+                pass
+        elif key == 'progress':
+            self.finished = value == 'end'
+            return True
+        return False
+
+    @property
+    def percent(self):
+        if self.finished:
+            return 100.0
+        if not self.duration:
+            return 0.0
+        return min(100.0, self.out_time / self.duration * 100)
+
+    @property
+    def eta(self):
+        """预计剩余秒数，无法估计时返回None"""
+        if self.finished:
+            return 0.0
+        if not self.duration or self.out_time <= 0:
+            return None
+        remaining = max(0.0, self.duration - self.out_time)
+        if self.speed > 0:
+            return remaining / self.speed
+        elapsed = time.time() - self.started
+        return remaining * elapsed / self.out_time
+
+
+def format_eta(seconds):
+    """把秒数格式化为 mm:ss / h:mm:ss"""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    if hours:
+        return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+    return f"{rest // 60:02d}:{rest % 60:02d}"
+
+
+def run_ffmpeg(cmd, duration=None, on_progress=None):
+    """
+    运行ffmpeg并逐行解析进度（自动加上 -progress pipe:1）
+    on_progress: 每组进度数据到达时以 FFmpegProgress 调用
+    返回: (returncode, stderr)
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + list(cmd[1:])
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        encoding='utf-8',
+        errors='replace'
+    )
+
+    # stderr单独读取，避免输出过多时阻塞ffmpeg
+    stderr_chunks = []
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+    )
+    stderr_thread.start()
+
+    progress = FFmpegProgress(duration)
+    for line in process.stdout:
+        if progress.feed(line) and on_progress:
+            on_progress(progress)
+
+    process.wait()
+    stderr_thread.join()
+    return process.returncode, ''.join(stderr_chunks)
+
+
+# 音频输出格式 -> 候选编码器（按优先级）及对应参数
+# 每个列表的最后一项是常见ffmpeg构建都带有的编码器
+AUDIO_ENCODERS = {
+    'mp3': [
+        ('libmp3lame', ['-q:a', '0']),  # VBR最高质量
+    ],
+    'wav': [
+        ('pcm_s16le', []),
+    ],
+    'flac': [
+        ('flac', ['-compression_level', '8']),  # 最高压缩
+    ],
+    'm4a': [
+        ('libfdk_aac', ['-vbr', '5']),
+        ('aac', ['-b:a', '320k']),
+    ],
+    'aac': [
+        ('libfdk_aac', ['-vbr', '5']),
+        ('aac', ['-b:a', '320k']),
+    ],
+}
+
+
+def audio_encoder_args(ffmpeg, output_format):
+    """
+    根据ffmpeg支持的编码器选择音频编码参数
+    返回: (['-c:a', encoder, ...], error)
+    """
+    candidates = AUDIO_ENCODERS.get(output_format.lower())
+    if not candidates:
+        return None, f"不支持的音频格式: {output_format}"
+
+    # 无法获取编码器列表时使用最常见的编码器
+    if not ffmpeg.encoders:
+        encoder, options = candidates[-1]
+        return ['-c:a', encoder] + options, None
+
+    for encoder, options in candidates:
+        if ffmpeg.has_encoder(encoder):
+            return ['-c:a', encoder] + options, None
+
+    names = '/'.join(encoder for encoder, _ in candidates)
+    return None, f"当前ffmpeg不支持{output_format.upper()}编码（需要{names}）"
+
+
+# 编码字符串前缀 -> 编码简称（codecs字段如 avc1.640032 / hev1.1.6.L150.90 / mp4a.40.2）
+CODEC_PREFIXES = {
+    'avc': 'avc', 'h264': 'avc',
+    'hev': 'hevc', 'hvc': 'hevc', 'hevc': 'hevc',
+    'av01': 'av1', 'av1': 'av1',
+    'mp4a': 'aac', 'aac': 'aac',
+    'flac': 'flac', 'fLaC': 'flac',
+    'ec-3': 'eac3', 'eac3': 'eac3', 'ac-3': 'ac3', 'ac3': 'ac3',
+    'mp3': 'mp3', 'opus': 'opus',
+}
+
+# 容器 -> 可以直接复制（不转码）的视频/音频编码
+CONTAINER_CODECS = {
+    'mp4': {'video': {'avc', 'hevc', 'av1'}, 'audio': {'aac', 'flac', 'eac3', 'ac3', 'mp3', 'opus'}},
+    'flv': {'video': {'avc'}, 'audio': {'aac', 'mp3'}},
+    'm4a': {'video': set(), 'audio': {'aac'}},
+    'aac': {'video': set(), 'audio': {'aac'}},
+    'mp3': {'video': set(), 'audio': {'mp3'}},
+    'flac': {'video': set(), 'audio': {'flac'}},
+    'wav': {'video': set(), 'audio': set()},
+}
+
+# 需要转码时使用的视频编码器（按优先级）
+VIDEO_ENCODERS = [
+    ('libx264', ['-preset', 'veryfast', '-crf', '18']),
+    ('h264', []),
+]
+
+# 容器需要额外的封装参数
+CONTAINER_OPTIONS = {
+    'm4a': ['-f', 'ipod'],
+    'aac': ['-f', 'adts'],
+}
+
+
+def codec_family(codecs):
+    """把codecs字符串归一为编码简称，无法识别时返回空字符串"""
+    if not codecs:
+        return ''
+    head = codecs.split('.')[0]
+    for prefix, family in CODEC_PREFIXES.items():
+        if head == prefix or head.lower().startswith(prefix.lower()):
+            return family
+    return ''
+
+
+class PostProcessPlan:
+    """
+    一次ffmpeg调用的后处理方案
+    inputs 为输入类型列表（'video' / 'audio'），codec_args 为输入与输出之间的参数
+    """
+
+    def __init__(self, inputs, output_path, codec_args, copied, transcoded):
+        self.inputs = inputs
+        self.output_path = output_path
+        self.codec_args = codec_args
+        self.copied = copied
+        self.transcoded = transcoded
+
+    @property
+    def stream_copy_only(self):
+        """是否所有流都直接复制（只受I/O限制）"""
+        return not self.transcoded
+
+    def command(self, ffmpeg_path, input_names, pre_output=()):
+        """生成完整的ffmpeg命令，input_names 与 inputs 一一对应（文件路径或 pipe:N）"""
+        cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error']
+        for name in input_names:
+            cmd.extend(['-i', name])
+        cmd.extend(self.codec_args)
+        cmd.extend(pre_output)
+        cmd.extend(['-y', self.output_path])
+        return cmd
+
+    def describe(self):
+        parts = [f"{kind}复制" for kind in self.copied]
+        parts += [f"{kind}转码({encoder})" for kind, encoder in self.transcoded]
+        return '，'.join(parts)
+
+
+def plan_postprocess(ffmpeg, output_path, output_format=None, video_codec=None, audio_codec=None,
+                     has_video=True, has_audio=True):
+    """
+    根据源编码和目标容器生成单次ffmpeg调用的方案：容器允许的流直接复制，只转码必须转码的流
+    video_codec / audio_codec: 源编码（codecs字符串或简称），未知时视为B站DASH的常见编码（AVC/AAC）
+    has_video / has_audio: 是否有视频/音频输入；只有视频输入时其中的音轨（如有）一并处理
+    返回: (PostProcessPlan, error)
+    """
+    container = (output_format or os.path.splitext(output_path)[1].lstrip('.')).lower()
+    allowed = CONTAINER_CODECS.get(container)
+    if allowed is None:
+        return None, f"不支持的输出格式: {container}"
+
+    inputs = []
+    codec_args = []
+    copied = []
+    transcoded = []
+
+    if has_video and allowed['video']:
+        inputs.append('video')
+        codec_args.extend(['-map', '0:v:0'])
+        source = codec_family(video_codec) or 'avc'
+        if source in allowed['video']:
+            codec_args.extend(['-c:v', 'copy'])
+            copied.append('视频')
+        else:
+            encoder, options = VIDEO_ENCODERS[-1]
+            if ffmpeg.encoders:
+                encoder, options = next(
+                    ((name, opts) for name, opts in VIDEO_ENCODERS if ffmpeg.has_encoder(name)),
+                    (None, None)
+                )
+                if encoder is None:
+                    return None, "当前ffmpeg没有可用的H.264编码器"
+            codec_args.extend(['-c:v', encoder] + options)
+            transcoded.append(('视频', encoder))
+        # DASH视频流中带HEVC的hvc1标签，苹果设备才能识别
+        if container == 'mp4' and source == 'hevc':
+            codec_args.extend(['-tag:v', 'hvc1'])
+    elif has_video and not has_audio:
+        return None, f"{container.upper()}格式不能保存视频"
+
+    if has_audio:
+        inputs.append('audio')
+        codec_args.extend(['-map', f'{len(inputs) - 1}:a:0'])
+    elif has_video:
+        # 单个视频输入可能自带音轨（传统FLV/MP4格式）
+        codec_args.extend(['-map', '0:a?'])
+
+    source = codec_family(audio_codec) or 'aac'
+    if source in allowed['audio']:
+        codec_args.extend(['-c:a', 'copy'])
+        copied.append('音频')
+    else:
+        # 视频容器中的音频统一转为AAC
+        encoder_args, error = audio_encoder_args(
+            ffmpeg, container if container in AUDIO_ENCODERS else 'aac'
+        )
+        if error:
+            return None, error
+        codec_args.extend(encoder_args)
+        transcoded.append(('音频', encoder_args[1]))
+
+    if not allowed['video']:
+        codec_args.append('-vn')
+    codec_args.extend(CONTAINER_OPTIONS.get(container, []))
+
+    return PostProcessPlan(inputs, output_path, codec_args, copied, transcoded), None
+
+
+class PostProcessPool:
+    """
+    后处理工作池：批量任务中的合并/转码在独立的工作线程中执行，
+    下载线程提交后即可继续下载下一个任务，网络和CPU工作互相重叠
+    实际编码在ffmpeg子进程中进行，工作线程只负责启动和等待
+    cpu_budget: 后处理可以占用的CPU核数（默认为全部核数）
+    threads_per_job: 每个转码任务传给ffmpeg的 -threads，同时运行的任务数为 cpu_budget // threads_per_job
+    """
+
+    HISTORY_SIZE = 100
+
+    def __init__(self, cpu_budget=None, threads_per_job=1):
+        self.cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+        self.threads_per_job = max(1, threads_per_job or 1)
+        self.workers = max(1, self.cpu_budget // self.threads_per_job)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='postprocess')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._encode_time = 0.0
+        self._history = deque(maxlen=self.HISTORY_SIZE)
+
+    def ffmpeg_args(self):
+        """转码时附加在输出前的ffmpeg参数"""
+        return ['-threads', str(self.threads_per_job)]
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        提交一个后处理任务，func 应返回 (success, message)
+        返回: Future，结果为 (success, message, queue_time, encode_time)
+        """
+        submitted = time.time()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        return self._executor.submit(self._run, name, submitted, func, args, kwargs)
+
+    def run(self, name, func, *args, **kwargs):
+        """提交任务并等待完成"""
+        return self.submit(name, func, *args, **kwargs).result()
+
+    def _run(self, name, submitted, func, args, kwargs):
+        started = time.time()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+
+        try:
+            success, message = func(*args, **kwargs)
+        except Exception as e:
+            success, message = False, f"后处理出错: {str(e)}"
+
+        finished = time.time()
+        with self._lock:
+            self._running -= 1
+            if success:
+                self._completed += 1
+            else:
+                self._failed += 1
+            self._encode_time += finished - started
+            self._history.append({
+                'name': name,
+                'success': success,
+                'queue_time': started - submitted,
+                'encode_time': finished - started,
+            })
+        return success, message, started - submitted, finished - started
+
+    @property
+    def queue_depth(self):
+        """等待执行的任务数"""
+        with self._lock:
+            return self._queued
+
+    def stats(self):
+        """工作池状态：队列深度、运行中/完成/失败数量、编码耗时"""
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                'workers': self.workers,
+                'threads_per_job': self.threads_per_job,
+                'queued': self._queued,
+                'max_queued': self._max_queued,
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+                'encode_time': self._encode_time,
+                'avg_encode_time': self._encode_time / finished if finished else 0.0,
+                'recent': list(self._history),
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,238 @@
+"""
+接口请求调度
+开始时不限速；遇到风控（-412/-352/-799）或 HTTP 429 时，把速率降到实测请求速率的一定比例（乘性减），
+之后每段时间没有再被限制就逐步提高（加性增），回到被限制前的速率后恢复不限速，
+让批量任务的请求速率贴近服务器能接受的上限；被限制、5xx 和网络错误按指数退避（带随机抖动）重试
+"""
+import random
+import threading
+import time
+from collections import deque
+
+from bandwidth import TokenBucket
+
+
+# 风控（请求过快、需要验证）的接口错误码
+RISK_CONTROL_CODES = {-412, -352, -799}
+
+OK = 'ok'
+RATE_LIMITED = 'rate_limited'
+SERVER_ERROR = 'server_error'
+NETWORK_ERROR = 'network_error'
+
+
+def classify(status, code=None):
+    """
+    按HTTP状态码和接口返回的code对响应分类
+    返回: OK（包括普通的接口错误，如视频不存在）、RATE_LIMITED 或 SERVER_ERROR
+    """
+    if status in (412, 429) or code in RISK_CONTROL_CODES:
+        return RATE_LIMITED
+    if status is not None and status >= 500:
+        return SERVER_ERROR
+    return OK
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数），无法解析时返回None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    自适应速率的接口请求调度器，可在多个线程中同时使用
+    max_rate: 速率上限（请求/秒），None表示没有被限制时不限速；min_rate: 降速的下限
+    """
+
+    INCREASE = 1.0            # 每个恢复周期提高的速率（请求/秒）
+    RECOVERY_INTERVAL = 2.0   # 恢复周期（秒）：没有再被限制时，每隔这么久提高一次速率
+    DECREASE = 0.5            # 被限制时速率乘以该系数
+    DECREASE_INTERVAL = 1.0   # 同一波限制只降一次速率（并发请求往往同时被拒绝）
+    COOLDOWN = 10.0           # 被限制后多长时间内不提高速率（秒）
+    MAX_RETRIES = 4
+    BACKOFF_BASE = 1.0        # 第一次重试前的等待（秒），之后每次翻倍
+    BACKOFF_MAX = 30.0
+    RATE_WINDOW = 5.0         # 统计实测请求速率的时间窗口（秒）
+
+    def __init__(self, max_rate=None, min_rate=0.5, max_retries=None):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_retries = self.MAX_RETRIES if max_retries is None else max_retries
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(max_rate, burst=1)
+        # 被限制前的速率，恢复到这个速率后取消限速
+        self._ceiling = None
+        self._recent = deque()
+        self._last_increase = time.monotonic()
+        self._last_decrease = 0.0
+        self._cooldown_until = 0.0
+        self.counts = {'requests': 0, 'retries': 0, OK: 0, RATE_LIMITED: 0, SERVER_ERROR: 0,
+                       NETWORK_ERROR: 0}
+
+    def _clamp(self, rate):
+        if self.max_rate:
+            rate = min(self.max_rate, rate)
+        return max(self.min_rate, rate)
+
+    @property
+    def rate(self):
+        """当前的有效速率上限（请求/秒），None表示不限速"""
+        return self._bucket.rate
+
+    def observed_rate(self):
+        """最近一段时间实际发出的请求速率（请求/秒）"""
+        with self._lock:
+            return self._observed(time.monotonic())
+
+    def _observed(self, now):
+        while self._recent and now - self._recent[0] > self.RATE_WINDOW:
+            self._recent.popleft()
+        if not self._recent:
+            return 0.0
+        return len(self._recent) / max(1.0, now - self._recent[0])
+
+    def set_max_rate(self, max_rate):
+        """调整速率上限（None表示不限），当前速率超出时随之降低"""
+        with self._lock:
+            self.max_rate = max_rate
+            rate = self._bucket.rate
+            if max_rate and (rate is None or rate > max_rate):
+                self._bucket.set_rate(max_rate, burst=1)
+
+    def reserve(self):
+        """按当前速率预约下一个请求，返回需要等待的秒数（不阻塞，供异步客户端使用）"""
+        return self._bucket.reserve(1)
+
+    def acquire(self):
+        """按当前速率等待发出下一个请求的时机（各线程依次排在前一个请求之后）"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, outcome):
+        """记录一次请求的结果并调整速率"""
+        now = time.monotonic()
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts[outcome] += 1
+            self._recent.append(now)
+            rate = self._bucket.rate
+            if outcome == RATE_LIMITED:
+                self._cooldown_until = now + self.COOLDOWN
+                self._last_increase = now
+                if now - self._last_decrease < self.DECREASE_INTERVAL:
+                    return
+                self._last_decrease = now
+                if rate is None:
+                    # 不限速时按实测速率计算
+                    rate = self._observed(now)
+                    self._ceiling = rate
+                rate = self._clamp(rate * self.DECREASE)
+            elif outcome == OK:
+                if rate is None or now < self._cooldown_until or \
+                        now - self._last_increase < self.RECOVERY_INTERVAL:
+                    return
+                self._last_increase = now
+                rate += self.INCREASE
+                if not self.max_rate and self._ceiling is not None and rate >= self._ceiling:
+                    rate = None
+                else:
+                    rate = self._clamp(rate)
+            else:
+                return
+            if rate != self._bucket.rate:
+                self._bucket.set_rate(rate, burst=1)
+
+    def backoff(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待秒数：指数增长，在一半到全部之间随机，不短于 Retry-After"""
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)
+        delay *= 0.5 + random.random() / 2
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.BACKOFF_MAX))
+        return delay
+
+    def run(self, send, on_retry=None):
+        """
+        发出请求，被限制或出错时重试
+        send(): 发出一次请求，返回 (HTTP状态码, 接口JSON或None, Retry-After秒数或None)
+        on_retry(reason, delay): 每次重试前调用
+        返回: 最后一次的接口JSON；重试用完仍然失败时抛出最后的异常或RuntimeError
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = send()
+            except Exception as e:
+                result = e
+            data, delay = self._settle(attempt, result, on_retry)
+            if delay is None:
+                return data
+            time.sleep(delay)
+            attempt += 1
+
+    async def run_async(self, send, on_retry=None):
+        """run 的异步版本，send 为协程函数，等待时不阻塞事件循环"""
+        import asyncio
+
+        attempt = 0
+        while True:
+            delay = self.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = await send()
+            except Exception as e:
+                result = e
+            data, delay = self._settle(attempt, result, on_retry)
+            if delay is None:
+                return data
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _settle(self, attempt, result, on_retry):
+        """
+        记录第 attempt 次请求的结果（send() 的返回值或抛出的异常）
+        返回: (接口JSON, None) 表示结束；(None, 等待秒数) 表示需要重试
+        """
+        error = None
+        status = data = retry_after = None
+        try:
+            if isinstance(result, Exception):
+                raise result
+            status, data, retry_after = result
+            outcome = classify(status, data.get('code') if data else None)
+        except Exception as e:
+            error = e
+            outcome = NETWORK_ERROR
+        self.record(outcome)
+
+        if outcome == OK and data is not None:
+            return data, None
+        if outcome == OK:
+            # 响应不是JSON，且不属于可以重试的情况
+            raise RuntimeError(f"接口返回了无法解析的响应（HTTP {status}）")
+        if attempt >= self.max_retries:
+            if error is not None:
+                raise error
+            if data is not None:
+                # 交给调用方按接口错误码处理
+                return data, None
+            raise RuntimeError(f"请求失败（HTTP {status}），已重试 {attempt} 次")
+
+        delay = self.backoff(attempt, retry_after)
+        with self._lock:
+            self.counts['retries'] += 1
+        if on_retry:
+            on_retry(outcome, delay)
+        return None, delay
+
+    def stats(self):
+        """请求数、各类结果的次数、当前速率上限和实测速率"""
+        with self._lock:
+            rate = self._bucket.rate
+            return dict(self.counts, rate=round(rate, 2) if rate else None,
+                        observed_rate=round(self._observed(time.monotonic()), 2))
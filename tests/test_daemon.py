@@ -0,0 +1,158 @@
+"""服务模式：访问令牌、输出目录限制、请求体检查和取消任务"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bilibili_api import BilibiliAPI  # noqa: E402
+from daemon import DownloadDaemon, JobManager  # noqa: E402
+
+TOKEN = 's3cret'
+
+
+class BlockingViewHandler(BaseHTTPRequestHandler):
+    """模拟视频信息接口：在 release 事件设置前不返回，让第一个任务一直处于运行中"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.release.wait(10)
+        data = json.dumps({'code': -404, 'message': '啥都木有'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = ThreadingHTTPServer(('127.0.0.1', 0), BlockingViewHandler)
+        self.upstream.release = threading.Event()
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.tempdir.name, 'downloads')
+        os.makedirs(self.output_dir)
+        self.api = BilibiliAPI()
+        self.api.API_BASE = f'http://127.0.0.1:{self.upstream.server_port}'
+        self.manager = JobManager(self.api, self.output_dir, jobs=1)
+        self.server = DownloadDaemon(self.manager, '127.0.0.1', 0, TOKEN)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.upstream.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.manager.shutdown()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self.api.transport.close()
+        self.tempdir.cleanup()
+
+    def request(self, method, path, body=None, token=TOKEN, data=None):
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        request = urllib.request.Request(self.base + path, data=data, method=method,
+                                         headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def wait_expanded(self, submission_id):
+        for _ in range(100):
+            status, submission = self.request('GET', f'/submissions/{submission_id}')
+            if submission['status'] != 'expanding':
+                return submission
+            time.sleep(0.05)
+        self.fail("提交的地址没有展开完成")
+
+    def wait_running(self, job_id):
+        for _ in range(100):
+            if self.request('GET', f'/jobs/{job_id}')[1]['status'] == 'running':
+                return
+            time.sleep(0.05)
+        self.fail("任务没有开始运行")
+
+    def test_requires_token(self):
+        self.assertEqual(self.request('GET', '/jobs', token=None)[0], 401)
+        self.assertEqual(self.request('GET', '/jobs', token='wrong')[0], 401)
+        self.assertEqual(self.request('POST', '/jobs', {'url': 'BV1aa'}, token=None)[0], 401)
+        self.assertEqual(self.request('GET', '/jobs')[0], 200)
+        self.assertEqual(self.manager.list_submissions(), [])
+
+    def test_rejects_output_dir_outside_root(self):
+        for output_dir in ('../x', os.path.join(self.tempdir.name, 'elsewhere'), '/'):
+            status, body = self.request('POST', '/jobs', {'url': 'BV1aa',
+                                                          'output_dir': output_dir})
+            self.assertEqual(status, 400, output_dir)
+            self.assertIn('error', body)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, 'x')))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, 'elsewhere')))
+        self.assertEqual(self.manager.list_submissions(), [])
+
+    def test_rejects_malformed_bodies(self):
+        bodies = [
+            {'url': 'BV1aa', 'job_rate': [1]},
+            {'url': 'BV1aa', 'job_rate': -5},
+            {'url': 'BV1aa', 'quality': True},
+            {'url': 'BV1aa', 'pages': 'x-y'},
+            {'url': 'BV1aa', 'pages': '5-3'},
+            {'url': 'BV1aa', 'format': '../mp4'},
+            {'url': 'BV1aa', 'output_dir': ['sub']},
+            {'url': ['BV1aa']},
+            {'urls': [1, 2]},
+            {'urls': {'BV1aa': 1}},
+            {},
+        ]
+        for body in bodies:
+            status, response = self.request('POST', '/jobs', body)
+            self.assertEqual(status, 400, body)
+            self.assertIn('error', response)
+        for data in (b'{not json', b'[1, 2]', b'\xff\xfe'):
+            self.assertEqual(self.request('POST', '/jobs', data=data)[0], 400, data)
+        self.assertEqual(self.manager.list_submissions(), [])
+
+    def test_urls_string_is_one_target(self):
+        status, submission = self.request('POST', '/jobs', {'urls': 'BV1aa', 'pages': '1-3,5'})
+        self.assertEqual(status, 202)
+        self.assertEqual(submission['targets'], ['BV1aa'])
+
+    def test_cancel_moves_queued_jobs_to_cancelled(self):
+        status, submission = self.request('POST', '/jobs',
+                                          {'urls': ['BV1aa', 'BV1bb', 'BV1cc', 'BV1dd']})
+        self.assertEqual(status, 202)
+        first, second, *rest = self.wait_expanded(submission['id'])['jobs']
+        self.wait_running(first)
+
+        # 取消单个排队中的任务
+        status, job = self.request('DELETE', f'/jobs/{second}')
+        self.assertEqual((status, job['status']), (200, 'cancelled'))
+
+        # 取消整个提交：其余排队中的任务都被取消
+        status, body = self.request('POST', f"/submissions/{submission['id']}/cancel")
+        self.assertEqual(status, 200)
+        for job_id in rest:
+            self.assertEqual(self.request('GET', f'/jobs/{job_id}')[1]['status'], 'cancelled')
+
+        self.upstream.release.set()
+        self.manager.executor.shutdown(wait=True)
+        self.assertNotEqual(self.request('GET', f'/jobs/{first}')[1]['status'], 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""登录状态恢复：后台检查不能把登录cookies发给第三方IP检测服务"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bilibili_api import BilibiliAPI  # noqa: E402
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """/ip 模拟IP检测服务，/x/web-interface/nav 模拟B站登录检查，记录每个请求的Cookie头"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Cookie')))
+        if self.path.startswith('/ip'):
+            body = {'ip': '203.0.113.7'}
+        else:
+            body = {'code': 0, 'data': {'isLogin': True}}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class LoginCookieLeakTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{self.server.server_port}'
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.api = BilibiliAPI()
+        self.api.API_BASE = base
+        self.api.IP_SERVICES = (f'{base}/ip?format=json',)
+        self.api.login_data_file = os.path.join(self.tempdir.name, 'login.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.api.transport.close()
+        self.tempdir.cleanup()
+
+    def ip_requests(self):
+        return [cookie for path, cookie in self.server.requests if path.startswith('/ip')]
+
+    def test_get_current_ip_sends_no_cookies(self):
+        self.api.cookies = {'SESSDATA': 'secret', 'bili_jct': 'csrf'}
+        self.api.session.cookies.update(self.api.cookies)
+
+        self.assertEqual(self.api.get_current_ip(timeout=5), '203.0.113.7')
+        self.assertEqual(self.ip_requests(), [None])
+
+    def test_background_login_check_sends_no_cookies_to_ip_service(self):
+        with open(self.api.login_data_file, 'w', encoding='utf-8') as f:
+            json.dump({'cookies': {'SESSDATA': 'secret', 'bili_jct': 'csrf'},
+                       'ip': '203.0.113.7', 'timestamp': time.time(), 'validated': 0}, f)
+
+        success, _ = self.api.load_login_state()
+        self.assertTrue(success)
+        self.assertEqual(self.api.wait_login_check(10), (True, "登录状态验证通过"))
+
+        self.assertEqual(self.ip_requests(), [None])
+        # 登录检查本身确实带着cookies（说明会话中有cookies，而不是测试没有设置）
+        nav = [cookie for path, cookie in self.server.requests if path.startswith('/x/')]
+        self.assertTrue(nav and 'SESSDATA=secret' in nav[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""传输层：HTTP/2客户端发送的请求头、连接池统计"""
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import HTTP2Client, PooledAdapter, Transport, httpx  # noqa: E402
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    h2 = None
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """返回请求的路径和请求头；/login 同时设置一个cookie"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = json.dumps({'path': self.path, 'headers': dict(self.headers)}).encode()
+        self.send_response(200)
+        if self.path.startswith('/login'):
+            self.send_header('Set-Cookie', 'SESSDATA=from-server; Path=/')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@unittest.skipUnless(httpx is not None and h2 is not None, "需要 httpx[http2]")
+class HTTP2ClientTest(TransportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = HTTP2Client({'User-Agent': 'test-agent'}, max_connections=4)
+
+    def tearDown(self):
+        self.client.close()
+        super().tearDown()
+
+    def get(self, path, **kwargs):
+        response = self.client.get(self.base + path, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sends_params_cookies_and_headers(self):
+        body = self.get('/x/web-interface/view', params={'bvid': 'BV1xx411c7mD'},
+                        cookies={'SESSDATA': 'secret', 'bili_jct': 'csrf'},
+                        headers={'Referer': 'https://www.bilibili.com'}, timeout=5)
+        self.assertEqual(body['path'], '/x/web-interface/view?bvid=BV1xx411c7mD')
+        headers = body['headers']
+        self.assertEqual(headers['Cookie'], 'SESSDATA=secret; bili_jct=csrf')
+        self.assertEqual(headers['Referer'], 'https://www.bilibili.com')
+        self.assertEqual(headers['User-Agent'], 'test-agent')
+        self.assertEqual(self.client.versions, {'HTTP/1.1': 1})
+
+    def test_cookies_are_per_request(self):
+        self.get('/login', cookies={'SESSDATA': 'user-a'})
+        # 响应设置的cookie和上一次请求的cookies都不会带到下一次请求
+        self.assertNotIn('Cookie', self.get('/x/nav')['headers'])
+        self.assertEqual(self.get('/x/nav', cookies={'SESSDATA': 'user-b'})['headers']['Cookie'],
+                         'SESSDATA=user-b')
+
+
+class PoolStatsTest(TransportTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transport = Transport({'User-Agent': 'test-agent'}, http2=False)
+
+    def tearDown(self):
+        self.transport.close()
+        super().tearDown()
+
+    def test_counts_requests_and_connections(self):
+        for _ in range(3):
+            self.transport.api_get(self.base + '/x/nav', timeout=5).json()
+        host = f'http://127.0.0.1:{self.server.server_port}'
+        stats = self.transport.stats()['api'][host]
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['maxsize'], 16)
+
+    def test_degrades_when_urllib3_internals_change(self):
+        self.transport.api_get(self.base + '/x/nav', timeout=5).json()
+        adapter = self.transport.api.get_adapter('http://')
+        self.assertIsInstance(adapter, PooledAdapter)
+        pools, adapter.poolmanager.pools = adapter.poolmanager.pools, object()
+        try:
+            host = f'http://127.0.0.1:{self.server.server_port}'
+            self.assertEqual(adapter.pool_stats(), {host: {'requests': 1, 'maxsize': 16}})
+        finally:
+            adapter.poolmanager.pools = pools
+
+
+if __name__ == '__main__':
+    unittest.main()
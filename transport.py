@@ -0,0 +1,164 @@
+"""
+HTTP传输层
+接口请求和CDN下载使用两个独立的连接池，按各自的并发量设置大小，连接在线程之间共享复用；
+安装了 httpx 和 h2 时，接口请求改用HTTP/2（同一主机的并发请求复用一个连接）
+"""
+import socket
+import threading
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def keepalive_socket_options(idle=60, interval=15, count=4):
+    """开启TCP keep-alive，空闲的长连接不会被中间设备悄悄断开"""
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # 各平台支持的选项不同，只设置存在的
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class PooledAdapter(HTTPAdapter):
+    """连接池大小可配置、开启TCP keep-alive的适配器"""
+
+    DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+    def __init__(self, hosts, connections_per_host):
+        self.socket_options = keepalive_socket_options()
+        self.connections_per_host = connections_per_host
+        self._requests = {}
+        self._stats_lock = threading.Lock()
+        super().__init__(pool_connections=hosts, pool_maxsize=connections_per_host)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        parts = urlsplit(request.url)
+        host = f"{parts.scheme}://{parts.hostname}:{parts.port or self.DEFAULT_PORTS.get(parts.scheme)}"
+        with self._stats_lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+        return super().send(request, *args, **kwargs)
+
+    def pool_stats(self):
+        """
+        各主机连接池的统计：请求数（适配器自己计数），以及从urllib3连接池读取的新建连接数和空闲连接数
+        urllib3的内部结构变化导致读取失败时，只报告请求数
+        """
+        with self._stats_lock:
+            stats = {host: {'requests': count, 'maxsize': self.connections_per_host}
+                     for host, count in self._requests.items()}
+        try:
+            pools = self.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{key.key_scheme}://{key.key_host}:{key.key_port}"
+                stats.setdefault(host, {'requests': 0, 'maxsize': self.connections_per_host})
+                stats[host]['connections'] = pool.num_connections
+                # 队列中预先填充了None占位，只统计真正的连接
+                stats[host]['idle'] = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        except Exception:
+            pass
+        return stats
+
+
+def make_session(headers, hosts, connections_per_host):
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = PooledAdapter(hosts, connections_per_host)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class HTTP2Client:
+    """
+    基于 httpx 的HTTP/2接口客户端，get 的参数与 requests 相同（params/cookies/headers/timeout）
+    线程安全；cookies 转为请求头发送，不写入客户端的cookie存储
+    """
+
+    def __init__(self, headers, max_connections, keepalive_expiry=60):
+        self.client = httpx.Client(
+            http2=True,
+            headers=headers,
+            # 不保存响应设置的cookies，否则之后的每个请求都会带上（包括其他账号的请求）
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections,
+                                keepalive_expiry=keepalive_expiry),
+        )
+        self._lock = threading.Lock()
+        self.versions = {}
+
+    def get(self, url, params=None, cookies=None, headers=None, timeout=None):
+        headers = dict(headers or {})
+        if cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in cookies.items())
+        response = self.client.get(url, params=params, headers=headers,
+                                   timeout=timeout if timeout is not None else 30)
+        with self._lock:
+            self.versions[response.http_version] = self.versions.get(response.http_version, 0) + 1
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+class Transport:
+    """
+    接口和CDN两个连接池
+    api: 接口请求（requests.Session，登录等流程也使用它，cookies保存在其中）
+    cdn: CDN下载（requests.Session，每个镜像主机一个连接池）
+    api_get: 接口GET请求，可用时走HTTP/2
+    """
+
+    def __init__(self, headers, api_connections=16, cdn_connections=32, cdn_hosts=16,
+                 http2=True):
+        self.api = make_session(headers, 4, api_connections)
+        self.cdn = make_session(headers, cdn_hosts, cdn_connections)
+        self.http2 = None
+        if http2 and httpx is not None:
+            try:
+                self.http2 = HTTP2Client(headers, api_connections)
+            except ImportError:
+                # 没有安装 h2 时 httpx 不能使用HTTP/2
+                self.http2 = None
+
+    def api_get(self, url, **kwargs):
+        """接口GET请求：参数与 requests.get 相同，返回的响应有 status_code、headers 和 json()"""
+        if self.http2 is not None and url.startswith('https://'):
+            return self.http2.get(url, **kwargs)
+        return self.api.get(url, **kwargs)
+
+    def stats(self):
+        """连接池统计"""
+        stats = {
+            'api': self.api.get_adapter('https://').pool_stats(),
+            'cdn': self.cdn.get_adapter('https://').pool_stats(),
+            'http2': self.http2 is not None,
+        }
+        if self.http2 is not None:
+            stats['api_http_versions'] = dict(self.http2.versions)
+        return stats
+
+    def close(self):
+        self.api.close()
+        self.cdn.close()
+        if self.http2 is not None:
+            self.http2.close()